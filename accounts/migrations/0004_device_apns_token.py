@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2026-10-19 21:10
+
+from django.db import migrations, models
+from django.db.models.functions import Lower
+
+
+def lowercase_platforms(apps, schema_editor):
+    # The register view used to store whatever case the client sent ("Android")
+    Device = apps.get_model('accounts', 'Device')
+    Device.objects.exclude(platform__in=['android', 'ios']).update(platform=Lower('platform'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_smsmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='apns_token',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+        migrations.RunPython(lowercase_platforms, migrations.RunPython.noop),
+    ]
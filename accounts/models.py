@@ -163,6 +163,42 @@ class OtpCode(models.Model):
         return f"OTP for {self.user.email} ({self.code}) - {self.purpose}"
 
 
+class SmsMessage(models.Model):
+    """
+    Outgoing SMS sent by utils.twilio_service, updated with the delivery
+    outcome from Twilio's status callback (TwilioStatusCallbackView).
+    """
+    STATUSES = [
+        ("accepted", "Accepted"),
+        ("queued", "Queued"),
+        ("sending", "Sending"),
+        ("sent", "Sent"),
+        ("delivered", "Delivered"),
+        ("undelivered", "Undelivered"),
+        ("failed", "Failed"),
+        ("canceled", "Canceled"),
+    ]
+    FINAL_STATUSES = {"delivered", "undelivered", "failed", "canceled"}
+
+    sid = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    to = models.CharField(max_length=20)
+    kind = models.CharField(max_length=50)
+    status = models.CharField(max_length=20, choices=STATUSES, default="queued")
+    error_code = models.CharField(max_length=20, blank=True)
+    error_message = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='accounts_sms_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"SMS {self.kind} to {self.to} ({self.status})"
+
+
 class Subscription(models.Model):
     """
     Stores user subscription details with full management capabilities.
@@ -479,6 +515,9 @@ class Device(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="devices")
     token = models.CharField(max_length=255, unique=True)
     platform = models.CharField(max_length=10, choices=[('android', 'Android'), ('ios', 'iOS')])
+    # token is always the FCM registration token; iOS apps may also register
+    # their native APNs device token for direct APNs delivery (utils.apns)
+    apns_token = models.CharField(max_length=255, null=True, blank=True, unique=True)
     is_online = models.BooleanField(default=False, help_text="Whether the device is currently online/app is open")
     last_seen = models.DateTimeField(null=True, blank=True, help_text="Last time the device was seen online")
     created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
@@ -1,3 +1,282 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from celery.exceptions import Retry
+from django.apps import apps
+from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import get_connection
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework.test import APIClient
+
+from accounts.models import Device
+from referralpro.celery import app as celery_app
+from utils import email_service, push
+from utils.rate_limit import TokenBucket
+from utils.tasks import (
+    DeliveryFailed, notify_users_task, send_email_task, send_invitation_task, send_push_task, send_sms_task,
+)
+from utils.twilio_service import TwilioService
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True)
+class CeleryTaskTests(TestCase):
+    """Task layer run eagerly (no worker) on Celery's in-memory broker."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # The Celery app read its config at import; apply the eager flags to it too
+        cls._celery_conf = {
+            key: celery_app.conf[key]
+            for key in ("task_always_eager", "task_eager_propagates", "broker_url")
+        }
+        celery_app.conf.update(task_always_eager=True, task_eager_propagates=True, broker_url="memory://")
+
+    @classmethod
+    def tearDownClass(cls):
+        celery_app.conf.update(cls._celery_conf)
+        super().tearDownClass()
+
+    def test_send_email_task_calls_email_service(self):
+        with mock.patch("utils.email_service.send_otp") as send_otp:
+            send_email_task.delay("send_otp", email="a@example.com", otp_code="123456", purpose="login", expires_in=5)
+        send_otp.assert_called_once_with(email="a@example.com", otp_code="123456", purpose="login", expires_in=5)
+
+    def test_send_sms_task_calls_twilio_service(self):
+        with mock.patch("utils.twilio_service.TwilioService.send_referral_sms", return_value={"success": True, "sid": "SM1"}) as send:
+            result = send_sms_task.delay("send_referral_sms", phone_number="+15550100", referred_to_name="A",
+                                         company_name="B", referred_by_name="C").get()
+        send.assert_called_once()
+        self.assertEqual(result["sid"], "SM1")
+
+    def test_send_sms_task_retries_reported_failures(self):
+        failed = {"success": False, "error": "boom"}
+        with mock.patch("utils.twilio_service.TwilioService.send_app_download_sms", return_value=failed), \
+                self.assertRaises(Retry) as raised:
+            send_sms_task.delay("send_app_download_sms", phone_number="+15550100", name="A")
+        self.assertIsInstance(raised.exception.exc, DeliveryFailed)
+
+    def test_send_sms_task_requeues_when_rate_limited(self):
+        from utils.twilio_service import RateLimited
+
+        with mock.patch("utils.twilio_service.TwilioService.send_sms", side_effect=[RateLimited(0.5), "SM3"]) as send, \
+                mock.patch.object(send_sms_task, "apply_async", wraps=send_sms_task.apply_async) as apply_async:
+            result = send_sms_task.delay("send_sms", phone_number="+15550100", otp_code="123456").get()
+
+        self.assertEqual(result, {"rate_limited": True, "retry_in": 0.5})
+        self.assertEqual(send.call_count, 2)
+        # Re-queued with the bucket's wait, not counted as a failed attempt
+        requeue = apply_async.call_args_list[-1]
+        self.assertEqual(requeue.kwargs["countdown"], 0.5)
+        self.assertEqual(requeue.kwargs["args"], ("send_sms",))
+
+    @override_settings(SHARED_CACHE=False, DEBUG=False, TESTING=False, TWILIO_SMS_DEDUPE_SECONDS=300)
+    def test_send_sms_task_does_not_retry_a_misconfigured_cache(self):
+        # Surfaces as the configuration error, not as a DeliveryFailed retry
+        with mock.patch("utils.twilio_service.get_client") as get_client, \
+                self.assertRaises(ImproperlyConfigured):
+            send_sms_task.delay("send_referral_sms", phone_number="+15550100", referred_to_name="A",
+                                company_name="B", referred_by_name="C")
+        get_client.assert_not_called()
+
+    def test_notify_users_task_calls_notify(self):
+        payload = {"event": "system.update", "title": "Hi", "message": "Hello"}
+        with mock.patch("utils.notify.notify_users") as notify:
+            notify_users_task.delay([1, 2], payload, "notification")
+        notify.assert_called_once_with([1, 2], payload, "notification", strict=True)
+
+    def test_notify_users_task_retries_when_storage_fails(self):
+        user = apps.get_model("accounts", "User").objects.create_user(email="notified@example.com")
+        payload = {"event": "system.update", "title": "Hi", "message": "Hello"}
+        with mock.patch("utils.notify._create_notifications_safely", side_effect=DatabaseError("gone away")), \
+                mock.patch("utils.notify._send_notification_batches") as send, \
+                self.assertRaises(Retry):
+            notify_users_task.delay([user.id], payload)
+        # Nothing went out for the failed attempt, so the retry can't duplicate it
+        send.assert_not_called()
+
+    def test_send_push_task_retries_only_failed_devices(self):
+        result = {"success": 1, "failed_tokens": ["slow", "dead"], "invalid_tokens": ["dead"]}
+        with mock.patch("utils.push.send_push_notification_to_user", return_value=result), \
+                self.assertRaises(Retry) as raised:
+            send_push_task.delay(1, "Hi", "Hello", {"k": "v"})
+        self.assertEqual(raised.exception.sig.kwargs, {"tokens": ["slow"]})
+
+    def test_send_push_task_does_not_retry_full_success(self):
+        result = {"success": 2, "failed_tokens": [], "invalid_tokens": []}
+        with mock.patch("utils.push.send_push_notification_to_user", return_value=result) as push:
+            send_push_task.delay(1, "Hi", "Hello")
+        push.assert_called_once_with(user=1, title="Hi", body="Hello", data=None, tokens=None)
+
+    def test_invitation_task_sets_and_emails_a_fresh_password(self):
+        User = apps.get_model("accounts", "User")
+        user = User.objects.create_user(email="invitee@example.com", full_name="Invitee", is_passwordSet=False)
+
+        with mock.patch("utils.email_service.send_invitation_email") as send:
+            send_invitation_task.delay(user.id)
+
+        password = send.call_args.kwargs["password"]
+        user.refresh_from_db()
+        self.assertTrue(user.check_password(password))
+        self.assertEqual(send.call_args.kwargs["email"], "invitee@example.com")
+
+    def test_invitation_task_skips_users_who_set_a_password(self):
+        User = apps.get_model("accounts", "User")
+        user = User.objects.create_user(email="member@example.com", password="chosen", is_passwordSet=True)
+
+        with mock.patch("utils.email_service.send_invitation_email") as send:
+            send_invitation_task.delay(user.id)
+
+        send.assert_not_called()
+        user.refresh_from_db()
+        self.assertTrue(user.check_password("chosen"))
+
+    def test_delay_on_commit_waits_for_commit(self):
+        with mock.patch("utils.email_service.send_otp") as send_otp:
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                send_email_task.delay_on_commit("send_otp", email="a@example.com", otp_code="1", purpose="login", expires_in=5)
+            send_otp.assert_not_called()
+
+            for callback in callbacks:
+                callback()
+        send_otp.assert_called_once()
+
+
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend", EMAIL_POOL_SIZE=1)
+class EmailConnectionPoolTests(SimpleTestCase):
+    def setUp(self):
+        # A fresh pool per test, built against the locmem backend
+        email_service._pool = None
+        self.addCleanup(setattr, email_service, "_pool", None)
+
+    def _send_otps(self, count):
+        with mock.patch("utils.email_service.get_connection", wraps=get_connection) as opened:
+            for i in range(count):
+                email_service.send_otp(email=f"user{i}@example.com", otp_code="123456", purpose="login", expires_in=5)
+        return opened.call_count
+
+    def test_one_connection_serves_every_message(self):
+        self.assertEqual(self._send_otps(5), 1)
+        self.assertEqual([m.to for m in mail.outbox], [[f"user{i}@example.com"] for i in range(5)])
+
+    @override_settings(EMAIL_CONNECTION_MAX_MESSAGES=2)
+    def test_connection_is_retired_after_max_messages(self):
+        self.assertEqual(self._send_otps(5), 3)
+        self.assertEqual(len(mail.outbox), 5)
+
+
+class SmsRateLimitTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_bucket_allows_capacity_then_reports_the_wait(self):
+        bucket = TokenBucket("test", rate=2)
+        with mock.patch("utils.rate_limit.time.time", return_value=1000.0):
+            self.assertEqual([bucket.take(), bucket.take()], [0, 0])
+            self.assertAlmostEqual(bucket.take(), 0.5)
+        with mock.patch("utils.rate_limit.time.time", return_value=1000.5):
+            self.assertEqual(bucket.take(), 0)
+
+    @override_settings(SHARED_CACHE=False, DEBUG=False, TESTING=False)
+    def test_bucket_requires_shared_cache(self):
+        with self.assertRaises(ImproperlyConfigured):
+            TokenBucket("test", rate=2).take()
+
+    @override_settings(SHARED_CACHE=False, DEBUG=False, TESTING=False, TWILIO_SMS_DEDUPE_SECONDS=300)
+    def test_sms_dedupe_requires_shared_cache(self):
+        with mock.patch("utils.twilio_service.get_client") as get_client, self.assertRaises(ImproperlyConfigured):
+            TwilioService.send_sms(phone_number="+15550100", otp_code="123456")
+        get_client.assert_not_called()
+
+
+class DeviceRegistrationTests(TestCase):
+    APNS_TOKEN = "ab" * 32
+
+    @classmethod
+    def setUpTestData(cls):
+        User = apps.get_model("accounts", "User")
+        cls.user = User.objects.create_user(email="device@example.com", password="x")
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_platform_is_stored_lowercase_with_the_apns_token(self):
+        response = self.client.post(
+            "/auth/push/register/", {"token": "fcm-ios", "platform": "iOS", "apns_token": self.APNS_TOKEN}, format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+        device = Device.objects.get(token="fcm-ios")
+        self.assertEqual((device.platform, device.apns_token), ("ios", self.APNS_TOKEN))
+
+        self.client.post("/auth/push/register/", {"token": "fcm-android"}, format="json")
+        self.assertEqual(Device.objects.get(token="fcm-android").platform, "android")
+
+    def test_unknown_platform_and_bad_apns_tokens_are_rejected(self):
+        response = self.client.post("/auth/push/register/", {"token": "t1", "platform": "web"}, format="json")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(
+            "/auth/push/register/", {"token": "t2", "platform": "android", "apns_token": self.APNS_TOKEN}, format="json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Device.objects.exists())
+
+
+class PushRoutingTests(TestCase):
+    APNS_TOKEN = "cd" * 32
+
+    @classmethod
+    def setUpTestData(cls):
+        User = apps.get_model("accounts", "User")
+        cls.user = User.objects.create_user(email="push@example.com", password="x")
+        Device.objects.create(user=cls.user, token="fcm-native", platform="ios", apns_token=cls.APNS_TOKEN)
+        Device.objects.create(user=cls.user, token="fcm-only", platform="ios")
+
+    def test_only_apns_tokens_go_to_apns_and_a_rejection_keeps_the_device(self):
+        fcm = mock.Mock()
+        fcm.send_each.side_effect = lambda chunk: mock.Mock(
+            responses=[mock.Mock(success=True, message_id=f"fcm-{m.token}") for m in chunk],
+        )
+        apns_client = mock.Mock()
+        apns_client.send_many.return_value = [
+            {"token": self.APNS_TOKEN, "success": False, "status": 400, "reason": "BadDeviceToken", "invalid": True},
+        ]
+
+        with mock.patch("utils.push.firebase_messaging", fcm), \
+                mock.patch("utils.push.apns_enabled", return_value=True), \
+                mock.patch("utils.push.get_apns_client", return_value=apns_client):
+            result = push.send_push_notifications([(self.user.id, "Hi", "Hello", None)])
+
+        apns_items = apns_client.send_many.call_args.args[0]
+        self.assertEqual([item[0] for item in apns_items], [self.APNS_TOKEN])
+        self.assertEqual([m.token for m in fcm.send_each.call_args.args[0]], ["fcm-only"])
+
+        # The FCM registration survives; only the dead APNs token is cleared
+        device = Device.objects.get(token="fcm-native")
+        self.assertIsNone(device.apns_token)
+        self.assertEqual(result["failed_tokens"], ["fcm-native"])
+        self.assertEqual(result["invalid_tokens"], [])
+
+
+@override_settings(TWILIO_SMS_DEDUPE_SECONDS=300)
+class SmsDedupeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_duplicate_during_the_first_send_gets_no_placeholder_sid(self):
+        duplicates = []
+
+        def create(**kwargs):
+            # A second worker sends the same SMS while Twilio is still answering the first
+            duplicates.append(TwilioService.send_sms(phone_number="+15550100", otp_code="123456"))
+            return mock.Mock(sid="SM1", status="queued")
+
+        with mock.patch("utils.twilio_service.get_client") as get_client:
+            get_client.return_value.messages.create.side_effect = create
+            sid = TwilioService.send_sms(phone_number="+15550100", otp_code="123456")
+            again = TwilioService.send_sms(phone_number="+15550100", otp_code="123456")
+
+        self.assertEqual((sid, duplicates, again), ("SM1", [None], "SM1"))
+        get_client.return_value.messages.create.assert_called_once()
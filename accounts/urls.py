@@ -20,6 +20,7 @@ from .views import (
     checkPhoneExistsView,
     RegisterFCMTokenView,
     UnregisterFCMTokenView,
+    TwilioStatusCallbackView,
     # Review views
     ReviewManagementView,
     BusinessReviewsView,
@@ -63,6 +64,9 @@ urlpatterns = [
     path("push/register/", RegisterFCMTokenView.as_view()),
     path("push/unregister/", UnregisterFCMTokenView.as_view()),
 
+    # Twilio delivery reports
+    path("twilio_status/", TwilioStatusCallbackView.as_view(), name="twilio_status"),
+
     
 
 ]
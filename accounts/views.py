@@ -4,7 +4,7 @@ from django.conf import settings
 from django.utils import timezone
 from django.utils.timezone import localtime
 from django.db import models
-from django.db.models import Avg
+from django.db.models import Avg, Q
 # rest framework
 from rest_framework_simplejwt.tokens import RefreshToken, TokenError
 from rest_framework.views import APIView
@@ -14,13 +14,12 @@ from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework_simplejwt.tokens import RefreshToken
 
 # models
-from .models import User, FavoriteCompany, ReferralUsage, BusinessInfo, Device, Review, ReviewImage
+from .models import User, FavoriteCompany, ReferralUsage, BusinessInfo, Device, Review, ReviewImage, SmsMessage
 from .models import Subscription, Transaction
 
 # utils
 from utils.otp_utils import generate_otp, verify_otp
-from utils.twilio_service import TwilioService
-from utils.email_service import send_otp, send_invitation_email, send_company_signup_email, send_payment_failed_email, send_payment_success_email, send_solo_signup_success_email
+from utils.tasks import send_email_task, send_invitation_task, send_sms_task
 from utils.stripe_payment import stripe_payment
 from utils.storage_backends import generate_presigned_url
 # google auth
@@ -28,9 +27,8 @@ from google.oauth2 import id_token
 from google.auth.transport import requests as google_requests
 
 # other
+import re
 import requests
-import secrets
-import string
 import jwt
 from datetime import datetime, timedelta
 import json
@@ -39,9 +37,6 @@ import jwt
 from jwt.algorithms import RSAAlgorithm
 
 
-def generate_random_password(length=10):
-    chars = string.digits + string.ascii_uppercase + string.ascii_lowercase
-    return ''.join(secrets.choice(chars) for _ in range(length))
 
 
 
@@ -155,7 +150,7 @@ class SignupView(APIView):
             
             user.save()
 
-            send_company_signup_email(user.email, user.full_name)
+            send_email_task.delay_on_commit("send_company_signup_email", email=user.email, name=user.full_name)
 
             # Now start Stripe payment (after DB records are stored)
             try:
@@ -187,7 +182,9 @@ class SignupView(APIView):
 
                     if not payment_details:
                         # Send internal email with full error for your team
-                        send_payment_failed_email(user.email, user.full_name, payment_error)
+                        send_email_task.delay_on_commit(
+                            "send_payment_failed_email", email=user.email, name=user.full_name, reason=payment_error
+                        )
 
                         # Delete user if needed
                         user.delete()
@@ -292,14 +289,15 @@ class SignupView(APIView):
                 user.is_paid = True
                 user.save()
 
-                send_payment_success_email(
-                    user.email,
-                    user.full_name,
-                    plan_name,
-                    price,
-                    payment_details.get("currency", "USD"),
-                    period_end.strftime("%Y-%m-%d"),
-                    payment_details.get("receipt_url")
+                send_email_task.delay_on_commit(
+                    "send_payment_success_email",
+                    email=user.email,
+                    name=user.full_name,
+                    plan_name=plan_name,
+                    amount=price,
+                    currency=payment_details.get("currency", "USD"),
+                    expiry_date=period_end.strftime("%Y-%m-%d"),
+                    receipt_url=payment_details.get("receipt_url"),
                 )
 
             except Exception as e:
@@ -310,7 +308,7 @@ class SignupView(APIView):
 
             tokens = get_tokens_for_user(user)
 
-            send_solo_signup_success_email(user.email, user.full_name)
+            send_email_task.delay_on_commit("send_solo_signup_success_email", email=user.email, name=user.full_name)
 
             return Response({
                 "message": "Business user registered and payment successful",
@@ -450,7 +448,7 @@ class SignupView(APIView):
                             used_by=user
                         )
 
-                    send_solo_signup_success_email(user.email, user.full_name)
+                    send_email_task.delay_on_commit("send_solo_signup_success_email", email=user.email, name=user.full_name)
                         
 
                     return Response({
@@ -760,12 +758,19 @@ class SendOTPView(APIView):
 
         # Send OTP via email or SMS
         try:
+            # OTPs go ahead of every other queued email/SMS
             if email:
-                send_otp(email, otp.code, "password reset", 10)
+                send_email_task.apply_async_on_commit(
+                    args=("send_otp",),
+                    kwargs={"email": email, "otp_code": otp.code, "purpose": "password reset", "expires_in": 10},
+                    priority=settings.TASK_PRIORITY_HIGH,
+                )
             else:
-                # print(phone)
-                twilio = TwilioService()
-                twilio.send_sms(phone, otp.code, "reset password", 10)
+                send_sms_task.apply_async_on_commit(
+                    args=("send_sms",),
+                    kwargs={"phone_number": phone, "otp_code": otp.code, "purpose": "reset password", "expires_in": 10},
+                    priority=settings.TASK_PRIORITY_HIGH,
+                )
             
             return Response({"message": f"OTP sent successfully to your {'email' if email else 'phone'}", "otp": otp.code}, status=200)
         except Exception as e:
@@ -888,11 +893,10 @@ class EmployeeManagementView(APIView):
                     return Response({"error": "Seat limit reached. Upgrade your subscription to add more employees."}, status=status.HTTP_400_BAD_REQUEST)
 
 
-            password = generate_random_password()
-
+            # The temporary password is set by the invitation task, so it never
+            # travels through the broker; until then the account can't log in
             user = User.objects.create_user(
                 email=email,
-                password=password,
                 full_name=name,
                 role="employee",
                 is_passwordSet=False,
@@ -903,8 +907,9 @@ class EmployeeManagementView(APIView):
                 sbData.seats_used += 1
                 sbData.save()
 
+            # SMTP failures are retried by the task; only a failed enqueue undoes the invite
             try:
-                send_invitation_email(email, name, password)
+                send_invitation_task.delay_on_commit(user.id)
             except Exception as e:
                 user.delete()
                 return Response({"error": f"Failed to send invitation: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -1048,13 +1053,13 @@ class SendResetPasswordView(APIView):
         except User.DoesNotExist:
             return Response({"error": "Employee not found"}, status=status.HTTP_404_NOT_FOUND)
 
-        new_password = generate_random_password()
-        user.set_password(new_password)
+        # The old password stops working now; the task sets and emails a new one
+        user.set_unusable_password()
         user.is_passwordSet = False
         user.save()
 
         try:
-            send_invitation_email(user.email, user.full_name, new_password)
+            send_invitation_task.delay_on_commit(user.id)
         except Exception as e:
             return Response({"error": f"Failed to send email: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -1385,10 +1390,16 @@ class RegisterFCMTokenView(APIView):
     def post(self, request):
         try:
             token = request.data.get("token")
-            platform = request.data.get("platform", "Android")
+            # Stored lowercase so push routing can compare it
+            platform = str(request.data.get("platform") or "android").strip().lower()
+            apns_token = (request.data.get("apns_token") or "").strip() or None
 
             if not token:
                 return Response({"error": "Token is required"}, status=400)
+            if platform not in dict(Device._meta.get_field("platform").choices):
+                return Response({"error": "platform must be 'android' or 'ios'"}, status=400)
+            if apns_token and (platform != "ios" or not re.fullmatch(r"[0-9a-fA-F]{64,200}", apns_token)):
+                return Response({"error": "Invalid APNs device token"}, status=400)
 
             # Optional: Validate token with Firebase
             try:
@@ -1397,14 +1408,16 @@ class RegisterFCMTokenView(APIView):
             except Exception:
                 return Response({"error": "Invalid FCM token"}, status=400)
 
-            # Remove any existing instances of this token
-            Device.objects.filter(token=token).delete()
+            # Remove any existing instances of this token (or of this phone's APNs token)
+            existing = Q(token=token) | Q(apns_token=apns_token) if apns_token else Q(token=token)
+            Device.objects.filter(existing).delete()
             
             # Create new device record for current user
             Device.objects.create(
                 user=request.user,
                 token=token,
-                platform=platform
+                platform=platform,
+                apns_token=apns_token,
             )
             
             return Response({"message": "Token registered successfully"})
@@ -1426,6 +1439,44 @@ class UnregisterFCMTokenView(APIView):
         return Response({"message": "Token removed"})
 
 
+class TwilioStatusCallbackView(APIView):
+    """
+    Twilio message status callback (TWILIO_STATUS_CALLBACK_URL): records each
+    SMS's delivery outcome on accounts.SmsMessage.
+    """
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+    def post(self, request):
+        from twilio.request_validator import RequestValidator
+
+        params = request.POST.dict()
+        signature = request.META.get("HTTP_X_TWILIO_SIGNATURE", "")
+        # Validate against the URL Twilio was given; behind a proxy the request URL differs
+        url = settings.TWILIO_STATUS_CALLBACK_URL or request.build_absolute_uri()
+        if not RequestValidator(settings.TWILIO_AUTH_TOKEN).validate(url, params, signature):
+            return Response({"error": "Invalid signature"}, status=status.HTTP_403_FORBIDDEN)
+
+        sid = params.get("MessageSid")
+        message_status = params.get("MessageStatus")
+        if not sid or not message_status:
+            return Response({"error": "MessageSid and MessageStatus are required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        messages = SmsMessage.objects.filter(sid=sid)
+        # Callbacks can arrive out of order; never move a final status back to "sent"
+        if message_status not in SmsMessage.FINAL_STATUSES:
+            messages = messages.exclude(status__in=SmsMessage.FINAL_STATUSES)
+        messages.update(
+            status=message_status,
+            error_code=params.get("ErrorCode") or "",
+            updated_at=timezone.now(),
+        )
+
+        if message_status in ("undelivered", "failed"):
+            print(f"SMS {sid} {message_status} (error {params.get('ErrorCode') or 'unknown'})")
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
 # ==========================================
 # REVIEW MANAGEMENT APIS
 # ==========================================
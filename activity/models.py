@@ -4,8 +4,9 @@ from django.utils import timezone
 from accounts.models import User
 from referr.models import Referral
 from chat.models import ChatRoom, Message
+from utils.ids import SnowflakeIdMixin, SnowflakeManager
 
-class ActivityLog(models.Model):
+class ActivityLog(SnowflakeIdMixin, models.Model):
     class Event(models.TextChoices):
         SEND_REFERRAL      = "send_referral", "Send Referral"
         FRIEND_OPTIN       = "friend_optin", "Friend Opt-in"
@@ -15,6 +16,8 @@ class ActivityLog(models.Model):
         COMPLETED          = "completed", "Completed"
         CANCELLED          = "cancelled", "Cancelled"
 
+    objects = SnowflakeManager()
+
     event = models.CharField(max_length=40, choices=Event.choices)
     actor = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, related_name="activity_actor")
     referral = models.ForeignKey(Referral, null=True, blank=True, on_delete=models.SET_NULL, related_name="activities")
@@ -1,6 +1,20 @@
+import logging
+
 from django.apps import AppConfig
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
 
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from utils.shared_cache import shared_cache_available
+
+        # Web processes queue digests that push workers flush; without a
+        # shared cache utils.push_digest sends every push immediately
+        if settings.PUSH_DIGEST_WINDOW_SECONDS > 0 and not shared_cache_available():
+            logger.warning("Chat push digests need a shared cache (CACHE_URL); sending pushes without a digest window")
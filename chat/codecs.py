@@ -0,0 +1,116 @@
+import json
+import uuid
+import zlib
+from datetime import date, datetime
+from decimal import Decimal
+
+import msgpack
+from django.conf import settings
+
+# Header byte on frames of the ".deflate" subprotocols
+FRAME_RAW = 0x00
+FRAME_DEFLATED = 0x01
+
+
+class CodecError(ValueError):
+    pass
+
+
+def _default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, (Decimal, uuid.UUID)):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+class DateTimeEncoder(json.JSONEncoder):
+    """JSON encoder that converts datetime -> ISO string"""
+    def default(self, obj):
+        return _default(obj)
+
+
+class FrameCodec:
+    """
+    Encodes/decodes WebSocket frames for one negotiated subprotocol.
+
+    - "json": text frames (the default when the client offers nothing we know)
+    - "msgpack": binary msgpack frames
+    - "<codec>.deflate": binary frames with a one-byte header; payloads above
+      WS_DEFLATE_THRESHOLD_BYTES are zlib-compressed (header FRAME_DEFLATED),
+      smaller ones are sent as-is (header FRAME_RAW)
+    """
+
+    def __init__(self, name, fmt, deflate=False):
+        self.name = name
+        self.fmt = fmt
+        self.deflate = deflate
+
+    @property
+    def binary(self):
+        return self.fmt == "msgpack" or self.deflate
+
+    def _dumps(self, data):
+        if self.fmt == "msgpack":
+            return msgpack.packb(data, default=_default, use_bin_type=True)
+        return json.dumps(data, cls=DateTimeEncoder, separators=(",", ":"))
+
+    def _loads(self, payload):
+        if self.fmt == "msgpack":
+            return msgpack.unpackb(payload, raw=False)
+        return json.loads(payload)
+
+    def encode(self, data):
+        """Returns (text_data, bytes_data); exactly one is set."""
+        payload = self._dumps(data)
+        if not self.deflate:
+            return (None, payload) if self.binary else (payload, None)
+
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        if len(payload) >= settings.WS_DEFLATE_THRESHOLD_BYTES:
+            return None, bytes([FRAME_DEFLATED]) + zlib.compress(payload, settings.WS_DEFLATE_LEVEL)
+        return None, bytes([FRAME_RAW]) + payload
+
+    def decode(self, text_data=None, bytes_data=None):
+        try:
+            # Text frames are always plain JSON, whatever was negotiated
+            if text_data is not None:
+                return json.loads(text_data)
+            if not bytes_data:
+                return {}
+
+            payload = bytes_data
+            if self.deflate:
+                header, payload = payload[0], payload[1:]
+                if header == FRAME_DEFLATED:
+                    payload = zlib.decompress(payload)
+                elif header != FRAME_RAW:
+                    raise CodecError(f"Unknown frame header {header}")
+            return self._loads(payload)
+        except CodecError:
+            raise
+        except (ValueError, TypeError, zlib.error, msgpack.UnpackException) as e:
+            raise CodecError(str(e))
+
+
+JSON_CODEC = FrameCodec("json", "json")
+
+CODECS = {
+    codec.name: codec
+    for codec in (
+        JSON_CODEC,
+        FrameCodec("json.deflate", "json", deflate=True),
+        FrameCodec("msgpack", "msgpack"),
+        FrameCodec("msgpack.deflate", "msgpack", deflate=True),
+    )
+}
+
+
+def negotiate(offered):
+    """Pick the first subprotocol the client offered that we support (else JSON)."""
+    for name in offered or ():
+        codec = CODECS.get(name)
+        if codec is not None:
+            return codec
+    return JSON_CODEC
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Close codes (sent after accept so clients can read them)
+CLOSE_IDLE = 4408
+CLOSE_TOO_MANY_FOR_USER = 4429
+CLOSE_WORKER_FULL = 4503
+
+
+class ConnectionRegistry:
+    """
+    Live WebSocket connections on this worker.
+
+    - Admission: caps sockets per user (WS_MAX_CONNECTIONS_PER_USER) and per
+      worker (WS_MAX_CONNECTIONS_PER_WORKER).
+    - Heartbeats: one sweeper task per worker pings every connection each
+      WS_PING_INTERVAL_SECONDS. Only when WS_IDLE_TIMEOUT_SECONDS is set
+      (opt-in) does it close those that sent no frame of any kind for that
+      long.
+    """
+
+    def __init__(self):
+        self._consumers = set()
+        self._per_user = {}  # user_id -> live sockets on this worker
+        self._sweeper = None
+
+    def __len__(self):
+        return len(self._consumers)
+
+    def admit(self, consumer, user_id):
+        """Register the consumer; returns a close code if it must be refused."""
+        if len(self._consumers) >= settings.WS_MAX_CONNECTIONS_PER_WORKER:
+            logger.warning(f"Refusing WebSocket for user {user_id}: worker at capacity")
+            return CLOSE_WORKER_FULL
+        if self._per_user.get(user_id, 0) >= settings.WS_MAX_CONNECTIONS_PER_USER:
+            logger.warning(f"Refusing WebSocket for user {user_id}: too many connections")
+            return CLOSE_TOO_MANY_FOR_USER
+
+        self._consumers.add(consumer)
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        self._ensure_sweeper()
+        return None
+
+    def release(self, consumer, user_id):
+        if consumer not in self._consumers:
+            return
+        self._consumers.discard(consumer)
+        count = self._per_user.get(user_id, 0) - 1
+        if count > 0:
+            self._per_user[user_id] = count
+        else:
+            self._per_user.pop(user_id, None)
+
+    def _ensure_sweeper(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._run_sweeper())
+
+    async def _run_sweeper(self):
+        while self._consumers:
+            await asyncio.sleep(settings.WS_PING_INTERVAL_SECONDS)
+            await self.sweep()
+
+    async def sweep(self):
+        now = time.monotonic()
+        ping = {"type": "ping", "timestamp": timezone.now().isoformat()}
+        idle_timeout = settings.WS_IDLE_TIMEOUT_SECONDS
+        idle = 0
+        for consumer in list(self._consumers):
+            try:
+                if idle_timeout > 0 and now - consumer.last_inbound_at > idle_timeout:
+                    idle += 1
+                    self.release(consumer, consumer.user.id)
+                    await consumer.close(code=CLOSE_IDLE)
+                else:
+                    await consumer.send_json(ping)
+            except Exception as e:
+                logger.error(f"Heartbeat sweep failed for a connection: {str(e)}")
+        if idle:
+            logger.info(f"Reaped {idle} idle WebSocket connections")
+
+
+# Shared per-worker registry
+connections = ConnectionRegistry()
@@ -1,7 +1,9 @@
-import json
 import logging
 from datetime import datetime
+from urllib.parse import parse_qs
 import asyncio
+import time
+from django.conf import settings
 from django.db.models import Count, Q
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
@@ -10,21 +12,113 @@ from django.contrib.auth import get_user_model
 User = get_user_model()
 logger = logging.getLogger(__name__)
 from chat.models import ChatRoom, ChatParticipant, Message, MessageReadStatus
+from chat.codecs import JSON_CODEC, CodecError, negotiate
+from chat.connections import connections
+from chat.outbound import CLOSE_SLOW_CONSUMER, CLOSE_WRITE_FAILED, OutboundQueue
+from chat.presence import presence
+from chat.replay import replay_buffer
+from chat.typing_indicators import typing_aggregator
+from chat.serializers import serialize_message_payload, apply_viewer_read_state
 from utils.storage_backends import generate_presigned_url
 from django.utils import timezone
 
 
-# Custom JSON encoder that converts datetime → ISO string
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return super().default(obj)
+# Upper bound for client-supplied typing TTLs
+TYPING_MAX_TTL_SECONDS = 10.0
+# Presigned avatar URLs last an hour; rebuild the typing profile well before that
+TYPING_PROFILE_MAX_AGE_SECONDS = 3000
+
 
 class BaseJsonConsumer(AsyncWebsocketConsumer):
+    """
+    Shared frame encoding for all consumers. The wire format is negotiated
+    through the WebSocket subprotocol (see chat.codecs): JSON text frames by
+    default, msgpack and/or deflate-compressed binary frames on request.
+
+    Ping/pong contract:
+    - the server sends {"type": "ping"} every WS_PING_INTERVAL_SECONDS;
+      clients may answer {"type": "pong"} but are not required to
+    - a client may send {"type": "ping"} at any time and gets {"type": "pong"}
+    - any inbound frame (ping, pong, heartbeat or a normal message) counts as
+      activity; only when WS_IDLE_TIMEOUT_SECONDS is set are sockets silent
+      for longer than that closed with 4408
+    """
+
+    codec = JSON_CODEC
+    _outbound = None
+    _admitted = False
+    last_inbound_at = 0.0
+
+    async def websocket_connect(self, message):
+        """Apply per-user / per-worker connection caps before connect()"""
+        user = self.scope.get("user")
+        if user and not user.is_anonymous:
+            refused = connections.admit(self, user.id)
+            if refused:
+                await self.accept()
+                await self.close(code=refused)
+                return
+            self._admitted = True
+        self.last_inbound_at = time.monotonic()
+        await super().websocket_connect(message)
+
+    async def accept(self, subprotocol=None, headers=None):
+        if subprotocol is None:
+            offered = self.scope.get("subprotocols") or []
+            self.codec = negotiate(offered)
+            if self.codec.name in offered:
+                subprotocol = self.codec.name
+        await super().accept(subprotocol=subprotocol, headers=headers)
+
     async def send_json(self, data):
-        print("Chat rooms data in consumer:", data)
-        await self.send(text_data=json.dumps(data, cls=DateTimeEncoder))
+        """Queue a frame for this connection's writer (see chat.outbound)"""
+        if self._outbound is None:
+            self._outbound = OutboundQueue(self.codec, self.send, on_failure=self._outbound_failed)
+        if not self._outbound.put(data):
+            await self.close(code=CLOSE_SLOW_CONSUMER)
+
+    async def _outbound_failed(self):
+        await self.close(code=CLOSE_WRITE_FAILED)
+
+    async def websocket_disconnect(self, message):
+        if self._admitted:
+            connections.release(self, self.scope["user"].id)
+            self._admitted = False
+        if self._outbound is not None:
+            self._outbound.close()
+        await super().websocket_disconnect(message)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """Decode the inbound frame once and hand it to handle_frame()"""
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+        except CodecError:
+            await self.send_json({"type": "error", "message": "Invalid message format"})
+            return
+        if not isinstance(data, dict):
+            await self.send_json({"type": "error", "message": "Invalid message format"})
+            return
+
+        # Any inbound frame proves the connection is alive
+        self.last_inbound_at = time.monotonic()
+        frame_type = data.get("type")
+        if frame_type in ("ping", "pong"):
+            presence.touch(self.scope["user"].id)
+            if frame_type == "ping":
+                await self.send_json({"type": "pong", "timestamp": timezone.now().isoformat()})
+            return
+
+        await self.handle_frame(data)
+
+    async def handle_frame(self, data):
+        pass
+
+    # Presence hooks (no-ops when the consumer runs inside a multiplexed socket)
+    def presence_join(self):
+        presence.connect(self.user.id)
+
+    def presence_leave(self):
+        presence.disconnect(self.user.id)
 
 
 # ---------------------------------------------
@@ -41,6 +135,20 @@ class ChatConsumer(BaseJsonConsumer):
         # typing state for THIS connection/user
         self._typing_task = None
         self._typing_active = False
+        self._typing_seen_at = 0.0
+        self._typing_profile = None
+        self._typing_profile_at = 0.0
+        self._presence_joined = False
+        # room/permission state cached for the lifetime of the connection
+        self.chat_room = None
+        self.participant_ids = set()
+        self.can_join = False
+        self.can_send = False
+        # read watermark state for THIS connection
+        self._read_watermark = None
+        self._pending_read_watermark = None
+        self._read_flushed_at = 0.0
+        self._read_flush_task = None
 
     async def connect(self):
         try:
@@ -52,19 +160,21 @@ class ChatConsumer(BaseJsonConsumer):
                 await self.close(code=4001)
                 return
 
-            can_join = await self.can_user_join_room()
-            if not can_join:
+            loaded = await self.load_room_state()
+            if not loaded or not self.can_join:
                 await self.close(code=4003)
                 return
 
             await self.channel_layer.group_add(self.room_group_name, self.channel_name)
             await self.accept()
-            await self.update_user_online_status(True)
+            self.presence_join()
+            self._presence_joined = True
 
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
                     "type": "user_joined",
+                    "room_id": self.room_id,
                     "user_id": self.user.id,
                     "user_name": self.user.full_name,
                     "timestamp": timezone.now().isoformat(),
@@ -78,11 +188,22 @@ class ChatConsumer(BaseJsonConsumer):
 
     async def disconnect(self, close_code):
         try:
-            await self.update_user_online_status(False)
+            if not self._presence_joined:
+                return
+            self.presence_leave()
+            self._presence_joined = False
+            await self._typing_stop_broadcast()
+
+            # Don't lose a throttled read receipt
+            if self._read_flush_task and not self._read_flush_task.done():
+                self._read_flush_task.cancel()
+            await self._flush_read_watermark()
+
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
                     "type": "user_left",
+                    "room_id": self.room_id,
                     "user_id": self.user.id,
                     "user_name": self.user.full_name,
                     "timestamp": datetime.now(),
@@ -93,23 +214,27 @@ class ChatConsumer(BaseJsonConsumer):
         except Exception as e:
             logger.error(f"Error in chat disconnect: {str(e)}")
 
-    async def receive(self, text_data):
+    async def handle_frame(self, data):
         try:
-            logger.debug(f"Received data: {text_data}")
-            data = json.loads(text_data)
+            logger.debug(f"Received data: {data}")
             message_type = data.get("type", "chat_message")
 
+            # Any inbound frame counts as a presence heartbeat
+            presence.touch(self.user.id)
+
+            if message_type == "heartbeat":
+                return
             if message_type == "chat_message":
                 await self.handle_chat_message(data)
             elif message_type == "typing":
                 await self.handle_typing_indicator(data)
             elif message_type == "mark_read":
                 await self.handle_mark_read(data)
+            elif message_type == "resume":
+                await self.handle_resume(data)
             else:
                 logger.warning(f"Unknown message type: {message_type}")
 
-        except json.JSONDecodeError:
-            await self.send_json({"type": "error", "message": "Invalid message format"})
         except Exception as e:
             logger.error(f"Error in receive: {str(e)}")
             await self.send_json({"type": "error", "message": "Server error"})
@@ -135,8 +260,7 @@ class ChatConsumer(BaseJsonConsumer):
                     await self.send_json({"type": "error", "message": f"{message_type.title()} messages require file data or content"})
                     return
 
-            can_send = await self.can_user_send_message()
-            if not can_send:
+            if not self.can_send:
                 await self.send_json({"type": "error", "message": "You do not have permission to send messages"})
                 return
 
@@ -154,11 +278,7 @@ class ChatConsumer(BaseJsonConsumer):
                 reply_to=reply_to_message,
             )
 
-            # Broadcast only identifiers; each recipient will serialize the message
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {"type": "chat_message", "room_id": self.room_id, "message_id": message.id},
-            )
+            # Message.save() fans the serialized message out to the room group
 
             # Acknowledge successful message submission to the sender
             await self.send_json({
@@ -175,48 +295,51 @@ class ChatConsumer(BaseJsonConsumer):
     async def handle_typing_indicator(self, data):
         """
         Debounced/TTL typing indicator:
-        - start: broadcast immediately, then schedule auto-stop after short idle window
-        - subsequent keypresses: just reset the timer (no spam)
-        - stop: broadcast immediately and cancel timer
+        - start: record the typer, then schedule auto-stop after short idle window
+        - subsequent keypresses: rate-limited per connection; accepted ones reset the timer
+        - stop: record the stop immediately and cancel timer
+        Broadcasts are coalesced per room by the typing aggregator.
         """
         try:
             is_typing = bool(data.get("is_typing", False))
-            ttl_seconds = float(data.get("ttl", 1.2))  # allow client to override, default ~1.2s
-
-            # Get user image URL
-            user_image_url = (
-                generate_presigned_url(f"media/{self.user.image}", expires_in=3600)
-                if getattr(self.user, "image", None) else None
-            )
-
+            ttl_seconds = min(float(data.get("ttl", 1.2)), TYPING_MAX_TTL_SECONDS)  # allow client to override, default ~1.2s
 
             if is_typing:
-                # Broadcast START only if not already active
+                now = time.monotonic()
+                if self._typing_active and now - self._typing_seen_at < settings.TYPING_MIN_INTERVAL_SECONDS:
+                    return
+                self._typing_seen_at = now
+
                 if not self._typing_active:
                     self._typing_active = True
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            "type": "typing_indicator",
-                            "user_id": self.user.id,
-                            "user_name": self.user.full_name,
-                            "user_image_url": user_image_url,
-                            "is_typing": True,
-                            "timestamp": timezone.now().isoformat(),
-                        },
-                    )
+                    typing_aggregator.update(self.channel_layer, self.room_id, self.channel_name, self.get_typing_profile(), True)
                 # Reset the idle timeout
                 if self._typing_task and not self._typing_task.done():
                     self._typing_task.cancel()
                 self._typing_task = asyncio.create_task(self._typing_timeout(ttl_seconds))
 
             else:
-                # Explicit STOP from client: cancel timer and broadcast stop if active
+                # Explicit STOP from client: cancel timer and record stop if active
                 await self._typing_stop_broadcast()
 
         except Exception as e:
             logger.error(f"Error handling typing indicator: {str(e)}")
 
+    def get_typing_profile(self):
+        """User fields for typing events, computed once per connection (URL refreshed before it expires)"""
+        now = time.monotonic()
+        if self._typing_profile is None or now - self._typing_profile_at > TYPING_PROFILE_MAX_AGE_SECONDS:
+            self._typing_profile = {
+                "user_id": self.user.id,
+                "user_name": self.user.full_name,
+                "user_image_url": (
+                    generate_presigned_url(f"media/{self.user.image}", expires_in=3600)
+                    if getattr(self.user, "image", None) else None
+                ),
+            }
+            self._typing_profile_at = now
+        return self._typing_profile
+
     async def _typing_timeout(self, delay: float):
         try:
             await asyncio.sleep(delay)
@@ -226,111 +349,177 @@ class ChatConsumer(BaseJsonConsumer):
             pass
 
     async def _typing_stop_broadcast(self):
-        """Cancel timer and broadcast stop if we are currently active."""
+        """Cancel timer and record stop if we are currently active."""
         if self._typing_task and not self._typing_task.done():
             self._typing_task.cancel()
         if self._typing_active:
             self._typing_active = False
-            
-            # Get user image URL
-            user_image_url = (
-                generate_presigned_url(f"media/{self.user.image}", expires_in=3600)
-                if getattr(self.user, "image", None) else None
-            )
-            
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "typing_indicator",
-                    "user_id": self.user.id,
-                    "user_name": self.user.full_name,
-                    "user_image_url": user_image_url,
-                    "is_typing": False,
-                    "timestamp": timezone.now().isoformat(),
-                },
-            )
+            typing_aggregator.update(self.channel_layer, self.room_id, self.channel_name, self.get_typing_profile(), False)
 
-    async def typing_indicator(self, event):
-        if event["user_id"] != self.user.id:
-            # normalize payload (explicit type & ISO timestamp already set above)
-            event["type"] = "typing"
-            await self.send_json(event)
+    async def handle_resume(self, data):
+        """
+        Replay what the client missed since {"type": "resume", "last_seq": N}.
+        Served from the in-memory replay buffer when it covers the gap, else
+        from the database; gaps over RESUME_MAX_MESSAGES get "resume_gap" and
+        the client reloads over REST.
+        """
+        try:
+            last_seq = int(data.get("last_seq") or 0)
+        except (TypeError, ValueError):
+            await self.send_json({"type": "error", "message": "Invalid last_seq for resume"})
+            return
+
+        current_seq = await self.get_room_last_seq()
+        payloads = []
+        if last_seq < current_seq:
+            if current_seq - last_seq > settings.RESUME_MAX_MESSAGES:
+                payloads = None
+            else:
+                payloads = replay_buffer.since(self.room_id, last_seq)
+                if payloads is None or not payloads or payloads[-1]["seq"] < current_seq:
+                    payloads = await self._load_messages_since(last_seq, current_seq)
+
+        if payloads is None:
+            await self.send_json({
+                "type": "resume_gap",
+                "room_id": self.room_id,
+                "last_seq": current_seq,
+                "timestamp": timezone.now().isoformat(),
+            })
+            return
+
+        await self.send_json({
+            "type": "resume_replay",
+            "room_id": self.room_id,
+            "messages": [apply_viewer_read_state(p, self.user.id) for p in payloads],
+            "read_watermarks": await self._get_read_watermarks(),
+            "last_seq": current_seq,
+            "timestamp": timezone.now().isoformat(),
+        })
 
     async def handle_mark_read(self, data):
+        """
+        Read receipts are a per-user watermark: "I've read everything up to
+        message N". Legacy message_id / message_ids frames are folded into
+        the watermark. Writes are throttled per connection and only the
+        highest pending watermark is persisted and broadcast.
+        """
         try:
-            message_id = data.get("message_id")
-            message_ids = data.get("message_ids", [])
-            
-            # Support both single message and bulk marking
-            if message_id:
-                message_ids = [message_id]
-            
-            if not message_ids:
-                await self.send_json({"type": "error", "message": "No message IDs provided for mark read"})
+            watermark = data.get("last_read_message_id") or data.get("message_id")
+            if not watermark and data.get("message_ids"):
+                watermark = max(int(mid) for mid in data["message_ids"])
+
+            if not watermark:
+                await self.send_json({"type": "error", "message": "No message ID provided for mark read"})
                 return
-            
-            # Mark messages as read
-            marked_messages = await self.mark_messages_read(message_ids)
-            
-            if marked_messages:
-                # Get the last (highest) message ID for efficient bulk updates
-                last_message_id = max(marked_messages) if marked_messages else None
-                
-                # Broadcast read status update to all room participants
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "message_read_update",
-                        "room_id": self.room_id,
-                        "user_id": self.user.id,
-                        "user_name": self.user.full_name,
-                        "message_ids": marked_messages,
-                        "last_read_message_id": last_message_id,
-                        "read_at": timezone.now().isoformat(),
-                        "timestamp": timezone.now().isoformat(),
-                    }
-                )
-                
-                # Send chat list updates to all participants (unread count changed)
-                await self._send_chat_list_updates_for_read_status()
-                
-                # Acknowledge to sender
-                await self.send_json({
-                    "type": "messages_marked_read",
-                    "message_ids": marked_messages,
-                    "success": True
-                })
-            
+
+            watermark = int(watermark)
+            if watermark > max(self._read_watermark or 0, self._pending_read_watermark or 0):
+                self._pending_read_watermark = watermark
+                await self._schedule_read_flush()
+
+            # Acknowledge to sender
+            await self.send_json({
+                "type": "messages_marked_read",
+                "message_ids": [],
+                "last_read_message_id": max(watermark, self._read_watermark or 0),
+                "success": True
+            })
+
+        except (TypeError, ValueError):
+            await self.send_json({"type": "error", "message": "Invalid message ID for mark read"})
         except Exception as e:
             logger.error(f"Error marking message as read: {str(e)}")
             await self.send_json({"type": "error", "message": "Failed to mark message as read"})
 
+    async def _schedule_read_flush(self):
+        throttle = settings.READ_RECEIPT_THROTTLE_SECONDS
+        elapsed = time.monotonic() - self._read_flushed_at
+        if elapsed >= throttle:
+            await self._flush_read_watermark()
+        elif self._read_flush_task is None or self._read_flush_task.done():
+            self._read_flush_task = asyncio.create_task(self._delayed_read_flush(throttle - elapsed))
+
+    async def _delayed_read_flush(self, delay):
+        try:
+            await asyncio.sleep(delay)
+            await self._flush_read_watermark()
+        except asyncio.CancelledError:
+            pass
+
+    async def _flush_read_watermark(self):
+        """Persist the pending watermark and broadcast it to the room"""
+        watermark, self._pending_read_watermark = self._pending_read_watermark, None
+        if not watermark or watermark <= (self._read_watermark or 0):
+            return
+
+        self._read_flushed_at = time.monotonic()
+        advanced = await self.persist_read_watermark(watermark)
+        if not advanced:
+            return
+        self._read_watermark = watermark
+
+        now = timezone.now().isoformat()
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                "type": "message_read_update",
+                "room_id": self.room_id,
+                "user_id": self.user.id,
+                "user_name": self.user.full_name,
+                "message_ids": [],
+                "last_read_message_id": watermark,
+                "watermark": True,
+                "read_at": now,
+                "timestamp": now,
+            }
+        )
+
+        # Only the reader's unread count changed; their chat list refreshes the room
+        await self.channel_layer.group_send(
+            f"chat_list_{self.user.id}",
+            {
+                "type": "chat_list_update",
+                "room_ids": [self.room_id],
+                "timestamp": now,
+            }
+        )
+
     # Outgoing events (all use safe encoder)
 
     async def chat_message(self, event):
         """
         Normalize to the SAME shape as API messages_data[] for this viewer.
-        Accepts both:
-        1) {"message_id": 123}
-        2) {"message": {"id": 123, ...}}   # legacy producers
+        Accepts:
+        1) {"message_id": 123, "payload": {...}}   # serialized once by the producer
+        2) {"message_id": 123}
+        3) {"message": {"id": 123, ...}}   # legacy producers
         """
-        # --- Accept both new and legacy event shapes ---
-        message_id = event.get("message_id")
-        if not message_id:
-            legacy_msg = event.get("message")
-            if isinstance(legacy_msg, dict):
-                message_id = legacy_msg.get("id")
-
-        if not message_id:
-            logger.error("WS chat_message event missing message_id (and legacy message.id). Ignoring.")
-            return
+        payload = event.get("payload")
+
+        if payload is None:
+            # --- Accept both id-only and legacy event shapes ---
+            message_id = event.get("message_id")
+            if not message_id:
+                legacy_msg = event.get("message")
+                if isinstance(legacy_msg, dict):
+                    message_id = legacy_msg.get("id")
+
+            if not message_id:
+                logger.error("WS chat_message event missing message_id (and legacy message.id). Ignoring.")
+                return
 
-        # --- Serialize to API shape for this viewer ---
-        try:
-            msg_obj = await self._serialize_message_for_client(message_id, self.user)
-        except Exception as e:
-            logger.exception(f"Failed to serialize message {message_id}: {e}")
-            return
+            try:
+                payload = await self._serialize_message_for_client(message_id)
+            except Exception as e:
+                logger.exception(f"Failed to serialize message {message_id}: {e}")
+                return
+
+        # Keep recent payloads so reconnecting clients can resume from memory
+        replay_buffer.record(self.room_id, payload)
+
+        # Only the viewer-specific flags are computed per connection
+        msg_obj = apply_viewer_read_state(payload, self.user.id)
 
         # Add a routing type; rest matches API exactly
         msg_obj["type"] = "chat_message"
@@ -338,8 +527,14 @@ class ChatConsumer(BaseJsonConsumer):
 
 
     async def typing_indicator(self, event):
-        if event["user_id"] != self.user.id:
-            await self.send_json(event)
+        # Skip events that only describe this user's own typing
+        if event.get("user_id") == self.user.id:
+            return
+        started = [t for t in event.get("started", []) if t["user_id"] != self.user.id]
+        stopped = [t for t in event.get("stopped", []) if t["user_id"] != self.user.id]
+        if not started and not stopped:
+            return
+        await self.send_json({**event, "started": started, "stopped": stopped})
 
     async def user_joined(self, event):
         if event["user_id"] != self.user.id:
@@ -362,36 +557,44 @@ class ChatConsumer(BaseJsonConsumer):
                 "read_at": event.get("read_at"),
                 "timestamp": event["timestamp"],
                 "mark_all": event.get("mark_all", False),
+                "watermark": event.get("watermark", False),
             })
 
     async def chat_list_update(self, event):
         # 🔑 FIX: Use safe encoder here
         await self.send_json(event)
 
-    # Wrapper for safe JSON sending
-    async def send_json(self, data):
-        await self.send(text_data=json.dumps(data, cls=DateTimeEncoder))
+    async def room_state_changed(self, event):
+        """Room or participant rows changed elsewhere; reload the cached state"""
+        loaded = await self.load_room_state()
+        if not loaded or not self.can_join:
+            await self.close(code=4003)
 
     # DB operations
     @database_sync_to_async
-    def can_user_join_room(self):
-        ChatRoom = apps.get_model("chat", "ChatRoom")
+    def load_room_state(self):
+        """
+        Load the room, its participants and this user's permissions once per
+        connection. Refreshed by the room_state_changed group event.
+        """
         try:
-            chat_room = ChatRoom.objects.get(room_id=self.room_id)
-            return chat_room.can_user_participate(self.user)
+            chat_room = (
+                ChatRoom.objects
+                .select_related("solo_user", "rep_user", "company_user", "referral")
+                .get(room_id=self.room_id)
+            )
         except ChatRoom.DoesNotExist:
             return False
 
-    @database_sync_to_async
-    def can_user_send_message(self):
-        ChatRoom = apps.get_model("chat", "ChatRoom")
-        ChatParticipant = apps.get_model("chat", "ChatParticipant")
-        try:
-            chat_room = ChatRoom.objects.get(room_id=self.room_id)
-            participant = ChatParticipant.objects.filter(chat_room=chat_room, user=self.user).first()
-            return participant.can_send_messages if participant else chat_room.can_user_participate(self.user)
-        except ChatRoom.DoesNotExist:
-            return False
+        participant = ChatParticipant.objects.filter(chat_room=chat_room, user=self.user).first()
+
+        self.chat_room = chat_room
+        self.participant_ids = {u.id for u in chat_room.get_participants()}
+        self.can_join = chat_room.can_user_participate(self.user)
+        self.can_send = participant.can_send_messages if participant else self.can_join
+        if participant and participant.last_read_message_id:
+            self._read_watermark = max(self._read_watermark or 0, participant.last_read_message_id)
+        return True
 
     @database_sync_to_async
     def save_message(self, content, message_type="text", file_data=None, reply_to=None):
@@ -401,12 +604,9 @@ class ChatConsumer(BaseJsonConsumer):
         from django.core.files.base import ContentFile
         from utils.storage_backends import upload_file_to_s3
         
-        ChatRoom = apps.get_model("chat", "ChatRoom")
-        Message = apps.get_model("chat", "Message")
-        chat_room = ChatRoom.objects.get(room_id=self.room_id)
 
         message_data = {
-            "chat_room": chat_room,
+            "chat_room": self.chat_room,
             "sender": self.user,
             "content": content,
             "message_type": message_type,
@@ -451,251 +651,51 @@ class ChatConsumer(BaseJsonConsumer):
 
     @database_sync_to_async
     def get_reply_message(self, message_id):
-        Message = apps.get_model("chat", "Message")
-        ChatRoom = apps.get_model("chat", "ChatRoom")
         try:
-            chat_room = ChatRoom.objects.get(room_id=self.room_id)
-            return Message.objects.get(id=message_id, chat_room=chat_room)
+            return Message.objects.get(id=message_id, chat_room=self.chat_room)
         except Message.DoesNotExist:
             return None
 
     @database_sync_to_async
-    def mark_message_read(self, message_id):
-        Message = apps.get_model("chat", "Message")
-        MessageReadStatus = apps.get_model("chat", "MessageReadStatus")
-        try:
-            message = Message.objects.get(id=message_id)
-            read_status, _ = MessageReadStatus.objects.get_or_create(message=message, user=self.user)
-            return read_status
-        except Message.DoesNotExist:
-            return None
+    def get_room_last_seq(self):
+        return ChatRoom.objects.filter(pk=self.chat_room.pk).values_list("last_seq", flat=True).get()
 
     @database_sync_to_async
-    def mark_messages_read(self, message_ids):
-        """Mark multiple messages as read and return successfully marked message IDs"""
-        Message = apps.get_model("chat", "Message")
-        MessageReadStatus = apps.get_model("chat", "MessageReadStatus")
-        ChatRoom = apps.get_model("chat", "ChatRoom")
-        
-        try:
-            chat_room = ChatRoom.objects.get(room_id=self.room_id)
-            
-            # Get messages that exist in this room and aren't sent by current user
-            messages = Message.objects.filter(
-                id__in=message_ids,
-                chat_room=chat_room
-            ).exclude(sender=self.user)
-            
-            # Get existing read statuses to avoid duplicates
-            existing_reads = set(
-                MessageReadStatus.objects.filter(
-                    message__in=messages,
-                    user=self.user
-                ).values_list("message_id", flat=True)
-            )
-            
-            # Create new read statuses for unread messages
-            new_reads = []
-            marked_message_ids = []
-            
-            for message in messages:
-                if message.id not in existing_reads:
-                    new_reads.append(MessageReadStatus(message=message, user=self.user))
-                    marked_message_ids.append(message.id)
-                else:
-                    # Already read, but include in response for consistency
-                    marked_message_ids.append(message.id)
-            
-            if new_reads:
-                MessageReadStatus.objects.bulk_create(new_reads)
-            
-            return marked_message_ids
-            
-        except ChatRoom.DoesNotExist:
-            logger.error(f"ChatRoom {self.room_id} not found when marking messages as read")
-            return []
-        except Exception as e:
-            logger.error(f"Error in mark_messages_read: {str(e)}")
-            return []
+    def _get_read_watermarks(self):
+        return self.chat_room.get_read_watermarks()
 
     @database_sync_to_async
-    def update_user_online_status(self, is_online):
-        from django.utils import timezone
-        
-        ChatRoom = apps.get_model("chat", "ChatRoom")
-        ChatParticipant = apps.get_model("chat", "ChatParticipant")
-        Device = apps.get_model("accounts", "Device")
-        
-        try:
-            # Update chat participant status
-            chat_room = ChatRoom.objects.get(room_id=self.room_id)
-            participant, created = ChatParticipant.objects.get_or_create(
-                chat_room=chat_room,
-                user=self.user,
-                defaults={"is_online": is_online},
-            )
-            if not created:
-                participant.is_online = is_online
-                participant.save(update_fields=["is_online", "last_seen_at"])
-            
-            # Update device online status for ALL user's devices
-            if is_online:
-                # Mark all user's devices as online when they connect
-                Device.objects.filter(user=self.user).update(
-                    is_online=True,
-                    last_seen=timezone.now()
-                )
-            else:
-                # Mark all user's devices as offline when they disconnect
-                Device.objects.filter(user=self.user).update(
-                    is_online=False,
-                    last_seen=timezone.now()
-                )
-            
-            print(f"{'✅' if is_online else '🔴'} Updated online status for user {self.user.id}: {is_online}")
-            
-        except ChatRoom.DoesNotExist:
-            pass
-
-    async def _send_chat_list_updates_for_read_status(self):
-        """Send chat list updates to all participants when read status changes"""
-        try:
-            ChatRoom = apps.get_model("chat", "ChatRoom")
-            chat_room = await database_sync_to_async(ChatRoom.objects.get)(room_id=self.room_id)
-            participants = await database_sync_to_async(list)(chat_room.get_participants())
-            
-            # Create a proper mock request class
-            class MockRequest:
-                def __init__(self, user):
-                    self.user = user
-                    self.META = {'HTTP_HOST': 'thereferralpro.com', 'wsgi.url_scheme': 'https'}
-
-                def build_absolute_uri(self, location=None):
-                    base = "https://thereferralpro.com"
-                    return f"{base}{location}" if location else base
-            
-            for participant in participants:
-                # Get updated chat room data with new unread counts
-                rooms_data = await self._fetch_and_serialize_single_room(chat_room, participant)
-                
-                # Send to user's chat list group
-                await self.channel_layer.group_send(
-                    f"chat_list_{participant.id}",
-                    {
-                        "type": "chat_list_update",
-                        "chat_rooms": [rooms_data],
-                        "timestamp": timezone.now().isoformat()
-                    }
-                )
-                
-        except Exception as e:
-            logger.error(f"Error sending chat list updates for read status: {str(e)}")
+    def _load_messages_since(self, last_seq, current_seq):
+        """Messages with last_seq < seq <= current_seq, or None if some are gone"""
+        msgs = list(
+            Message.objects
+            .filter(chat_room=self.chat_room, seq__gt=last_seq, seq__lte=current_seq)
+            .select_related("sender", "chat_room", "reply_to__sender")
+            .prefetch_related("read_statuses", "additional_attachments")
+            .order_by("seq")
+        )
+        if len(msgs) != current_seq - last_seq:
+            return None
+        watermarks = self.chat_room.get_read_watermarks()
+        return [serialize_message_payload(m, self.participant_ids, read_watermarks=watermarks) for m in msgs]
 
     @database_sync_to_async
-    def _fetch_and_serialize_single_room(self, chat_room, viewer):
-        """Serialize a single chat room for a specific viewer"""
-        from utils.storage_backends import generate_presigned_url
-        
-        chat_image = chat_room.get_chat_image(viewer)
-        image_url = generate_presigned_url(f"media/{chat_image}", expires_in=3600) if chat_image else None
-
-        return {
-            "room_id": chat_room.room_id,
-            "room_type": chat_room.room_type,
-            "chat_name": chat_room.get_display_name(viewer),
-            "last_message": chat_room.get_last_message_summary(),
-            "unread_count": chat_room.get_unread_count(viewer),
-            "is_online": chat_room.is_any_participant_online(exclude_user=viewer),
-            "is_active": chat_room.is_active,
-            "created_at": chat_room.created_at.isoformat(),
-            "updated_at": chat_room.updated_at.isoformat(),
-            "referral_id": chat_room.referral.reference_id if getattr(chat_room, "referral", None) else None,
-            "image_url": image_url,
-        }
+    def persist_read_watermark(self, watermark):
+        return ChatParticipant.advance_read_watermark(self.chat_room, self.user, watermark)
 
     @database_sync_to_async
-    def _serialize_message_for_client(self, message_id, viewer):
-        Message = apps.get_model("chat", "Message")
+    def _serialize_message_for_client(self, message_id):
+        """Viewer-independent payload for producers that only sent an id"""
         msg = (
             Message.objects
-            .select_related("sender", "chat_room")
-            .prefetch_related("read_statuses")
+            .select_related("sender", "chat_room", "reply_to__sender")
+            .prefetch_related("read_statuses", "additional_attachments")
             .get(id=message_id)
         )
-
-        # Get participants for proper read state calculation
-        participants = list(msg.chat_room.get_participants())
-        participant_user_ids = set([p.id for p in participants])
-        
-        # Get users who read this message (excluding sender)
-        read_user_ids = set(msg.read_statuses.values_list("user_id", flat=True))
-        read_user_ids.discard(msg.sender_id)
-        
-        # For the viewer: is this message read by me?
-        is_read_by_me = (msg.sender_id == viewer.id) or msg.read_statuses.filter(user_id=viewer.id).exists()
-        
-        # For the sender: did others read it?
-        others_count = len(participant_user_ids - {msg.sender_id})
-        read_by_others_count = len(read_user_ids)
-        read_by_all_others = (others_count > 0 and read_by_others_count == others_count)
-
-        sender_image_url = (
-            generate_presigned_url(f"media/{msg.sender.image}", expires_in=3600)
-            if getattr(msg.sender, "image", None) else None
+        return serialize_message_payload(
+            msg, self.participant_ids, read_watermarks=self.chat_room.get_read_watermarks()
         )
 
-        # Create base message data
-        message_data = {
-            "id": msg.id,
-            "room_id": msg.chat_room.room_id,
-            "sender": {
-                "id": msg.sender.id,
-                "name": msg.sender.full_name,
-                "role": msg.sender.role,
-                "image_url": sender_image_url,
-            },
-            "content": msg.content,
-            "message_type": msg.message_type,
-            "created_at": msg.created_at.isoformat(),
-            
-            # Viewer perspective
-            "is_read_by_me": is_read_by_me,
-            
-            # Sender perspective (for showing "others read" indicators)
-            "read_by_user_ids": list(read_user_ids),
-            "read_by_others_count": read_by_others_count,
-            "read_by_all_others": read_by_all_others,
-            
-            # Legacy fields for backwards compatibility
-            "is_read": is_read_by_me,
-            "read_by": list(msg.read_statuses.values_list("user_id", flat=True)),
-        }
-        
-        # Add file-related fields for media messages
-        if msg.message_type in ['image', 'document', 'file']:
-            message_data.update({
-                "file_url": msg.get_file_url(),  # Use the method to get presigned URL
-                "file_name": msg.file_name,
-                "file_size": msg.file_size,
-                "file_size_formatted": msg.file_size_formatted if hasattr(msg, 'file_size_formatted') else None,
-                "file_type": msg.file_type,
-                "duration": msg.duration,
-                "thumbnail_url": msg.thumbnail_url,
-                "dimensions": msg.dimensions,
-                "attachments": msg.get_attachments_data(),  # Include all attachments
-            })
-            
-        # Add reply info if this is a reply message
-        if msg.reply_to:
-            message_data["reply_to"] = {
-                "id": msg.reply_to.id,
-                "content": msg.reply_to.content[:100] + ('...' if len(msg.reply_to.content) > 100 else ''),
-                "sender_name": msg.reply_to.sender.full_name,
-                "message_type": msg.reply_to.message_type,
-            }
-            
-        return message_data
-
 
 
 # ---------------------------------------------
@@ -728,29 +728,32 @@ class ChatListConsumer(BaseJsonConsumer):
         await self.accept()
 
         # Mark user as online when they connect to chat list
-        await self.update_device_online_status(True)
+        self.presence_join()
 
         # Initial payload: API-shaped rooms list
         rooms_data = await self._fetch_and_serialize_rooms_for_user(self.user)
         user_profile = await self._get_user_profile_info()
 
-        await self.send(text_data=json.dumps({
+        await self.send_json({
             "type": "chat_rooms_loaded",
             "user_profile": user_profile,
             "chat_rooms": rooms_data,
             "timestamp": datetime.now().isoformat()
-        }, cls=DateTimeEncoder))
+        })
 
         print(f"✅ WebSocket connection accepted. Group: {self.group_name}")
 
     async def disconnect(self, close_code):
-        # Mark user as offline when they disconnect from chat list
-        await self.update_device_online_status(False)
-        
         if hasattr(self, 'group_name'):
+            # Mark user as offline when they disconnect from chat list
+            self.presence_leave()
             await self.channel_layer.group_discard(self.group_name, self.channel_name)
             print(f"🔌 WebSocket disconnected from group: {self.group_name}")
 
+    async def handle_frame(self, data):
+        # The chat list is push-only; inbound frames are heartbeats
+        presence.touch(self.user.id)
+
     # ---------- Incoming group event -> out to client ----------
 
     async def chat_list_update(self, event):
@@ -828,7 +831,6 @@ class ChatListConsumer(BaseJsonConsumer):
 
     @database_sync_to_async
     def _query_rooms_for_user(self, viewer):
-        ChatRoom = apps.get_model("chat", "ChatRoom")
 
         if viewer.role == 'solo':
             qs = ChatRoom.objects.filter(solo_user=viewer)
@@ -848,7 +850,6 @@ class ChatListConsumer(BaseJsonConsumer):
 
     @database_sync_to_async
     def _query_rooms_by_ids(self, room_ids):
-        ChatRoom = apps.get_model("chat", "ChatRoom")
         qs = (ChatRoom.objects.filter(room_id__in=room_ids)
               .select_related('solo_user', 'rep_user', 'company_user', 'referral')
               .prefetch_related('messages', 'participants'))
@@ -870,42 +871,26 @@ class ChatListConsumer(BaseJsonConsumer):
             out.append(await self._serialize_room_for_list(r, viewer))
         return out
 
-    @database_sync_to_async
-    def update_device_online_status(self, is_online):
-        """Update device online status for push notification control"""
-        from django.utils import timezone
-        
-        Device = apps.get_model("accounts", "Device")
-        
-        try:
-            if is_online:
-                # Mark all user's devices as online when they connect
-                Device.objects.filter(user=self.user).update(
-                    is_online=True,
-                    last_seen=timezone.now()
-                )
-            else:
-                # Mark all user's devices as offline when they disconnect
-                Device.objects.filter(user=self.user).update(
-                    is_online=False,
-                    last_seen=timezone.now()
-                )
-            
-            print(f"{'✅' if is_online else '🔴'} Updated device online status for user {self.user.id}: {is_online}")
-            
-        except Exception as e:
-            print(f"❌ Error updating device online status for user {self.user.id}: {e}")
-
-
-
-
-
 
 
 # ---------------------------------------------
 # NotificationConsumer
 # ---------------------------------------------
-class NotificationConsumer(AsyncWebsocketConsumer):
+class NotificationConsumer(BaseJsonConsumer):
+    # Group event types delivered on notifications_<user_id>
+    EVENT_TYPES = (
+        "notification",
+        "new_message_notification",
+        "referral_notification",
+        "chat_notification",
+        "notification_batch",
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Live events at or below this id were already sent by the replay
+        self._replayed_through = None
+
     async def connect(self):
         try:
             self.user_id = self.scope["url_route"]["kwargs"]["user_id"]
@@ -915,10 +900,15 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 await self.close(code=4001)
                 return
 
+            # Join the group before replaying so nothing slips between replay and live
             self.notification_group_name = f"notifications_{self.user_id}"
             await self.channel_layer.group_add(self.notification_group_name, self.channel_name)
             await self.accept()
 
+            last_id = self._get_last_notification_id()
+            if last_id is not None:
+                await self.replay_missed_notifications(last_id)
+
             logger.info(f"User {self.user_id} connected to notifications")
         except Exception as e:
             logger.error(f"Error in notification connect: {str(e)}")
@@ -931,23 +921,107 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             logger.error(f"Error in notification disconnect: {str(e)}")
 
-    async def receive(self, text_data):
+    async def handle_frame(self, data):
+        # No-op for now
+        pass
+
+    # ---------- missed-notification replay ----------
+
+    def _get_last_notification_id(self):
+        """?last_notification_id=N on the handshake (or the multiplex subscribe frame)"""
+        value = self.scope["url_route"]["kwargs"].get("last_notification_id")
+        if value is None:
+            query = parse_qs(self.scope.get("query_string", b"").decode())
+            value = (query.get("last_notification_id") or [None])[0]
         try:
-            _ = json.loads(text_data)
-            # No-op for now
-        except json.JSONDecodeError:
-            logger.error("Invalid JSON received in notifications")
-        except Exception as e:
-            logger.error(f"Error in notification receive: {str(e)}")
+            return int(value) if value is not None else None
+        except (TypeError, ValueError):
+            return None
+
+    async def replay_missed_notifications(self, last_id):
+        """
+        Stream Notification rows newer than last_id in id order, in batches,
+        then switch to live mode. Past NOTIFICATION_REPLAY_MAX rows the replay
+        stops with truncated=True and the client reloads over REST.
+        """
+        batch_size = settings.NOTIFICATION_REPLAY_BATCH_SIZE
+        limit = settings.NOTIFICATION_REPLAY_MAX
+        cursor, sent, truncated = last_id, 0, False
+
+        while True:
+            size = min(batch_size, limit - sent)
+            if size <= 0:
+                # The previous batch said there was more
+                truncated = True
+                break
+
+            rows = await self._load_notifications_after(cursor, size + 1)
+            batch, has_more = rows[:size], len(rows) > size
+            if not batch:
+                break
+
+            cursor = batch[-1]["id"]
+            sent += len(batch)
+            await self.send_json({
+                "type": "notification_replay",
+                "notifications": batch,
+                "has_more": has_more,
+            })
+            if not has_more:
+                break
+
+        self._replayed_through = cursor
+        await self.send_json({
+            "type": "notification_replay_complete",
+            "last_notification_id": cursor,
+            "count": sent,
+            "truncated": truncated,
+            "timestamp": timezone.now().isoformat(),
+        })
+
+    @database_sync_to_async
+    def _load_notifications_after(self, after_id, limit):
+        # Keyset scan on (user_id, id): served by the user FK index, which carries the PK
+        from utils.notify import _serialize_notification, ws_event_type
+
+        Notification = apps.get_model("chat", "Notification")
+        rows = (
+            Notification.objects
+            .filter(user_id=self.user.id, id__gt=after_id)
+            .select_related("actor_user", "referral", "chat_room", "chat_message")
+            .order_by("id")[:limit]
+        )
+        return [
+            {
+                "type": ws_event_type(n.event_type),
+                **_serialize_notification(n, include_chat=n.event_type.startswith("chat."), include_referral=True),
+            }
+            for n in rows
+        ]
+
+    # ---------- live events ----------
+
+    async def _send_live(self, event):
+        if self._replayed_through is not None and (event.get("id") or 0) and event["id"] <= self._replayed_through:
+            return
+        await self.send_json(event)
+
+    async def notification(self, event):
+        await self._send_live(event)
 
     async def new_message_notification(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self._send_live(event)
 
     async def referral_notification(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self._send_live(event)
 
     async def chat_notification(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self._send_live(event)
+
+    async def notification_batch(self, event):
+        """Several notifications for this user in one layer event (utils.notify)"""
+        for item in event.get("notifications", []):
+            await self._send_live({"type": event["event_type"], **item})
 
 
 # ---------------------------------------------
@@ -0,0 +1 @@
+# chat/management/__init__.py
\ No newline at end of file
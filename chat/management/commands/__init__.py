@@ -0,0 +1 @@
+# chat/management/commands/__init__.py
\ No newline at end of file
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.retention import get_policies, run_retention
+
+
+class Command(BaseCommand):
+    help = 'Delete rows past their retention period in throttled primary-key batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('policies', nargs='*', help='Policies to run (default: all)')
+        parser.add_argument('--batch-size', type=int, default=None, help='Rows per delete transaction')
+        parser.add_argument('--max-seconds', type=int, default=None, help='Time budget for the run (0 = unlimited)')
+        parser.add_argument('--dry-run', action='store_true', help='Walk the batches without deleting')
+        parser.add_argument('--list', action='store_true', help='List the available policies')
+
+    def handle(self, *args, **options):
+        if options['list']:
+            for policy in get_policies():
+                self.stdout.write(f"{policy.name:<24} {policy.model}")
+            return
+
+        try:
+            get_policies(options['policies'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        def progress(stats):
+            if stats['batches'] % 10 == 0:
+                self.stdout.write(f"  {stats['policy']}: {stats['deleted']} rows, last pk {stats['last_pk']}")
+
+        results = run_retention(
+            options['policies'],
+            batch_size=options['batch_size'],
+            max_seconds=options['max_seconds'],
+            dry_run=options['dry_run'],
+            progress=progress,
+        )
+
+        verb = "would delete" if options['dry_run'] else "deleted"
+        for stats in results:
+            line = f"{stats['policy']}: {verb} {stats['deleted']} rows in {stats['batches']} batches ({stats['seconds']}s)"
+            if stats['finished']:
+                self.stdout.write(self.style.SUCCESS(line))
+            else:
+                self.stdout.write(self.style.WARNING(f"{line}; time budget reached, rerun to continue"))
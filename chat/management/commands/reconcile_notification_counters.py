@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import NotificationCounter
+
+
+class Command(BaseCommand):
+    help = 'Rebuild per-user notification counters from the Notification table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='user_ids', help='Only this user id (repeatable)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Users per transaction')
+
+    def handle(self, *args, **options):
+        if options['user_ids']:
+            fixed = NotificationCounter.reconcile(options['user_ids'])
+        else:
+            fixed = NotificationCounter.reconcile_all(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Reconciled notification counters: {fixed} rows corrected"))
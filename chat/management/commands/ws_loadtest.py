@@ -0,0 +1,259 @@
+import asyncio
+import json
+import time
+import tracemalloc
+import uuid
+
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from accounts.models import User
+from chat.models import ChatParticipant, ChatRoom
+from chat.outbound import outbound_stats
+from referr.models import Referral
+
+
+class QueryCounter:
+    """execute_wrapper counting every query on every connection it is installed on"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def on_connection_created(self, sender, connection, **kwargs):
+        self.install(connection)
+
+
+class Client:
+    """One load-test socket plus a reader task recording what it receives"""
+
+    def __init__(self, communicator, user_id, room_id=None):
+        self.communicator = communicator
+        self.user_id = user_id
+        self.room_id = room_id
+        self.latencies = []
+        self.frames = 0
+        self.last_message_id = None
+        self.reader = None
+
+    async def read_loop(self):
+        while True:
+            try:
+                text = await self.communicator.receive_from(timeout=3600)
+            except (asyncio.TimeoutError, AssertionError):
+                return
+            self.frames += 1
+            data = json.loads(text)
+            if data.get("type") != "chat_message":
+                continue
+            self.last_message_id = data.get("id")
+            content = data.get("content") or ""
+            if content.startswith("lt:") and data.get("sender", {}).get("id") != self.user_id:
+                self.latencies.append(time.perf_counter() - float(content[3:]))
+
+    async def send(self, data):
+        await self.communicator.send_to(text_data=json.dumps(data))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class Command(BaseCommand):
+    help = 'Drive synthetic chat traffic through the WebSocket consumers and report fan-out costs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=10, help='Chat rooms to create')
+        parser.add_argument('--users', type=int, default=20, help='Solo users to create (rooms are spread over them)')
+        parser.add_argument('--messages', type=int, default=20, help='Messages sent per room')
+        parser.add_argument('--interval', type=float, default=0.5, help='Seconds between messages in a room')
+        parser.add_argument('--typing', type=int, default=3, help='Typing frames sent before each message')
+        parser.add_argument('--no-lists', action='store_true', help='Skip the chat-list and notification sockets')
+        parser.add_argument('--timeout', type=float, default=10.0, help='Seconds to wait for connects and deliveries')
+        parser.add_argument('--keep', action='store_true', help='Keep the generated users, referrals and rooms')
+
+    def handle(self, *args, **options):
+        run_id = uuid.uuid4().hex[:8]
+        self.stdout.write(f"Load test run {run_id}: {options['rooms']} rooms, {options['users']} users")
+
+        try:
+            company, users, rooms = self._create_fixtures(run_id, options)
+            tokens = {u.id: str(AccessToken.for_user(u)) for u in [company, *users]}
+            # The shared company user holds a socket per room; lift the admission caps
+            with override_settings(
+                WS_MAX_CONNECTIONS_PER_USER=len(rooms) + 10,
+                WS_MAX_CONNECTIONS_PER_WORKER=2 * len(rooms) + 2 * len(users) + 10,
+            ):
+                stats = asyncio.run(self._run(company, users, rooms, tokens, options))
+            self._report(stats)
+        finally:
+            if not options['keep']:
+                deleted, _ = User.objects.filter(email__startswith=f"loadtest-{run_id}-").delete()
+                self.stdout.write(f"Cleaned up {deleted} rows")
+
+    # ---------- fixtures ----------
+
+    def _create_fixtures(self, run_id, options):
+        company = User.objects.create_user(
+            email=f"loadtest-{run_id}-company@example.com",
+            full_name="Load Test Company",
+            role="company",
+        )
+        users = [
+            User.objects.create_user(
+                email=f"loadtest-{run_id}-{i}@example.com",
+                full_name=f"Load Test User {i}",
+                role="solo",
+            )
+            for i in range(max(options['users'], 1))
+        ]
+
+        rooms = []
+        for i in range(options['rooms']):
+            solo = users[i % len(users)]
+            referral = Referral.objects.create(referred_by=solo, referred_to=solo, company=company)
+            rooms.append(ChatRoom.objects.create(
+                room_id=f"loadtest-{run_id}-{i}",
+                referral=referral,
+                room_type="company_solo",
+                solo_user=solo,
+                company_user=company,
+            ))
+
+        ChatParticipant.objects.bulk_create([
+            ChatParticipant(chat_room=room, user=user)
+            for room in rooms
+            for user in (room.solo_user, company)
+        ])
+        return company, users, rooms
+
+    # ---------- traffic ----------
+
+    async def _connect(self, application, path, user_id, timeout, room_id=None):
+        communicator = WebsocketCommunicator(application, path)
+        connected, code = await communicator.connect(timeout=timeout)
+        if not connected:
+            raise RuntimeError(f"Connect to {path.split('?')[0]} refused ({code})")
+        client = Client(communicator, user_id, room_id)
+        client.reader = asyncio.create_task(client.read_loop())
+        return client
+
+    async def _drive_room(self, clients, options):
+        sent = 0
+        for i in range(options['messages']):
+            sender = clients[i % len(clients)]
+            reader = clients[(i + 1) % len(clients)]
+            pause = options['interval'] / (options['typing'] + 1)
+
+            for _ in range(options['typing']):
+                await sender.send({"type": "typing", "is_typing": True})
+                await asyncio.sleep(pause)
+
+            await sender.send({"type": "chat_message", "message": f"lt:{time.perf_counter()}"})
+            sent += 1
+            await asyncio.sleep(pause)
+
+            if reader.last_message_id:
+                await reader.send({"type": "mark_read", "last_read_message_id": reader.last_message_id})
+        return sent
+
+    async def _run(self, company, users, rooms, tokens, options):
+        from referralpro.asgi import application
+
+        timeout = options['timeout']
+        counter = QueryCounter()
+        connection_created.connect(counter.on_connection_created)
+        for connection in connections.all():
+            counter.install(connection)
+
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+
+        room_clients = {}
+        other_clients = []
+        for room in rooms:
+            room_clients[room.room_id] = [
+                await self._connect(
+                    application, f"/api/ws/chat/{room.room_id}/?token={tokens[uid]}", uid, timeout, room.room_id
+                )
+                for uid in (room.solo_user_id, company.id)
+            ]
+        if not options['no_lists']:
+            for user in [company, *users]:
+                token = tokens[user.id]
+                other_clients.append(await self._connect(application, f"/api/ws/chat-list/?token={token}", user.id, timeout))
+                other_clients.append(await self._connect(
+                    application, f"/api/ws/notifications/{user.id}/?token={token}", user.id, timeout
+                ))
+
+        all_clients = [c for clients in room_clients.values() for c in clients] + other_clients
+        memory_per_connection = (tracemalloc.get_traced_memory()[0] - memory_before) / max(len(all_clients), 1)
+        tracemalloc.stop()
+
+        # Only count queries caused by the traffic itself
+        counter.count = 0
+        started = time.perf_counter()
+        sent = sum(await asyncio.gather(*(self._drive_room(c, options) for c in room_clients.values())))
+
+        # Every message should reach the other socket(s) in its room
+        expected = sum(options['messages'] * (len(c) - 1) for c in room_clients.values())
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            if sum(len(c.latencies) for c in all_clients) >= expected:
+                break
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - started
+        queries = counter.count
+        connection_created.disconnect(counter.on_connection_created)
+
+        for client in all_clients:
+            client.reader.cancel()
+        for client in all_clients:
+            await client.communicator.disconnect()
+
+        latencies = [lat for c in all_clients for lat in c.latencies]
+        return {
+            "connections": len(all_clients),
+            "messages_sent": sent,
+            "deliveries": len(latencies),
+            "deliveries_expected": expected,
+            "frames_received": sum(c.frames for c in all_clients),
+            "elapsed": elapsed,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "queries": queries,
+            "queries_per_message": queries / max(sent, 1),
+            "memory_per_connection_kb": memory_per_connection / 1024,
+            "outbound": outbound_stats(),
+        }
+
+    # ---------- output ----------
+
+    def _report(self, stats):
+        self.stdout.write(self.style.SUCCESS("Load test results"))
+        self.stdout.write(f"  connections:            {stats['connections']}")
+        self.stdout.write(f"  messages sent:          {stats['messages_sent']} in {stats['elapsed']:.1f}s")
+        self.stdout.write(f"  deliveries:             {stats['deliveries']} / {stats['deliveries_expected']}")
+        self.stdout.write(f"  frames received:        {stats['frames_received']}")
+        self.stdout.write(f"  delivery latency p50:   {stats['p50_ms']:.1f} ms")
+        self.stdout.write(f"  delivery latency p99:   {stats['p99_ms']:.1f} ms")
+        self.stdout.write(f"  DB queries:             {stats['queries']} ({stats['queries_per_message']:.1f} per message)")
+        self.stdout.write(f"  memory per connection:  {stats['memory_per_connection_kb']:.1f} KB")
+        self.stdout.write(f"  outbound queues:        {stats['outbound']}")
+
+        if stats['deliveries'] < stats['deliveries_expected']:
+            self.stdout.write(self.style.WARNING("  some messages were not delivered before the timeout"))
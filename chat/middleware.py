@@ -1,16 +1,43 @@
 # chat/middleware.py
+import hashlib
+import time
 from urllib.parse import parse_qs
+
+import jwt
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework_simplejwt.tokens import AccessToken
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
 
+
+def token_cache_key(jti):
+    return f"ws_auth:jti:{jti}"
+
+
+def user_cache_key(user_id):
+    return f"ws_auth:user:{user_id}"
+
+
+def invalidate_user_snapshot(user_id):
+    """Drop the cached user so the next handshake reloads it (profile/role change)."""
+    cache.delete(user_cache_key(user_id))
+
+
 class TokenAuthMiddleware:
     """
     Custom token auth middleware for Django Channels
     Supports token passed in query string ?token=xxx OR in headers
+
+    Repeat handshakes are served from the cache:
+    - verified tokens are cached by JTI until the token's own expiry
+    - user rows are cached as short-lived snapshots (WS_AUTH_USER_CACHE_SECONDS),
+      invalidated whenever the user is saved
     """
 
     def __init__(self, inner):
@@ -30,9 +57,7 @@ class TokenAuthMiddlewareInstance:
         # Call the inner middleware with the full ASGI signature
         return await self.inner(self.scope, receive, send)
 
-    @database_sync_to_async
-    def get_user(self, scope):
-        # Try to extract token
+    def get_token(self, scope):
         headers = dict(scope.get("headers", []))
         query_string = parse_qs(scope.get("query_string", b"").decode())
 
@@ -43,13 +68,54 @@ class TokenAuthMiddlewareInstance:
                 token = auth_header.split(" ")[1]
         elif "token" in query_string:
             token = query_string["token"][0]
+        return token
 
+    async def get_user(self, scope):
+        token = self.get_token(scope)
         if not token:
             return AnonymousUser()
 
+        user_id = await self.verify_token(token)
+        if user_id is None:
+            return AnonymousUser()
+
+        user = await cache.aget(user_cache_key(user_id))
+        if user is None:
+            user = await self.load_user(user_id)
+            if user is None:
+                return AnonymousUser()
+            await cache.aset(user_cache_key(user_id), user, settings.WS_AUTH_USER_CACHE_SECONDS)
+
+        if not user.is_active:
+            return AnonymousUser()
+        return user
+
+    async def verify_token(self, token):
+        """User id for a valid access token; verification is cached per JTI."""
+        try:
+            claims = jwt.decode(token, options={"verify_signature": False})
+        except jwt.PyJWTError:
+            return None
+
+        jti = claims.get(api_settings.JTI_CLAIM)
+        digest = hashlib.sha256(token.encode()).hexdigest()
+        if jti and claims.get("exp", 0) > time.time():
+            cached = await cache.aget(token_cache_key(jti))
+            # The digest ties the entry to this exact (signed) token
+            if cached and cached["digest"] == digest:
+                return cached["user_id"]
+
         try:
             access_token = AccessToken(token)
-            user = User.objects.get(id=access_token["user_id"])
-            return user
-        except Exception:
-            return AnonymousUser()
+        except TokenError:
+            return None
+
+        user_id = access_token.get(api_settings.USER_ID_CLAIM)
+        ttl = int(access_token["exp"] - time.time())
+        if jti and user_id is not None and ttl > 0:
+            await cache.aset(token_cache_key(jti), {"user_id": user_id, "digest": digest}, ttl)
+        return user_id
+
+    @database_sync_to_async
+    def load_user(self, user_id):
+        return User.objects.filter(id=user_id).first()
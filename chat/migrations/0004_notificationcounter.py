@@ -0,0 +1,56 @@
+# Generated by Django 5.2.5 on 2026-10-19 14:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def backfill_counters(apps, schema_editor):
+    Notification = apps.get_model('chat', 'Notification')
+    NotificationCounter = apps.get_model('chat', 'NotificationCounter')
+
+    counts = {}
+    aggregates = (
+        Notification.objects.values('user_id', 'event_type')
+        .annotate(total=Count('id'), unread=Count('id', filter=Q(is_read=False)))
+        .order_by()
+    )
+    for row in aggregates:
+        for key in ((row['user_id'], row['event_type']), (row['user_id'], '')):
+            total, unread = counts.get(key, (0, 0))
+            counts[key] = (total + row['total'], unread + row['unread'])
+
+    NotificationCounter.objects.bulk_create(
+        [
+            NotificationCounter(user_id=user_id, event_type=event_type, total=total, unread=unread)
+            for (user_id, event_type), (total, unread) in counts.items()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_message_seq'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_type', models.CharField(blank=True, default='', max_length=50)),
+                ('total', models.IntegerField(default=0)),
+                ('unread', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notification_counters', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'event_type'), name='chat_notification_counter_uniq')],
+            },
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
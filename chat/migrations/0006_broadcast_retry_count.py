@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-19 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_broadcast'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='broadcast',
+            name='retry_count',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
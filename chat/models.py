@@ -1,7 +1,11 @@
-from django.db import models
+from collections import Counter
+
+from django.db import models, transaction
+from django.db.models import Count, F, Q
 from django.utils import timezone
 from accounts.models import User
 from referr.models import Referral
+from utils.ids import SnowflakeIdMixin, SnowflakeManager, SnowflakeQuerySet
 
 
 class ChatRoom(models.Model):
@@ -48,6 +52,9 @@ class ChatRoom(models.Model):
     
     # Last activity tracking
     last_message_at = models.DateTimeField(null=True, blank=True)
+
+    # Sequence number of the newest message in the room
+    last_seq = models.PositiveBigIntegerField(default=0)
     
     class Meta:
         unique_together = ['referral', 'solo_user', 'company_user']
@@ -136,28 +143,66 @@ class ChatRoom(models.Model):
             "sender_id": last_message.sender.id
         }
     
+    def get_read_watermarks(self):
+        """Map of user_id -> last_read_message_id (uses prefetched participants when present)"""
+        return {
+            p.user_id: p.last_read_message_id
+            for p in self.participants.all()
+            if p.last_read_message_id
+        }
+
     def get_unread_count(self, user):
         """Get count of unread messages for a specific user"""
         from django.db.models import Count, Q
         
         # Count messages that don't have a read status for this user
-        unread_count = self.messages.exclude(
+        unread = self.messages.exclude(
             read_statuses__user=user
         ).exclude(
             sender=user  # Don't count user's own messages as unread
-        ).count()
+        )
+
+        # Everything up to the user's read watermark counts as read
+        watermark = self.get_read_watermarks().get(user.id)
+        if watermark:
+            unread = unread.filter(id__gt=watermark)
         
-        return unread_count
+        return unread.count()
     
     def is_any_participant_online(self, exclude_user=None):
         """Check if any participant (except excluded user) is online"""
-        participants = self.participants.filter(is_online=True)
-        
-        if exclude_user:
-            participants = participants.exclude(user=exclude_user)
-        
-        return participants.exists()
+        from chat.presence import presence
+
+        exclude_id = getattr(exclude_user, "id", exclude_user)
+        user_ids = [self.solo_user_id, self.company_user_id, self.rep_user_id]
+        return presence.any_online([uid for uid in user_ids if uid != exclude_id])
     
+    @classmethod
+    def allocate_seq(cls, room_pk):
+        """
+        Next per-room message sequence number. The UPDATE row-locks the room
+        until the surrounding transaction commits, so numbers are gap-free
+        and monotonic per room.
+        """
+        cls.objects.filter(pk=room_pk).update(last_seq=F("last_seq") + 1)
+        return cls.objects.filter(pk=room_pk).values_list("last_seq", flat=True).get()
+
+    def broadcast_state_change(self):
+        """Tell connected chat consumers to reload their cached room/permission state"""
+        try:
+            from asgiref.sync import async_to_sync
+            from channels.layers import get_channel_layer
+
+            channel_layer = get_channel_layer()
+            if not channel_layer:
+                return
+            async_to_sync(channel_layer.group_send)(
+                f"chat_{self.room_id}",
+                {"type": "room_state_changed", "room_id": self.room_id}
+            )
+        except Exception as e:
+            print(f"Error broadcasting room state change: {e}")
+
     @classmethod
     def create_room_for_referral(cls, referral, solo_user, assigned_rep=None):
         company_user = referral.company
@@ -237,9 +282,15 @@ class Message(models.Model):
     
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
+
+    # Monotonic per-room sequence number, assigned at insert (resume/replay)
+    seq = models.PositiveBigIntegerField(null=True, blank=True)
     
     class Meta:
         ordering = ['created_at']
+        constraints = [
+            models.UniqueConstraint(fields=['chat_room', 'seq'], name='chat_message_room_seq_uniq'),
+        ]
         indexes = [
             models.Index(fields=['chat_room', '-created_at']),
             models.Index(fields=['sender', '-created_at']),
@@ -254,19 +305,25 @@ class Message(models.Model):
     
     def save(self, *args, **kwargs):
         """Update chat room's last message timestamp and broadcast updates"""
-        super().save(*args, **kwargs)
+        created = self._state.adding
+        with transaction.atomic():
+            if created and self.seq is None:
+                self.seq = ChatRoom.allocate_seq(self.chat_room_id)
+            super().save(*args, **kwargs)
+        self.chat_room.last_seq = max(self.chat_room.last_seq, self.seq or 0)
         self.chat_room.last_message_at = self.created_at
         self.chat_room.save(update_fields=['last_message_at', 'updated_at'])
         
         # Send real-time updates to WebSocket consumers
-        self._send_realtime_updates()
+        if not getattr(self, "defer_realtime_updates", False):
+            self._send_realtime_updates(created=created)
     
-    def _send_realtime_updates(self):
+    def _send_realtime_updates(self, created=False):
         """Send real-time updates to chat and chat-list consumers"""
         try:
             from asgiref.sync import async_to_sync
             from channels.layers import get_channel_layer
-            from .serializers import MessageSerializer, ChatRoomListSerializer
+            from .serializers import MessageSerializer, ChatRoomListSerializer, serialize_message_payload
             
             channel_layer = get_channel_layer()
             if not channel_layer:
@@ -283,29 +340,22 @@ class Message(models.Model):
                         return f"http://localhost{location}"
                     return "http://localhost/"
             
-            # Send message to chat room (without request context to avoid serializer issues)
-            message_data = {
-                "id": self.id,
-                "content": self.content,
-                "sender_id": self.sender.id,
-                "sender_name": getattr(self.sender, 'full_name', str(self.sender)),
-                "sender_role": getattr(self.sender, 'role', ''),
-                "message_type": self.message_type,
-                "timestamp": self.created_at.isoformat(),
-                "file_url": self.get_file_url(),  # Use the method to get presigned URL
-                "file_name": self.file_name,
-                "file_size": self.file_size,
-                "file_type": self.file_type,
-                "duration": self.duration,
-                "thumbnail_url": self.thumbnail_url,
-                "dimensions": self.dimensions,
-            }
-            
+            # Serialize once; each chat consumer only adds its viewer-specific flags
+            participant_ids = [self.chat_room.solo_user_id, self.chat_room.company_user_id, self.chat_room.rep_user_id]
+            payload = serialize_message_payload(
+                self,
+                [uid for uid in participant_ids if uid],
+                read_user_ids=() if created else None,
+            )
+
             async_to_sync(channel_layer.group_send)(
                 f"chat_{self.chat_room.room_id}",
                 {
                     "type": "chat_message",
-                    "message": message_data
+                    "room_id": self.chat_room.room_id,
+                    "message_id": self.id,
+                    "seq": self.seq,
+                    "payload": payload,
                 }
             )
             
@@ -313,7 +363,6 @@ class Message(models.Model):
             participants = self.chat_room.get_participants()
             for participant in participants:
                 # Get updated chat rooms for this participant
-                from django.db.models import Q, Count
                 if participant.role == 'solo':
                     chat_rooms = ChatRoom.objects.filter(solo_user=participant)
                 elif participant.role in ['rep', 'employee']:
@@ -326,12 +375,7 @@ class Message(models.Model):
                 else:
                     continue
                 
-                chat_rooms = chat_rooms.annotate(
-                    unread_count=Count(
-                        'messages', 
-                        filter=~Q(messages__sender=participant) & ~Q(messages__read_statuses__user=participant)
-                    )
-                ).select_related(
+                chat_rooms = chat_rooms.select_related(
                     'solo_user', 'rep_user', 'company_user', 'referral'
                 ).prefetch_related(
                     'messages'
@@ -457,10 +501,12 @@ class MessageAttachment(models.Model):
             size /= 1024.0
 
 
-class MessageReadStatus(models.Model):
+class MessageReadStatus(SnowflakeIdMixin, models.Model):
     """
     Track read status of messages for each user
     """
+    objects = SnowflakeManager()
+
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='read_statuses')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='message_reads')
     read_at = models.DateTimeField(auto_now_add=True)
@@ -494,6 +540,9 @@ class ChatParticipant(models.Model):
     joined_at = models.DateTimeField(auto_now_add=True)
     last_seen_at = models.DateTimeField(default=timezone.now)
     is_online = models.BooleanField(default=False)
+
+    # Read receipts: every message in the room with id <= this is read
+    last_read_message_id = models.BigIntegerField(null=True, blank=True)
     
     class Meta:
         unique_together = ['chat_room', 'user']
@@ -502,11 +551,52 @@ class ChatParticipant(models.Model):
     def __str__(self):
         return f"{self.user.full_name} in {self.chat_room.room_id} ({self.role})"
 
+    @classmethod
+    def advance_read_watermark(cls, chat_room, user, message_id):
+        """
+        Move the user's read watermark forward to message_id with a single
+        monotonic UPDATE. The watermark only moves if message_id belongs to
+        the room and is ahead of the stored value.
+        Returns True if the watermark moved.
+        """
+        from django.db.models import Exists, Q
+
+        in_room = Message.objects.filter(chat_room=chat_room, id=message_id)
+        updated = cls.objects.filter(
+            Q(last_read_message_id__isnull=True) | Q(last_read_message_id__lt=message_id),
+            Exists(in_room),
+            chat_room=chat_room,
+            user=user,
+        ).update(last_read_message_id=message_id, last_seen_at=timezone.now())
+        if updated:
+            return True
+
+        # Rooms created before participant rows existed: create the row lazily
+        if in_room.exists():
+            _, created = cls.objects.get_or_create(
+                chat_room=chat_room,
+                user=user,
+                defaults={"last_read_message_id": message_id},
+            )
+            return created
+        return False
+
+
+class NotificationQuerySet(SnowflakeQuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        # Counters move in the same transaction as the rows
+        with transaction.atomic(using=self.db):
+            created = super().bulk_create(objs, *args, **kwargs)
+            NotificationCounter.record_created(created)
+        return created
 
-class Notification(models.Model):
+
+class Notification(SnowflakeIdMixin, models.Model):
     """
     Store notification records for users
     """
+    objects = models.Manager.from_queryset(NotificationQuerySet)()
+
     NOTIFICATION_TYPES = [
         ('referral.sent', 'Referral Sent'),
         ('referral.accepted', 'Referral Accepted'),
@@ -558,13 +648,58 @@ class Notification(models.Model):
     
     def __str__(self):
         return f"{self.event_type} for {self.user.full_name}: {self.title}"
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            NotificationCounter.record_created([self])
     
     def mark_as_read(self):
         """Mark notification as read"""
         if not self.is_read:
+            now = timezone.now()
+            with transaction.atomic():
+                NotificationCounter.lock_user(self.user_id)
+                # Conditional UPDATE so a concurrent mark can't decrement twice
+                updated = Notification.objects.filter(pk=self.pk, is_read=False).update(
+                    is_read=True, read_at=now, updated_at=now
+                )
+                if updated:
+                    NotificationCounter.record_read(self.user_id, {self.event_type: 1})
             self.is_read = True
-            self.read_at = timezone.now()
-            self.save(update_fields=['is_read', 'read_at', 'updated_at'])
+            self.read_at = now
+
+    @classmethod
+    def mark_read_for_user(cls, user, ids=None):
+        """
+        Mark the user's unread notifications (all, or just `ids`) as read and
+        move the counters in the same transaction.
+        Returns the number marked and, for an explicit id list, the ids.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            NotificationCounter.lock_user(user.id)
+
+            if ids is None:
+                updated = cls.objects.filter(user=user, is_read=False).update(
+                    is_read=True, read_at=now, updated_at=now
+                )
+                NotificationCounter.objects.filter(user=user).update(unread=0, updated_at=now)
+                return updated, None
+
+            rows = list(
+                cls.objects.select_for_update()
+                .filter(user=user, is_read=False, id__in=ids)
+                .values_list("id", "event_type")
+            )
+            if not rows:
+                return 0, []
+            marked_ids = [notification_id for notification_id, _ in rows]
+            cls.objects.filter(id__in=marked_ids).update(is_read=True, read_at=now, updated_at=now)
+            NotificationCounter.record_read(user.id, Counter(event_type for _, event_type in rows))
+            return len(marked_ids), marked_ids
     
     def mark_as_delivered(self):
         """Mark notification as delivered (for push notifications)"""
@@ -592,3 +727,230 @@ class Notification(models.Model):
             message=message,
             **kwargs
         )
+
+
+class Broadcast(models.Model):
+    """
+    One announcement to a large audience (system.update by default),
+    delivered in chunks by utils.broadcast. last_user_id is the resume
+    cursor: every user up to it already has their Notification row. A failed
+    broadcast is resumed automatically up to BROADCAST_MAX_RETRIES times.
+    """
+    AUDIENCES = [
+        ('all', 'All users'),
+        ('solo', 'Solo users'),
+        ('company', 'Companies'),
+        ('rep', 'Company reps'),
+    ]
+    STATUSES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('cancelled', 'Cancelled'),
+        ('failed', 'Failed'),
+    ]
+
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='broadcasts')
+    event_type = models.CharField(max_length=50, default='system.update')
+    title = models.CharField(max_length=200)
+    message = models.TextField()
+    meta_data = models.JSONField(default=dict, blank=True)
+    audience = models.CharField(max_length=20, choices=AUDIENCES, default='all')
+    send_push = models.BooleanField(default=True)
+
+    # Progress
+    status = models.CharField(max_length=20, choices=STATUSES, default='pending')
+    last_user_id = models.BigIntegerField(default=0)
+    total_recipients = models.PositiveIntegerField(default=0)
+    delivered_count = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    retry_count = models.PositiveSmallIntegerField(default=0)  # automatic resumes after a failure
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'updated_at'], name='chat_broadcast_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"Broadcast {self.id} to {self.audience}: {self.title} ({self.status})"
+
+    @property
+    def progress(self):
+        if not self.total_recipients:
+            return 100.0 if self.status == 'completed' else 0.0
+        return round(min(self.delivered_count / self.total_recipients, 1.0) * 100, 1)
+
+
+class NotificationCounter(models.Model):
+    """
+    Materialized per-user notification counts so badges and stats are row
+    reads instead of COUNT(*) over the user's history.
+
+    One row per (user, event_type) plus an event_type="" row with the user's
+    overall totals. Rows move with Notification inserts/reads in the same
+    transaction; reconcile() rebuilds them from Notification to fix drift
+    (cascade deletes, raw SQL).
+    """
+    ALL = ""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notification_counters')
+    event_type = models.CharField(max_length=50, blank=True, default="")
+    total = models.IntegerField(default=0)
+    unread = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'event_type'], name='chat_notification_counter_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}:{self.event_type or '*'} total={self.total} unread={self.unread}"
+
+    # ---------- writes ----------
+
+    @classmethod
+    def lock_user(cls, user_id):
+        """Lock the user's counter rows; read paths take this before touching Notification"""
+        list(cls.objects.select_for_update().filter(user_id=user_id).values_list("id", flat=True))
+
+    @classmethod
+    def apply(cls, deltas):
+        """
+        deltas: {(user_id, event_type): (total_delta, unread_delta)}; each is
+        also rolled into the user's "" row. Rows with the same delta are
+        updated in one statement, so a fan-out to N users is one UPDATE.
+        """
+        rolled = {}
+        for (user_id, event_type), (total_delta, unread_delta) in deltas.items():
+            for key in ((user_id, event_type), (user_id, cls.ALL)):
+                total, unread = rolled.get(key, (0, 0))
+                rolled[key] = (total + total_delta, unread + unread_delta)
+        rolled = {key: delta for key, delta in rolled.items() if delta != (0, 0)}
+        if not rolled:
+            return
+
+        cls.objects.bulk_create(
+            [cls(user_id=user_id, event_type=event_type) for user_id, event_type in rolled],
+            ignore_conflicts=True,
+        )
+
+        by_delta = {}
+        for (user_id, event_type), delta in rolled.items():
+            by_delta.setdefault(delta, {}).setdefault(event_type, []).append(user_id)
+
+        now = timezone.now()
+        for (total_delta, unread_delta), by_type in by_delta.items():
+            match = Q()
+            for event_type, user_ids in by_type.items():
+                match |= Q(event_type=event_type, user_id__in=user_ids)
+            cls.objects.filter(match).update(
+                total=F('total') + total_delta,
+                unread=F('unread') + unread_delta,
+                updated_at=now,
+            )
+
+    @classmethod
+    def record_created(cls, notifications):
+        deltas = {}
+        for n in notifications:
+            key = (n.user_id, n.event_type)
+            total, unread = deltas.get(key, (0, 0))
+            deltas[key] = (total + 1, unread + (0 if n.is_read else 1))
+        cls.apply(deltas)
+
+    @classmethod
+    def record_read(cls, user_id, counts_by_type):
+        cls.apply({(user_id, event_type): (0, -count) for event_type, count in counts_by_type.items()})
+
+    @classmethod
+    def record_deleted(cls, rows):
+        """rows: iterable of (user_id, event_type, is_read) for deleted notifications"""
+        deltas = {}
+        for user_id, event_type, is_read in rows:
+            key = (user_id, event_type)
+            total, unread = deltas.get(key, (0, 0))
+            deltas[key] = (total - 1, unread - (0 if is_read else 1))
+        cls.apply(deltas)
+
+    # ---------- reads ----------
+
+    @classmethod
+    def counts_for(cls, user, event_type=None):
+        """
+        ((total, unread) overall, (total, unread) for event_type or None),
+        from at most two rows in one query.
+        """
+        wanted = [cls.ALL] + ([event_type] if event_type else [])
+        rows = {
+            row_type: (total, unread)
+            for row_type, total, unread in cls.objects.filter(user=user, event_type__in=wanted)
+            .values_list("event_type", "total", "unread")
+        }
+        overall = rows.get(cls.ALL, (0, 0))
+        return overall, (rows.get(event_type, (0, 0)) if event_type else None)
+
+    # ---------- reconciliation ----------
+
+    @classmethod
+    def reconcile(cls, user_ids):
+        """
+        Rebuild the counters for user_ids from Notification. Returns the
+        number of counter rows that were wrong (created, fixed or removed).
+        """
+        user_ids = list(user_ids)
+        fixed = 0
+        with transaction.atomic():
+            existing = {
+                (c.user_id, c.event_type): c
+                for c in cls.objects.select_for_update().filter(user_id__in=user_ids)
+            }
+
+            actual = {}
+            aggregates = (
+                Notification.objects.filter(user_id__in=user_ids)
+                .values("user_id", "event_type")
+                .annotate(total=Count("id"), unread=Count("id", filter=Q(is_read=False)))
+                .order_by()
+            )
+            for row in aggregates:
+                for key in ((row["user_id"], row["event_type"]), (row["user_id"], cls.ALL)):
+                    total, unread = actual.get(key, (0, 0))
+                    actual[key] = (total + row["total"], unread + row["unread"])
+
+            stale = [c.id for key, c in existing.items() if key not in actual]
+            if stale:
+                cls.objects.filter(id__in=stale).delete()
+                fixed += len(stale)
+
+            missing = []
+            for key, (total, unread) in actual.items():
+                counter = existing.get(key)
+                if counter is None:
+                    missing.append(cls(user_id=key[0], event_type=key[1], total=total, unread=unread))
+                elif (counter.total, counter.unread) != (total, unread):
+                    cls.objects.filter(id=counter.id).update(total=total, unread=unread, updated_at=timezone.now())
+                    fixed += 1
+            cls.objects.bulk_create(missing)
+            fixed += len(missing)
+        return fixed
+
+    @classmethod
+    def reconcile_all(cls, batch_size=500):
+        """reconcile() every user, batch_size users per transaction"""
+        fixed = 0
+        last_id = 0
+        while True:
+            user_ids = list(
+                User.objects.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:batch_size]
+            )
+            if not user_ids:
+                return fixed
+            fixed += cls.reconcile(user_ids)
+            last_id = user_ids[-1]
@@ -0,0 +1,218 @@
+import logging
+import re
+
+from channels.consumer import get_handler_name
+from django.conf import settings
+from django.utils import timezone
+
+from chat.consumers import BaseJsonConsumer, ChatConsumer, ChatListConsumer, NotificationConsumer
+from chat.presence import presence
+
+logger = logging.getLogger(__name__)
+
+ROOM_TOPIC_RE = re.compile(r"^room:(?P<room_id>[\w-]+)$")
+
+
+class TopicDelegateMixin:
+    """
+    Runs an existing consumer as one topic of a MultiplexConsumer.
+
+    The delegate shares the parent's channel name (so its group_add calls
+    subscribe the parent socket), never owns the WebSocket itself, and tags
+    every outgoing frame with its topic.
+    """
+
+    def bind(self, parent, topic, url_kwargs):
+        self.parent = parent
+        self.topic = topic
+        self.scope = {**parent.scope, "url_route": {"args": (), "kwargs": url_kwargs}}
+        self.channel_layer = parent.channel_layer
+        self.channel_name = parent.channel_name
+        self.accepted = False
+        self.closed = False
+        self.close_code = None
+
+    async def accept(self, subprotocol=None, headers=None):
+        self.accepted = True
+
+    async def close(self, code=None, reason=None):
+        self.closed = True
+        self.close_code = code
+        await self.parent.topic_closed(self, code)
+
+    async def send_json(self, data):
+        await self.parent.send_json({**data, "topic": self.topic})
+
+    # The parent socket owns presence for the user
+    def presence_join(self):
+        pass
+
+    def presence_leave(self):
+        pass
+
+
+def _delegate_class(consumer_class):
+    return type(f"Multiplexed{consumer_class.__name__}", (TopicDelegateMixin, consumer_class), {})
+
+
+class MultiplexConsumer(BaseJsonConsumer):
+    """
+    One WebSocket per user carrying any number of topics:
+      - "room:<room_id>"  -> ChatConsumer
+      - "chat_list"       -> ChatListConsumer
+      - "notifications"   -> NotificationConsumer
+
+    Client frames:
+      {"type": "subscribe", "topic": "room:abc"}
+      {"type": "subscribe", "topic": "notifications", "last_notification_id": 123}
+      {"type": "unsubscribe", "topic": "room:abc"}
+      {"topic": "room:abc", "type": "chat_message", ...}   # forwarded to the topic
+      {"type": "heartbeat"}
+
+    Every server frame for a topic carries a "topic" field.
+    """
+
+    DELEGATES = {
+        "chat_list": _delegate_class(ChatListConsumer),
+        "notifications": _delegate_class(NotificationConsumer),
+        "room": _delegate_class(ChatConsumer),
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.topics = {}  # topic -> delegate consumer
+        self._presence_joined = False
+
+    # ---------- socket lifecycle ----------
+
+    async def connect(self):
+        self.user = self.scope.get("user")
+        if not self.user or self.user.is_anonymous:
+            await self.close(code=4001)
+            return
+
+        await self.accept()
+        self.presence_join()
+        self._presence_joined = True
+        logger.info(f"User {self.user.id} opened a multiplexed socket")
+
+    async def disconnect(self, close_code):
+        for topic in list(self.topics):
+            await self._drop_topic(topic, close_code)
+        if self._presence_joined:
+            self.presence_leave()
+            self._presence_joined = False
+
+    # ---------- inbound frames ----------
+
+    async def handle_frame(self, data):
+        presence.touch(self.user.id)
+
+        frame_type = data.get("type")
+        topic = data.get("topic")
+
+        if frame_type == "heartbeat":
+            return
+        if frame_type == "subscribe":
+            await self.subscribe(topic, data)
+        elif frame_type == "unsubscribe":
+            await self.unsubscribe(topic)
+        elif topic in self.topics:
+            await self.topics[topic].handle_frame(data)
+        else:
+            await self.send_json({"type": "error", "topic": topic, "message": "Not subscribed to topic"})
+
+    async def subscribe(self, topic, data=None):
+        if topic in self.topics:
+            await self.send_json({"type": "subscribed", "topic": topic})
+            return
+
+        if len(self.topics) >= settings.MULTIPLEX_MAX_TOPICS:
+            await self.send_json({"type": "error", "topic": topic, "message": "Too many subscriptions"})
+            return
+
+        delegate = self._build_delegate(topic, data or {})
+        if delegate is None:
+            await self.send_json({"type": "error", "topic": topic, "message": "Unknown topic"})
+            return
+
+        await delegate.connect()
+        if not delegate.accepted or delegate.closed:
+            await self.send_json({
+                "type": "subscribe_failed",
+                "topic": topic,
+                "code": delegate.close_code,
+            })
+            return
+
+        self.topics[topic] = delegate
+        await self.send_json({"type": "subscribed", "topic": topic})
+
+    async def unsubscribe(self, topic):
+        if topic in self.topics:
+            await self._drop_topic(topic, 1000)
+        await self.send_json({"type": "unsubscribed", "topic": topic})
+
+    def _build_delegate(self, topic, data):
+        if topic == "chat_list":
+            cls, kwargs = self.DELEGATES["chat_list"], {}
+        elif topic == "notifications":
+            cls, kwargs = self.DELEGATES["notifications"], {"user_id": str(self.user.id)}
+            if data.get("last_notification_id") is not None:
+                kwargs["last_notification_id"] = data["last_notification_id"]
+        else:
+            match = ROOM_TOPIC_RE.match(topic or "")
+            if not match:
+                return None
+            cls, kwargs = self.DELEGATES["room"], {"room_id": match.group("room_id")}
+
+        delegate = cls()
+        delegate.bind(self, topic, kwargs)
+        return delegate
+
+    async def _drop_topic(self, topic, code):
+        delegate = self.topics.pop(topic, None)
+        if delegate is None:
+            return
+        try:
+            await delegate.disconnect(code)
+        except Exception as e:
+            logger.error(f"Error closing topic {topic}: {str(e)}")
+
+    async def topic_closed(self, delegate, code):
+        """A delegate closed itself (e.g. lost room access); drop just that topic"""
+        if self.topics.get(delegate.topic) is not delegate:
+            return
+        await self._drop_topic(delegate.topic, code)
+        await self.send_json({
+            "type": "unsubscribed",
+            "topic": delegate.topic,
+            "code": code,
+            "timestamp": timezone.now().isoformat(),
+        })
+
+    # ---------- group events -> topic ----------
+
+    def _topic_for_event(self, event):
+        event_type = event["type"]
+        if event_type == "chat_list_update":
+            return "chat_list"
+        if event_type in NotificationConsumer.EVENT_TYPES:
+            return "notifications"
+        if event.get("room_id"):
+            return f"room:{event['room_id']}"
+        return None
+
+    async def dispatch(self, message):
+        if message["type"].startswith("websocket."):
+            await super().dispatch(message)
+            return
+
+        delegate = self.topics.get(self._topic_for_event(message))
+        if delegate is None:
+            return
+        handler = getattr(delegate, get_handler_name(message), None)
+        if handler is None:
+            logger.warning(f"No handler for {message['type']} on topic {delegate.topic}")
+            return
+        await handler(message)
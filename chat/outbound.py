@@ -0,0 +1,205 @@
+import asyncio
+import logging
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Close code used when a client falls past the hard outbound limit
+CLOSE_SLOW_CONSUMER = 4008
+# Close code used when writing to the socket failed
+CLOSE_WRITE_FAILED = 1011
+
+# Worker-wide counters; see outbound_stats()
+_metrics = {
+    "connections": 0,
+    "queued_frames": 0,
+    "queued_bytes": 0,
+    "max_queue_frames": 0,
+    "sent": 0,
+    "dropped": 0,
+    "coalesced": 0,
+    "disconnected": 0,
+}
+
+
+def outbound_stats():
+    """Snapshot of this worker's outbound queue metrics."""
+    return dict(_metrics)
+
+
+def _setting_types(name, default):
+    value = getattr(settings, name, default)
+    if isinstance(value, str):
+        value = [v.strip() for v in value.split(",") if v.strip()]
+    return frozenset(value)
+
+
+class _Frame:
+    __slots__ = ("frame_type", "data", "text_data", "bytes_data", "size")
+
+    def __init__(self, frame_type, data, text_data, bytes_data):
+        self.frame_type = frame_type
+        self.data = data
+        self.text_data = text_data
+        self.bytes_data = bytes_data
+        self.size = len(text_data if text_data is not None else bytes_data)
+
+
+class OutboundQueue:
+    """
+    Bounded per-connection send queue drained by a writer task, so a slow
+    client never blocks the consumer's event handling.
+
+    Policy (all limits from settings):
+    - coalesce: a queued, unsent frame of a WS_OUTBOUND_COALESCE_TYPES type is
+      merged with the new one (chat_list_update rooms are merged by room_id)
+    - soft limit: past WS_OUTBOUND_SOFT_MAX_MESSAGES / _BYTES, frames of
+      WS_OUTBOUND_DROP_TYPES (typing, presence) are dropped, queued ones too
+    - hard limit: past WS_OUTBOUND_HARD_MAX_MESSAGES / _BYTES the queue
+      refuses the frame and the consumer disconnects the client
+    """
+
+    def __init__(self, codec, send, on_failure=None):
+        self.codec = codec
+        self._send = send
+        # Coroutine function called once if the writer dies, so the owner can close the socket
+        self._on_failure = on_failure
+        self._frames = deque()
+        self._bytes = 0
+        self._ready = asyncio.Event()
+        self._task = None
+        self._closed = False
+        self._over_soft = False
+        _metrics["connections"] += 1
+
+        self.drop_types = _setting_types("WS_OUTBOUND_DROP_TYPES", ())
+        self.coalesce_types = _setting_types("WS_OUTBOUND_COALESCE_TYPES", ())
+
+    def __len__(self):
+        return len(self._frames)
+
+    # ---------- producer side ----------
+
+    def put(self, data):
+        """Queue a frame. Returns False if the hard limit was hit."""
+        if self._closed:
+            return True
+
+        frame_type = data.get("type")
+        if frame_type in self.coalesce_types and self._coalesce(frame_type, data):
+            return True
+
+        if self._is_over_soft() and frame_type in self.drop_types:
+            _metrics["dropped"] += 1
+            return True
+
+        text_data, bytes_data = self.codec.encode(data)
+        self._append(_Frame(frame_type, data, text_data, bytes_data))
+
+        if self._is_over_soft():
+            self._shed_droppable()
+        if (len(self._frames) > settings.WS_OUTBOUND_HARD_MAX_MESSAGES
+                or self._bytes > settings.WS_OUTBOUND_HARD_MAX_BYTES):
+            _metrics["disconnected"] += 1
+            logger.warning(
+                f"Outbound queue over hard limit ({len(self._frames)} frames, {self._bytes} bytes); disconnecting"
+            )
+            self.close()
+            return False
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._writer())
+        self._ready.set()
+        return True
+
+    def _append(self, frame):
+        self._frames.append(frame)
+        self._bytes += frame.size
+        _metrics["queued_frames"] += 1
+        _metrics["queued_bytes"] += frame.size
+        _metrics["max_queue_frames"] = max(_metrics["max_queue_frames"], len(self._frames))
+
+    def _remove(self, frame):
+        self._bytes -= frame.size
+        _metrics["queued_frames"] -= 1
+        _metrics["queued_bytes"] -= frame.size
+
+    def _is_over_soft(self):
+        over = (len(self._frames) >= settings.WS_OUTBOUND_SOFT_MAX_MESSAGES
+                or self._bytes >= settings.WS_OUTBOUND_SOFT_MAX_BYTES)
+        if over and not self._over_soft:
+            logger.info(f"Outbound queue over soft limit ({len(self._frames)} frames, {self._bytes} bytes)")
+        self._over_soft = over
+        return over
+
+    def _shed_droppable(self):
+        kept = deque()
+        for frame in self._frames:
+            if frame.frame_type in self.drop_types:
+                self._remove(frame)
+                _metrics["dropped"] += 1
+            else:
+                kept.append(frame)
+        self._frames = kept
+
+    def _coalesce(self, frame_type, data):
+        """Merge into a queued frame of the same type; True if merged."""
+        for frame in self._frames:
+            if frame.frame_type != frame_type:
+                continue
+
+            merged = {**frame.data, **data}
+            if "chat_rooms" in frame.data and "chat_rooms" in data:
+                rooms = {room.get("room_id"): room for room in frame.data["chat_rooms"]}
+                rooms.update({room.get("room_id"): room for room in data["chat_rooms"]})
+                merged["chat_rooms"] = list(rooms.values())
+
+            self._remove(frame)
+            text_data, bytes_data = self.codec.encode(merged)
+            frame.data, frame.text_data, frame.bytes_data = merged, text_data, bytes_data
+            frame.size = len(text_data if text_data is not None else bytes_data)
+            self._bytes += frame.size
+            _metrics["queued_frames"] += 1
+            _metrics["queued_bytes"] += frame.size
+            _metrics["coalesced"] += 1
+            return True
+        return False
+
+    # ---------- writer side ----------
+
+    async def _writer(self):
+        try:
+            while not self._closed:
+                if not self._frames:
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                frame = self._frames.popleft()
+                self._remove(frame)
+                await self._send(text_data=frame.text_data, bytes_data=frame.bytes_data)
+                _metrics["sent"] += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception("Outbound writer failed; closing connection")
+            # Nothing drains the queue any more; stop accepting frames and hang up
+            self.close()
+            if self._on_failure is not None:
+                try:
+                    await self._on_failure()
+                except Exception:
+                    logger.debug("Close after writer failure failed", exc_info=True)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for frame in self._frames:
+            self._remove(frame)
+        self._frames.clear()
+        _metrics["connections"] -= 1
+        if (self._task is not None and not self._task.done()
+                and self._task is not asyncio.current_task()):
+            self._task.cancel()
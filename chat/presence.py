@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import threading
+import time
+
+from channels.db import database_sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceRegistry:
+    """
+    Tracks which users have live WebSocket connections.
+
+    - Connection counts live in process memory, so online checks for users
+      connected to this worker are plain dict lookups.
+    - Each worker also adds 1 per connected user to a TTL'd counter in the
+      Django cache, so other workers (and REST views) can see presence when a
+      shared cache backend is configured. The worker keeps that TTL fresh for
+      as long as the user has a socket here, quiet or not; if the worker dies
+      its contribution expires with the key.
+    - Device.is_online / Device.last_seen are written behind in batches by a
+      periodic flush instead of on every connect/disconnect. The flush takes
+      online/offline from the shared counter, so a user who leaves this
+      worker but is still connected on another stays online.
+    """
+
+    CACHE_KEY = "presence:{user_id}"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {}   # user_id -> live connection count on this worker
+        self._cache_touched = {} # user_id -> monotonic time of the last cache refresh
+        self._pending = {}       # user_id -> online flag waiting to be written to Device
+        self._flush_task = None
+
+    @property
+    def ttl(self):
+        return getattr(settings, "PRESENCE_TTL_SECONDS", 300)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, "PRESENCE_FLUSH_INTERVAL_SECONDS", 15)
+
+    # ---------- connection lifecycle ----------
+
+    def connect(self, user_id):
+        """Register a new connection for the user."""
+        with self._lock:
+            count = self._connections.get(user_id, 0) + 1
+            self._connections[user_id] = count
+            self._pending[user_id] = True
+
+        if count == 1:
+            self._cache_join(user_id)
+        self.ensure_flusher()
+
+    def disconnect(self, user_id):
+        """Drop one connection for the user; the user goes offline at zero."""
+        with self._lock:
+            count = self._connections.get(user_id, 0) - 1
+            if count > 0:
+                self._connections[user_id] = count
+                return
+            self._connections.pop(user_id, None)
+            self._cache_touched.pop(user_id, None)
+            self._pending[user_id] = False
+
+        self._cache_leave(user_id)
+
+    def touch(self, user_id):
+        """Heartbeat: refresh the user's shared TTL (any inbound frame counts)."""
+        now = time.monotonic()
+        with self._lock:
+            if user_id not in self._connections:
+                return
+            self._pending.setdefault(user_id, True)
+            # Only refresh the shared key once per half TTL
+            refresh = now - self._cache_touched.get(user_id, 0) > self.ttl / 2
+            if refresh:
+                self._cache_touched[user_id] = now
+
+        if refresh:
+            self._cache_refresh(user_id)
+
+    # ---------- lookups ----------
+
+    def is_online(self, user_id):
+        return self.any_online([user_id])
+
+    def any_online(self, user_ids):
+        """True if any of the given users has a live connection on any worker."""
+        user_ids = [uid for uid in user_ids if uid]
+        if not user_ids:
+            return False
+
+        with self._lock:
+            for uid in user_ids:
+                if self._connections.get(uid):
+                    return True
+
+        keys = [self.CACHE_KEY.format(user_id=uid) for uid in user_ids]
+        return any((value or 0) > 0 for value in cache.get_many(keys).values())
+
+    def connection_count(self, user_id):
+        """Live connections for the user on this worker."""
+        with self._lock:
+            return self._connections.get(user_id, 0)
+
+    # ---------- shared cache counter ----------
+
+    def _cache_join(self, user_id):
+        key = self.CACHE_KEY.format(user_id=user_id)
+        try:
+            cache.add(key, 0, self.ttl)
+            cache.incr(key)
+        except ValueError:
+            # Key expired between add and incr
+            cache.set(key, 1, self.ttl)
+        with self._lock:
+            self._cache_touched[user_id] = time.monotonic()
+
+    def _cache_leave(self, user_id):
+        # Only this worker's contribution; other workers may still hold the user
+        key = self.CACHE_KEY.format(user_id=user_id)
+        try:
+            if cache.decr(key) <= 0:
+                cache.delete(key)
+        except ValueError:
+            pass
+
+    def _cache_refresh(self, user_id):
+        # The key expired (or was evicted) while the user stayed connected here
+        if not cache.touch(self.CACHE_KEY.format(user_id=user_id), self.ttl):
+            self._cache_join(user_id)
+
+    # ---------- write-behind ----------
+
+    def _refresh_connected(self):
+        """Keep the shared TTL alive for users whose sockets here are quiet."""
+        now = time.monotonic()
+        with self._lock:
+            stale = [
+                uid for uid in self._connections
+                if now - self._cache_touched.get(uid, 0) > self.ttl / 2
+            ]
+            for uid in stale:
+                self._cache_touched[uid] = now
+
+        for uid in stale:
+            self._cache_refresh(uid)
+
+    def _drain_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            # Users still connected get their last_seen refreshed on every flush
+            for uid in self._connections:
+                pending.setdefault(uid, True)
+        return pending
+
+    def _shared_online(self, user_ids):
+        """The subset of user_ids connected on any worker, per the shared counters."""
+        online = set()
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            values = cache.get_many([self.CACHE_KEY.format(user_id=uid) for uid in chunk])
+            online.update(uid for uid in chunk if (values.get(self.CACHE_KEY.format(user_id=uid)) or 0) > 0)
+        return online
+
+    def flush_sync(self, pending):
+        Device = apps.get_model("accounts", "Device")
+        now = timezone.now()
+        # A local disconnect only means offline if no other worker holds the user
+        shared = self._shared_online([uid for uid, online in pending.items() if not online])
+        online_ids = [uid for uid, online in pending.items() if online or uid in shared]
+        offline_ids = [uid for uid, online in pending.items() if not online and uid not in shared]
+
+        for ids, is_online in ((online_ids, True), (offline_ids, False)):
+            for start in range(0, len(ids), 500):
+                Device.objects.filter(user_id__in=ids[start:start + 500]).update(
+                    is_online=is_online,
+                    last_seen=now,
+                )
+
+    async def flush(self):
+        self._refresh_connected()
+        pending = self._drain_pending()
+        if not pending:
+            return
+        try:
+            await database_sync_to_async(self.flush_sync)(pending)
+        except Exception as e:
+            logger.error(f"Presence flush failed: {str(e)}")
+            # Put back anything that wasn't superseded in the meantime
+            with self._lock:
+                for uid, online in pending.items():
+                    self._pending.setdefault(uid, online)
+
+    async def _run_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def ensure_flusher(self):
+        """Start the periodic flush on the running event loop (once per worker)."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._run_flusher())
+
+
+# Shared per-worker registry
+presence = PresenceRegistry()
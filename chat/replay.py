@@ -0,0 +1,63 @@
+import threading
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+
+class RoomReplayBuffer:
+    """
+    Bounded per-worker buffer of recent message payloads, keyed by room and
+    ordered by the room's message sequence number.
+
+    Filled as chat_message events reach consumers on this worker, so rooms
+    with live connections can serve a reconnecting client's "resume" from
+    memory. Each room keeps the last REPLAY_BUFFER_SIZE payloads and only
+    the REPLAY_BUFFER_MAX_ROOMS most recently active rooms are kept.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rooms = OrderedDict()  # room_id -> deque[(seq, payload)]
+
+    def record(self, room_id, payload):
+        seq = payload.get("seq")
+        if not seq:
+            return
+
+        with self._lock:
+            entries = self._rooms.get(room_id)
+            if entries is None:
+                entries = deque(maxlen=settings.REPLAY_BUFFER_SIZE)
+                self._rooms[room_id] = entries
+            self._rooms.move_to_end(room_id)
+
+            # Every connection in the room sees the same event; keep it once
+            if entries and seq <= entries[-1][0]:
+                return
+            entries.append((seq, payload))
+
+            while len(self._rooms) > settings.REPLAY_BUFFER_MAX_ROOMS:
+                self._rooms.popitem(last=False)
+
+    def since(self, room_id, last_seq):
+        """
+        Payloads with seq > last_seq, or None if the buffer can't prove it
+        holds all of them (gap before the oldest entry or between entries).
+        """
+        with self._lock:
+            entries = list(self._rooms.get(room_id) or ())
+
+        if not entries or entries[0][0] > last_seq + 1:
+            return None
+
+        missed = [(seq, payload) for seq, payload in entries if seq > last_seq]
+        expected = last_seq + 1
+        for seq, _ in missed:
+            if seq != expected:
+                return None
+            expected += 1
+        return [payload for _, payload in missed]
+
+
+# Shared per-worker buffer
+replay_buffer = RoomReplayBuffer()
@@ -1,9 +1,12 @@
 from django.urls import re_path
 from . import consumers
+from .multiplex import MultiplexConsumer
 
 websocket_urlpatterns = [
     re_path(r'^api/ws/chat/(?P<room_id>[\w-]+)/$', consumers.ChatConsumer.as_asgi()),
     re_path(r'^api/ws/notifications/(?P<user_id>\d+)/$', consumers.NotificationConsumer.as_asgi()),
     re_path(r'^api/ws/chat-list/?$', consumers.ChatListConsumer.as_asgi()),
+    # Single socket per user: rooms, chat list and notifications as topics
+    re_path(r'^api/ws/?$', MultiplexConsumer.as_asgi()),
 ]
 
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from .models import ChatRoom, Message, MessageReadStatus, ChatParticipant
+from .presence import presence
 from accounts.models import BusinessInfo
 from referr.models import Referral
 
@@ -50,14 +51,26 @@ class MessageSerializer(serializers.ModelSerializer):
             'is_read', 'read_count',
         ]
 
+    def _read_watermarks(self, obj):
+        # Pass 'read_watermarks' in the context to share one lookup across messages
+        watermarks = self.context.get('read_watermarks')
+        if watermarks is None:
+            watermarks = obj.chat_room.get_read_watermarks()
+        return watermarks
+
     def get_is_read(self, obj):
         request = self.context.get('request')
         if request and hasattr(request, 'user'):
+            watermark = self._read_watermarks(obj).get(request.user.id)
+            if watermark and watermark >= obj.id:
+                return True
             return obj.read_statuses.filter(user=request.user).exists()
         return False
 
     def get_read_count(self, obj):
-        return obj.read_statuses.count()
+        readers = {rs.user_id for rs in obj.read_statuses.all()}
+        readers.update(uid for uid, watermark in self._read_watermarks(obj).items() if watermark >= obj.id)
+        return len(readers)
         
     def get_file_url(self, obj):
         """Get presigned URL for file access"""
@@ -174,12 +187,16 @@ class MessageCreateSerializer(serializers.ModelSerializer):
             validated_data['file_type'] = getattr(first_file, 'content_type', 'application/octet-stream')
         
         # Create the message
-        message = Message.objects.create(
+        message = Message(
             chat_room=chat_room,
             sender=sender,
             reply_to=reply_to,
             **validated_data
         )
+        # Hold the realtime broadcast until every attachment exists, so the
+        # payload serialized once for the fan-out is complete
+        message.defer_realtime_updates = len(all_files) > 1
+        message.save()
         
         # Create additional attachments for remaining files
         if len(all_files) > 1:
@@ -195,6 +212,7 @@ class MessageCreateSerializer(serializers.ModelSerializer):
                 additional_attachments.append(attachment)
             
             MessageAttachment.objects.bulk_create(additional_attachments)
+            message._send_realtime_updates(created=True)
         
         return message
 
@@ -202,6 +220,8 @@ class MessageCreateSerializer(serializers.ModelSerializer):
 class ChatParticipantSerializer(serializers.ModelSerializer):
     """Serializer for chat participants"""
     user = UserBasicSerializer(read_only=True)
+    # Live presence; the ChatParticipant.is_online column is no longer written
+    is_online = serializers.SerializerMethodField()
     
     class Meta:
         model = ChatParticipant
@@ -210,6 +230,9 @@ class ChatParticipantSerializer(serializers.ModelSerializer):
             'joined_at', 'last_seen_at', 'is_online'
         ]
 
+    def get_is_online(self, obj):
+        return presence.is_online(obj.user_id)
+
 
 class ChatRoomSerializer(serializers.ModelSerializer):
     """Detailed chat room serializer"""
@@ -257,11 +280,7 @@ class ChatRoomSerializer(serializers.ModelSerializer):
         """Get unread message count for current user"""
         request = self.context.get('request')
         if request and hasattr(request, 'user'):
-            return obj.messages.exclude(
-                read_statuses__user=request.user
-            ).exclude(
-                sender=request.user
-            ).count()
+            return obj.get_unread_count(request.user)
         return 0
     
     def get_can_send_messages(self, obj):
@@ -324,11 +343,7 @@ class ChatRoomListSerializer(serializers.ModelSerializer):
         """Get unread message count for current user"""
         request = self.context.get('request')
         if request and hasattr(request, 'user'):
-            return obj.messages.exclude(
-                read_statuses__user=request.user
-            ).exclude(
-                sender=request.user
-            ).count()
+            return obj.get_unread_count(request.user)
         return 0
     
     def get_other_participant(self, obj):
@@ -387,4 +402,95 @@ class ChatStatisticsSerializer(serializers.Serializer):
     active_chat_rooms = serializers.IntegerField()
     messages_last_30_days = serializers.IntegerField()
     unread_messages = serializers.IntegerField()
-    active_conversations_last_7_days = serializers.IntegerField()
\ No newline at end of file
+    active_conversations_last_7_days = serializers.IntegerField()
+
+# ---------------------------------------------
+# Realtime message payloads
+# ---------------------------------------------
+def serialize_message_payload(msg, participant_ids, read_user_ids=None, read_watermarks=None):
+    """
+    Viewer-independent message payload, built once per message and shared by
+    every recipient (REST pages and WebSocket fan-out alike).
+    Use apply_viewer_read_state() to add the per-viewer flags.
+
+    read_watermarks ({user_id: last_read_message_id}) marks the message as
+    read for every participant whose watermark has passed it.
+    """
+    from utils.storage_backends import generate_presigned_url
+
+    if read_user_ids is None:
+        # Uses the prefetch cache when read_statuses was prefetched
+        read_user_ids = {rs.user_id for rs in msg.read_statuses.all()}
+    read_user_ids = set(read_user_ids)
+    for uid, watermark in (read_watermarks or {}).items():
+        if watermark and watermark >= msg.id:
+            read_user_ids.add(uid)
+
+    # Users who read this message (excluding sender)
+    read_by_others = read_user_ids - {msg.sender_id}
+    others_count = len(set(participant_ids) - {msg.sender_id})
+
+    sender_image_url = (
+        generate_presigned_url(f"media/{msg.sender.image}", expires_in=3600)
+        if getattr(msg.sender, "image", None) else None
+    )
+
+    message_data = {
+        "id": msg.id,
+        "seq": msg.seq,
+        "room_id": msg.chat_room.room_id,
+        "sender": {
+            "id": msg.sender.id,
+            "name": msg.sender.full_name,
+            "role": msg.sender.role,
+            "image_url": sender_image_url,
+        },
+        "content": msg.content,
+        "message_type": msg.message_type,
+        "created_at": msg.created_at.isoformat(),
+
+        # Sender perspective (for showing "others read" indicators)
+        "read_by_user_ids": list(read_by_others),
+        "read_by_others_count": len(read_by_others),
+        "read_by_all_others": others_count > 0 and len(read_by_others) == others_count,
+
+        # Legacy field for backwards compatibility
+        "read_by": list(read_user_ids),
+    }
+
+    # Add file/attachment information for media messages
+    if msg.message_type in ['image', 'document', 'file']:
+        message_data.update({
+            "file_url": msg.get_file_url(),
+            "file_name": msg.file_name,
+            "file_size": msg.file_size,
+            "file_size_formatted": msg.file_size_formatted,
+            "file_type": msg.file_type,
+            "duration": msg.duration,
+            "thumbnail_url": msg.thumbnail_url,
+            "dimensions": msg.dimensions,
+            "attachments": msg.get_attachments_data(),
+        })
+
+    # Add reply info if this is a reply message
+    if msg.reply_to_id:
+        message_data["reply_to"] = {
+            "id": msg.reply_to.id,
+            "content": msg.reply_to.content[:100] + ('...' if len(msg.reply_to.content) > 100 else ''),
+            "sender_name": msg.reply_to.sender.full_name,
+            "message_type": msg.reply_to.message_type,
+        }
+
+    return message_data
+
+
+def apply_viewer_read_state(message_data, viewer_id):
+    """Add the cheap per-viewer flags to a shared message payload."""
+    is_read_by_me = message_data["sender"]["id"] == viewer_id or viewer_id in message_data["read_by"]
+    return {
+        **message_data,
+        # Viewer perspective
+        "is_read_by_me": is_read_by_me,
+        # Legacy field for backwards compatibility
+        "is_read": is_read_by_me,
+    }
@@ -0,0 +1,14 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from chat.middleware import invalidate_user_snapshot
+
+User = get_user_model()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_ws_user_snapshot(sender, instance, **kwargs):
+    """Profile, role or status changes must not be served from the WebSocket auth cache."""
+    invalidate_user_snapshot(instance.pk)
@@ -0,0 +1,12 @@
+from celery import shared_task
+from django.conf import settings
+
+
+@shared_task(name="chat.tasks.reconcile_notification_counters")
+def reconcile_notification_counters():
+    from chat.models import NotificationCounter
+
+    fixed = NotificationCounter.reconcile_all(batch_size=settings.NOTIFICATION_COUNTER_RECONCILE_BATCH_SIZE)
+    if fixed:
+        print(f"Reconciled notification counters: {fixed} rows corrected")
+    return fixed
@@ -1,3 +1,631 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import ssl
+import tempfile
+import threading
+from unittest import mock
 
-# Create your tests here.
+import h2.config
+import h2.connection
+import h2.events
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from django.apps import apps
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from chat.presence import PresenceRegistry
+from utils import apns, ids, push_digest
+from utils import broadcast as broadcast_utils
+from utils import retention
+from utils.tasks import resume_stalled_broadcasts_task
+
+FROZEN_TIME = 1767225600.0  # 2026-01-01T00:00:00Z
+TIMESTAMP_SHIFT = ids.WORKER_BITS + ids.SEQUENCE_BITS
+
+
+class SnowflakeGeneratorTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def _mint(self, generator, count, now=FROZEN_TIME):
+        with mock.patch("utils.ids.time.time", return_value=now):
+            return [generator.next_id() for _ in range(count)]
+
+    def test_ids_unique_and_monotonic_within_a_millisecond(self):
+        generator = ids.SnowflakeGenerator(worker_id=5)
+        minted = self._mint(generator, ids.MAX_SEQUENCE + 1)
+
+        self.assertEqual(len(set(minted)), len(minted))
+        self.assertEqual(minted, sorted(minted))
+        self.assertEqual({(i >> ids.SEQUENCE_BITS) & ids.MAX_WORKER_ID for i in minted}, {5})
+        self.assertEqual(len({i >> TIMESTAMP_SHIFT for i in minted}), 1)
+
+    def test_sequence_rollover_borrows_the_next_millisecond(self):
+        generator = ids.SnowflakeGenerator(worker_id=5)
+        minted = self._mint(generator, 3 * (ids.MAX_SEQUENCE + 1))
+
+        self.assertEqual(len(set(minted)), len(minted))
+        self.assertEqual(minted, sorted(minted))
+        self.assertEqual((minted[-1] >> TIMESTAMP_SHIFT) - (minted[0] >> TIMESTAMP_SHIFT), 2)
+
+        # The wall clock lagging behind the borrowed millisecond never goes backwards
+        later = self._mint(generator, 1, now=FROZEN_TIME + 0.001)
+        self.assertGreater(later[0], minted[-1])
+
+    def test_clock_going_backwards_keeps_ids_increasing(self):
+        generator = ids.SnowflakeGenerator(worker_id=1)
+        first = self._mint(generator, 1)
+        earlier = self._mint(generator, 1, now=FROZEN_TIME - 5)
+        self.assertGreater(earlier[0], first[0])
+
+    @override_settings(SNOWFLAKE_WORKER_ID=None)
+    def test_processes_lease_distinct_worker_ids(self):
+        leased = {ids.SnowflakeGenerator().worker_id for _ in range(10)}
+        self.assertEqual(len(leased), 10)
+
+    @override_settings(SNOWFLAKE_WORKER_ID=None)
+    def test_forked_child_leases_its_own_worker_id(self):
+        generator = ids.SnowflakeGenerator()
+        parent = generator.worker_id
+        with mock.patch("utils.ids.os.getpid", return_value=os.getpid() + 1):
+            child = generator.worker_id
+        self.assertNotEqual(parent, child)
+
+    @override_settings(SNOWFLAKE_WORKER_ID="99")
+    def test_out_of_range_worker_id_is_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            ids.SnowflakeGenerator().next_id()
+
+    @override_settings(SNOWFLAKE_WORKER_ID=None, SHARED_CACHE=False, DEBUG=False, TESTING=False)
+    def test_lease_requires_shared_cache_outside_debug(self):
+        with self.assertRaises(ImproperlyConfigured):
+            ids.SnowflakeGenerator().next_id()
+
+
+@override_settings(PUSH_DIGEST_WINDOW_SECONDS=5, PUSH_DIGEST_MAX_MESSAGES=50)
+class PushDigestTests(SimpleTestCase):
+    ROOM_ID = 7
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch("utils.tasks.flush_chat_push_digest_task.apply_async")
+        self.schedule = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _queue(self, *bodies):
+        for body in bodies:
+            push_digest.queue_chat_push(self.ROOM_ID, 1, "Ann", [1, 2], body, {"chat_room_id": self.ROOM_ID})
+
+    def _flush(self):
+        with mock.patch("utils.push_digest.send_digest") as send_digest:
+            push_digest.flush_digest(self.ROOM_ID)
+        if not send_digest.called:
+            return []
+        return [entry["body"] for entry in send_digest.call_args.args[1]]
+
+    def test_flush_sends_queued_messages_once(self):
+        self._queue("a", "b", "c")
+        self.assertEqual(self.schedule.call_count, 1)
+
+        self.assertEqual(self._flush(), ["a", "b", "c"])
+        self.assertEqual(self._flush(), [])
+
+    def test_messages_queued_after_a_flush_read_are_kept(self):
+        self._queue("a", "b")
+        entries, complete = push_digest._take_pending(self.ROOM_ID)
+        self.assertEqual([e["body"] for e in entries], ["a", "b"])
+        self.assertTrue(complete)
+
+        self._queue("c")
+        self.assertEqual(self._flush(), ["c"])
+
+    @override_settings(PUSH_DIGEST_MAX_MESSAGES=2)
+    def test_digest_keeps_the_newest_messages(self):
+        self._queue("a", "b", "c")
+        self.assertEqual(self._flush(), ["b", "c"])
+        self.assertEqual(self._flush(), [])
+
+    def test_unwritten_entry_waits_one_window_then_is_skipped(self):
+        self._queue("a")
+        # Counted by a writer that hasn't stored its entry yet
+        cache.incr(push_digest.HEAD_KEY.format(room_id=self.ROOM_ID))
+        self._queue("c")
+
+        self.assertEqual(self._flush(), ["a"])
+        self.assertEqual(self.schedule.call_count, 2)
+        self.assertEqual(self._flush(), ["c"])
+
+    @override_settings(SHARED_CACHE=False, DEBUG=False, TESTING=False)
+    def test_without_shared_cache_pushes_go_out_immediately(self):
+        with self.assertLogs("chat.apps", "WARNING"):
+            apps.get_app_config("chat").ready()
+
+        with mock.patch("utils.push_digest.send_digest") as send_digest:
+            self._queue("a")
+        self.assertEqual(send_digest.call_args.args[1][0]["body"], "a")
+        self.schedule.assert_not_called()
+
+class _APNsStandIn:
+    """
+    Local HTTP/2 server speaking enough of the APNs API for utils.apns:
+    TLS with ALPN "h2", one response per POST from `respond(headers, body)`
+    -> (status, json_body). Runs on its own event loop thread.
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+        self._loop = asyncio.new_event_loop()
+        self._tmp = tempfile.TemporaryDirectory()
+        self._server = None
+        self.port = None
+
+    def _tls_context(self):
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(name).issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256())
+        )
+        cert_path = os.path.join(self._tmp.name, "cert.pem")
+        key_path = os.path.join(self._tmp.name, "key.pem")
+        with open(cert_path, "wb") as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+        with open(key_path, "wb") as f:
+            f.write(key.private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+            ))
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_path, key_path)
+        context.set_alpn_protocols(["h2"])
+        return context
+
+    async def _handle(self, reader, writer):
+        conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding="utf-8"))
+        conn.initiate_connection()
+        writer.write(conn.data_to_send())
+        streams = {}
+        while data := await reader.read(65535):
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    streams[event.stream_id] = [dict(event.headers), b""]
+                elif isinstance(event, h2.events.DataReceived):
+                    streams[event.stream_id][1] += event.data
+                    conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    headers, body = streams.pop(event.stream_id)
+                    self.requests.append((headers, json.loads(body)))
+                    status, payload = self.respond(headers, body)
+                    content = json.dumps(payload).encode() if payload else b""
+                    conn.send_headers(event.stream_id, [(":status", str(status)), ("apns-id", f"id-{event.stream_id}")])
+                    conn.send_data(event.stream_id, content, end_stream=True)
+            writer.write(conn.data_to_send())
+            await writer.drain()
+        writer.close()
+
+    def __enter__(self):
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        self._server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._handle, "127.0.0.1", 0, ssl=self._tls_context()), self._loop,
+        ).result(5)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def _shutdown(self):
+        self._server.close()
+        # Handlers end on the client's EOF; cancel any left behind
+        handlers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if handlers:
+            _, pending = await asyncio.wait(handlers, timeout=1)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def __exit__(self, *exc_info):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._tmp.cleanup()
+
+
+class APNsClientTests(SimpleTestCase):
+    def setUp(self):
+        key = ec.generate_private_key(ec.SECP256R1())
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.key_path = os.path.join(tmp.name, "AuthKey_TEST.p8")
+        with open(self.key_path, "wb") as f:
+            f.write(key.private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+            ))
+
+    def _send(self, respond, tokens):
+        with _APNsStandIn(respond) as server, override_settings(
+            APNS_BASE_URL=f"https://localhost:{server.port}",
+            APNS_VERIFY_TLS=False,
+            APNS_KEY_PATH=self.key_path,
+            APNS_KEY_ID="TESTKEY",
+            APNS_TEAM_ID="TEAM",
+            APNS_TOPIC="com.example.app",
+            APNS_TIMEOUT_SECONDS=5,
+        ):
+            client = apns.APNsClient()
+            try:
+                results = client.send_many(
+                    [(token, "Hi", "Hello", {"chat_room_id": 3}) for token in tokens], collapse_key="chat:3",
+                )
+            finally:
+                self._close(client)
+        return results, server.requests
+
+    def _close(self, client):
+        if client._client is not None:
+            asyncio.run_coroutine_threadsafe(client._client.aclose(), client._loop).result(5)
+        client._loop.call_soon_threadsafe(client._loop.stop)
+
+    def test_accepted_push(self):
+        results, requests = self._send(lambda headers, body: (200, None), ["tok1", "tok2"])
+
+        self.assertEqual([r["success"] for r in results], [True, True])
+        self.assertTrue(all(r["apns_id"] for r in results))
+        headers, payload = requests[0]
+        self.assertEqual(headers["apns-topic"], "com.example.app")
+        self.assertEqual(headers["apns-collapse-id"], "chat:3")
+        self.assertTrue(headers["authorization"].startswith("bearer "))
+        self.assertEqual(payload["aps"]["alert"], {"title": "Hi", "body": "Hello"})
+        self.assertEqual(payload["chat_room_id"], "3")
+
+    def test_unregistered_token_is_marked_for_pruning(self):
+        def respond(headers, body):
+            if headers[":path"].endswith("/dead"):
+                return 410, {"reason": "Unregistered", "timestamp": 0}
+            return 200, None
+
+        results, _ = self._send(respond, ["live", "dead"])
+        by_token = {r["token"]: r for r in results}
+
+        self.assertTrue(by_token["live"]["success"])
+        self.assertFalse(by_token["dead"]["success"])
+        self.assertEqual(by_token["dead"]["status"], 410)
+        self.assertTrue(by_token["dead"]["invalid"])
+
+    def test_expired_provider_token_is_resigned(self):
+        seen = []
+
+        def respond(headers, body):
+            seen.append(headers["authorization"])
+            if len(seen) == 1:
+                return 403, {"reason": "ExpiredProviderToken"}
+            return 200, None
+
+        # A fresh signature needs a different iat than the rejected one
+        with mock.patch("utils.apns.time.time", side_effect=itertools.count(FROZEN_TIME)):
+            results, _ = self._send(respond, ["tok1"])
+
+        self.assertTrue(results[0]["success"])
+        self.assertEqual(len(seen), 2)
+        self.assertNotEqual(seen[0], seen[1])
+
+    @override_settings(APNS_TIMEOUT_SECONDS=0.01, APNS_MAX_CONCURRENT_STREAMS=100)
+    def test_batch_timeout_returns_a_failure_per_token(self):
+        client = apns.APNsClient()
+        self.addCleanup(self._close, client)
+
+        async def hang(*args):
+            await asyncio.sleep(60)
+
+        with mock.patch.object(client, "_send_all", hang), mock.patch("utils.apns.RESULT_GRACE_SECONDS", 0):
+            results = client.send_many([("tok1", "Hi", "Hello", None), ("tok2", "Hi", "Hello", None)])
+
+        self.assertEqual([r["token"] for r in results], ["tok1", "tok2"])
+        self.assertTrue(all(not r["success"] and not r["invalid"] for r in results))
+
+
+@override_settings(BROADCAST_CHUNK_SIZE=2, BROADCAST_MAX_RETRIES=2, BROADCAST_STALL_SECONDS=600)
+class BroadcastTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        User = apps.get_model("accounts", "User")
+        cls.users = [User.objects.create_user(email=f"user{i}@example.com", password="x") for i in range(3)]
+
+    def _broadcast(self, **fields):
+        Broadcast = apps.get_model("chat", "Broadcast")
+        return Broadcast.objects.create(title="Hi", message="Hello", status="running", **fields)
+
+    def test_push_failure_does_not_stop_the_broadcast(self):
+        broadcast = self._broadcast()
+
+        with mock.patch("utils.push.send_push_notifications", side_effect=RuntimeError("FCM down")):
+            more = broadcast_utils.process_next_chunk(broadcast.id)
+
+        broadcast.refresh_from_db()
+        self.assertTrue(more)
+        self.assertEqual(broadcast.status, "running")
+        self.assertEqual(broadcast.delivered_count, 2)
+        self.assertEqual(broadcast.last_user_id, self.users[1].id)
+
+    def test_failed_broadcast_is_resumed_while_retries_remain(self):
+        broadcast = self._broadcast(retry_count=1)
+        exhausted = self._broadcast(retry_count=2)
+        recent = self._broadcast()
+        Broadcast = apps.get_model("chat", "Broadcast")
+        old = timezone.now() - datetime.timedelta(seconds=601)
+        Broadcast.objects.filter(id__in=[broadcast.id, exhausted.id]).update(status="failed", updated_at=old)
+        Broadcast.objects.filter(id=recent.id).update(status="failed")
+
+        with mock.patch("utils.tasks.run_broadcast_task.delay") as delay:
+            resumed = resume_stalled_broadcasts_task()
+
+        self.assertEqual(resumed, [broadcast.id])
+        delay.assert_called_once_with(broadcast.id)
+        broadcast.refresh_from_db()
+        self.assertEqual((broadcast.status, broadcast.retry_count), ("running", 2))
+        exhausted.refresh_from_db()
+        self.assertEqual(exhausted.status, "failed")
+
+
+class PresenceFlushTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        User = apps.get_model("accounts", "User")
+        Device = apps.get_model("accounts", "Device")
+        cls.user = User.objects.create_user(email="presence@example.com", password="x")
+        cls.device = Device.objects.create(user=cls.user, token="tok-presence", platform="android")
+
+    def setUp(self):
+        cache.clear()
+
+    def _flush(self, registry):
+        registry.flush_sync(registry._drain_pending())
+        self.device.refresh_from_db()
+        return self.device.is_online
+
+    def test_leaving_one_worker_keeps_a_user_online_on_another(self):
+        worker_a, worker_b = PresenceRegistry(), PresenceRegistry()
+        worker_a.connect(self.user.id)
+        worker_b.connect(self.user.id)
+
+        worker_a.disconnect(self.user.id)
+        self.assertTrue(self._flush(worker_a))
+        self.assertTrue(self._flush(worker_b))
+
+        worker_b.disconnect(self.user.id)
+        self.assertFalse(self._flush(worker_b))
+
+
+class NotificationCounterAssertions:
+    """Counter rows must equal a COUNT over the user's Notification rows (zeroed rows ignored)"""
+
+    def assertCountersMatch(self, user):
+        Notification = apps.get_model("chat", "Notification")
+        NotificationCounter = apps.get_model("chat", "NotificationCounter")
+        expected = {}
+        for event_type, is_read in Notification.objects.filter(user=user).values_list("event_type", "is_read"):
+            for key in (event_type, NotificationCounter.ALL):
+                total, unread = expected.get(key, (0, 0))
+                expected[key] = (total + 1, unread + (0 if is_read else 1))
+        counters = {
+            event_type: (total, unread)
+            for event_type, total, unread in NotificationCounter.objects.filter(user=user)
+            .values_list("event_type", "total", "unread")
+            if (total, unread) != (0, 0)
+        }
+        self.assertEqual(counters, expected)
+
+
+class NotificationCounterTests(NotificationCounterAssertions, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        User = apps.get_model("accounts", "User")
+        cls.user = User.objects.create_user(email="counted@example.com", password="x")
+        cls.other = User.objects.create_user(email="other@example.com", password="x")
+
+    def _notify(self, user, event_type="system.update", **fields):
+        Notification = apps.get_model("chat", "Notification")
+        return Notification.objects.create(user=user, event_type=event_type, title="Hi", message="Hello", **fields)
+
+    def test_counters_follow_create_and_bulk_create(self):
+        Notification = apps.get_model("chat", "Notification")
+        self._notify(self.user)
+        self._notify(self.user, event_type="reward.earned", is_read=True)
+        Notification.objects.bulk_create([
+            Notification(user=user, event_type=event_type, title="Hi", message="Hello")
+            for user in (self.user, self.other) for event_type in ("system.update", "referral.sent")
+        ])
+
+        self.assertCountersMatch(self.user)
+        self.assertCountersMatch(self.other)
+
+    def test_counters_follow_mark_read(self):
+        Notification = apps.get_model("chat", "Notification")
+        first, second, third = (self._notify(self.user, event_type=t) for t in ("system.update", "referral.sent", "system.update"))
+        self._notify(self.other)
+
+        marked, ids = Notification.mark_read_for_user(self.user, ids=[first.id, second.id])
+        self.assertEqual((marked, sorted(ids)), (2, sorted([first.id, second.id])))
+        # Already read: no second decrement
+        self.assertEqual(Notification.mark_read_for_user(self.user, ids=[first.id]), (0, []))
+        self.assertCountersMatch(self.user)
+
+        third.mark_as_read()
+        self._notify(self.user, event_type="reward.earned")
+        Notification.mark_read_for_user(self.user)
+        self.assertCountersMatch(self.user)
+        self.assertCountersMatch(self.other)
+
+    def test_reconcile_repairs_counters_after_delete(self):
+        NotificationCounter = apps.get_model("chat", "NotificationCounter")
+        kept = self._notify(self.user)
+        self._notify(self.user, event_type="referral.sent").delete()
+        self._notify(self.other).delete()
+
+        self.assertEqual(NotificationCounter.reconcile([self.user.id, self.other.id]), 4)
+        self.assertCountersMatch(self.user)
+        self.assertCountersMatch(self.other)
+        self.assertEqual(NotificationCounter.counts_for(self.user, kept.event_type), ((1, 1), (1, 1)))
+
+
+class NotificationCursorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        User = apps.get_model("accounts", "User")
+        Notification = apps.get_model("chat", "Notification")
+        cls.user = User.objects.create_user(email="paged@example.com", password="x")
+        Notification.objects.bulk_create([
+            Notification(user=cls.user, event_type="system.update", title=f"#{i}", message="Hello") for i in range(7)
+        ])
+        # Five rows share one timestamp, so page boundaries land inside the tie
+        same, older = timezone.now(), timezone.now() - datetime.timedelta(minutes=1)
+        ids = sorted(Notification.objects.values_list("id", flat=True))
+        Notification.objects.filter(id__in=ids[:5]).update(created_at=same)
+        Notification.objects.filter(id__in=ids[5:]).update(created_at=older)
+        cls.expected = ids
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_equal_created_at_across_pages_neither_skips_nor_repeats(self):
+        seen, cursor = [], None
+        while True:
+            params = {"page_size": 2, **({"cursor": cursor} if cursor else {})}
+            body = self.client.get("/chat/notifications/", params).json()
+            seen += [n["id"] for n in body["notifications"]]
+            cursor = body["pagination"]["next_cursor"]
+            if not cursor:
+                break
+
+        self.assertEqual(seen, self.expected)
+
+
+@override_settings(
+    RETENTION_NOTIFICATION_READ_DAYS=90, RETENTION_NOTIFICATION_UNREAD_DAYS=365, RETENTION_READ_STATUS_DAYS=30,
+    RETENTION_MIN_SLEEP_SECONDS=0,
+)
+class RetentionTests(NotificationCounterAssertions, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        User = apps.get_model("accounts", "User")
+        cls.user = User.objects.create_user(email="retained@example.com", password="x")
+
+    def setUp(self):
+        sleep = mock.patch("utils.retention.time.sleep")
+        sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def _notification(self, days_old, is_read=False, event_type="system.update"):
+        Notification = apps.get_model("chat", "Notification")
+        notification = Notification.objects.create(
+            user=self.user, event_type=event_type, title="Hi", message="Hello", is_read=is_read,
+        )
+        Notification.objects.filter(id=notification.id).update(
+            created_at=timezone.now() - datetime.timedelta(days=days_old),
+        )
+        return notification.id
+
+    def _remaining(self):
+        return set(apps.get_model("chat", "Notification").objects.values_list("id", flat=True))
+
+    def test_prune_keeps_unread_inside_the_window_and_counters_exact(self):
+        old_read = self._notification(100, is_read=True)
+        old_unread = self._notification(100)
+        expired_unread = self._notification(400, event_type="referral.sent")
+        recent_read = self._notification(10, is_read=True)
+
+        stats = retention.run_retention(["notifications"], batch_size=2)[0]
+
+        self.assertEqual((stats["deleted"], stats["finished"]), (2, True))
+        self.assertEqual(self._remaining(), {old_unread, recent_read})
+        self.assertFalse({old_read, expired_unread} & self._remaining())
+        self.assertCountersMatch(self.user)
+
+    def test_deadline_stop_resumes_on_the_next_run(self):
+        doomed = [self._notification(100, is_read=True) for _ in range(5)]
+        kept = self._notification(100)
+        policy = retention.get_policies(["notifications"])[0]
+
+        # Each monotonic() call is one second: the deadline passes right after the first batch
+        with mock.patch("utils.retention.time.monotonic", side_effect=itertools.count()):
+            first = retention.prune(policy, batch_size=2, deadline=4)
+        self.assertEqual((first["deleted"], first["finished"], first["last_pk"]), (2, False, doomed[1]))
+        self.assertCountersMatch(self.user)
+
+        second = retention.prune(policy, batch_size=2)
+        self.assertEqual((second["deleted"], second["batches"], second["finished"]), (3, 2, True))
+        self.assertEqual(self._remaining(), {kept})
+        self.assertCountersMatch(self.user)
+
+    def test_rows_created_during_a_run_wait_for_the_next_one(self):
+        doomed = [self._notification(100, is_read=True) for _ in range(3)]
+        late = []
+        policy = retention.get_policies(["notifications"])[0]
+
+        def insert_after_first_batch(stats):
+            if stats["batches"] == 1:
+                late.append(self._notification(100, is_read=True))
+
+        stats = retention.prune(policy, batch_size=2, progress=insert_after_first_batch)
+
+        self.assertEqual((stats["deleted"], stats["last_pk"]), (3, doomed[-1]))
+        self.assertEqual(self._remaining(), set(late))
+        self.assertCountersMatch(self.user)
+
+    def test_rows_that_stop_matching_before_the_delete_survive(self):
+        Notification = apps.get_model("chat", "Notification")
+        doomed = self._notification(100, is_read=True)
+        unmarked = self._notification(100, is_read=True)
+        real_atomic = retention.transaction.atomic
+
+        def unmark_then_atomic(*args, **kwargs):
+            # Between the pk SELECT and the DELETE, one row goes back to unread
+            Notification.objects.filter(id=unmarked).update(is_read=False)
+            return real_atomic(*args, **kwargs)
+
+        policy = retention.get_policies(["notifications"])[0]
+        with mock.patch("utils.retention.transaction.atomic", side_effect=unmark_then_atomic):
+            stats = retention.prune(policy)
+
+        self.assertEqual(stats["deleted"], 1)
+        self.assertEqual(self._remaining(), {unmarked})
+        self.assertNotIn(doomed, self._remaining())
+
+    def test_read_statuses_go_only_once_the_room_watermark_covers_them(self):
+        User = apps.get_model("accounts", "User")
+        Referral = apps.get_model("referr", "Referral")
+        ChatRoom = apps.get_model("chat", "ChatRoom")
+        ChatParticipant = apps.get_model("chat", "ChatParticipant")
+        Message = apps.get_model("chat", "Message")
+        MessageReadStatus = apps.get_model("chat", "MessageReadStatus")
+
+        company = User.objects.create_user(email="company@example.com", password="x")
+        referral = Referral.objects.create(referred_by=company, referred_to=self.user, company=company)
+        room = ChatRoom.objects.create(room_id="retention-room", referral=referral, solo_user=self.user, company_user=company)
+        messages = []
+        for text in ("covered", "after watermark", "recent"):
+            message = Message(chat_room=room, sender=company, content=text)
+            message.defer_realtime_updates = True
+            message.save()
+            messages.append(message)
+        ChatParticipant.objects.create(chat_room=room, user=self.user, last_read_message_id=messages[0].id)
+
+        statuses = [MessageReadStatus.objects.create(message=m, user=self.user).id for m in messages]
+        MessageReadStatus.objects.filter(id__in=statuses[:2]).update(read_at=timezone.now() - datetime.timedelta(days=40))
+
+        stats = retention.run_retention(["message_read_statuses"])[0]
+
+        self.assertEqual(stats["deleted"], 1)
+        self.assertEqual(set(MessageReadStatus.objects.values_list("id", flat=True)), set(statuses[1:]))
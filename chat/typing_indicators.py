@@ -0,0 +1,94 @@
+import asyncio
+import logging
+
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class TypingAggregator:
+    """
+    Coalesces typing start/stop changes per room.
+
+    Consumers report state changes here instead of hitting the channel layer
+    directly. At most one "typing_indicator" group event is sent per room per
+    broadcast interval. State is per worker, so events carry deltas rather
+    than a room snapshot:
+
+        "started": [{...profile, "typing_id": ...}]  connections that began typing
+        "stopped": [{"user_id": ..., "typing_id": ...}]  connections that stopped
+
+    typing_id identifies one connection (device), so a user typing on two
+    devices, possibly on different workers, has two entries. Clients show a
+    user as typing while any of their typing_ids is active.
+    """
+
+    def __init__(self):
+        self._typers = {}    # room_id -> {(user_id, typing_id): profile}
+        self._announced = {} # room_id -> {key: profile} as of the last broadcast
+        self._tasks = {}     # room_id -> pending broadcast task
+
+    @property
+    def interval(self):
+        return getattr(settings, "TYPING_BROADCAST_INTERVAL_SECONDS", 0.5)
+
+    def update(self, channel_layer, room_id, typing_id, profile, is_typing):
+        """Record a connection's typing change; schedules a room broadcast if the state moved."""
+        typers = self._typers.setdefault(room_id, {})
+        key = (profile["user_id"], typing_id)
+        if (key in typers) == is_typing:
+            return
+
+        if is_typing:
+            typers[key] = profile
+        else:
+            typers.pop(key, None)
+
+        task = self._tasks.get(room_id)
+        if task is None or task.done():
+            self._tasks[room_id] = asyncio.create_task(self._broadcast_later(channel_layer, room_id))
+
+    async def _broadcast_later(self, channel_layer, room_id):
+        await asyncio.sleep(self.interval)
+
+        self._tasks.pop(room_id, None)
+        typers = self._typers.get(room_id, {})
+        announced = self._announced.get(room_id, {})
+        # A start and stop inside one interval cancel out
+        started = [key for key in typers if key not in announced]
+        stopped = [key for key in announced if key not in typers]
+
+        if typers:
+            self._announced[room_id] = dict(typers)
+        else:
+            self._typers.pop(room_id, None)
+            self._announced.pop(room_id, None)
+        if not started and not stopped:
+            return
+
+        event = {
+            "type": "typing_indicator",
+            "room_id": room_id,
+            "started": [{**typers[key], "typing_id": key[1]} for key in started],
+            "stopped": [{"user_id": user_id, "typing_id": typing_id} for user_id, typing_id in stopped],
+            "timestamp": timezone.now().isoformat(),
+        }
+        if len(started) + len(stopped) == 1:
+            # Single change: keep the legacy per-user fields for older clients,
+            # unless the user is still typing on another connection here
+            user_id = (started or stopped)[0][0]
+            still_typing = any(uid == user_id for uid, _ in typers)
+            if started or not still_typing:
+                profile = typers[started[0]] if started else announced[stopped[0]]
+                event.update(profile)
+                event["is_typing"] = bool(started)
+
+        try:
+            await channel_layer.group_send(f"chat_{room_id}", event)
+        except Exception as e:
+            logger.error(f"Error broadcasting typing state for room {room_id}: {str(e)}")
+
+
+# Shared per-worker aggregator
+typing_aggregator = TypingAggregator()
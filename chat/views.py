@@ -2,97 +2,39 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
-from django.db.models import Q, Count, Max
-from django.db import models
+from django.db.models import Q, Count, Exists, Max, OuterRef
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from datetime import timedelta
+from datetime import datetime, timedelta
+import base64
+import binascii
 import json
-from .models import ChatRoom, Message, MessageReadStatus, ChatParticipant, Notification
+from .models import ChatRoom, Message, MessageReadStatus, ChatParticipant, Notification, NotificationCounter
 from accounts.models import User, BusinessInfo
 from referr.models import Referral, ReferralAssignment
 from .serializers import (
     ChatRoomSerializer, MessageSerializer, 
-    ChatRoomListSerializer, MessageCreateSerializer
+    ChatRoomListSerializer, MessageCreateSerializer,
+    serialize_message_payload, apply_viewer_read_state,
 )
-from django.db.models import Count, Q
 from utils.notify import notify_new_message
 
 from django.core.serializers.json import DjangoJSONEncoder
 
 from utils.storage_backends import generate_presigned_url
-from utils.push import send_push_notification_to_user 
+from utils.push_digest import queue_chat_push
 
 
-def serialize_message_with_read_state(msg, viewer, participants):
+def serialize_message_with_read_state(msg, viewer, participants, read_watermarks=None):
     """
     Serialize message with dual read perspectives:
     - is_read_by_me: for the viewer (recipient perspective)
     - read_by_*: for the sender (showing who else read their message)
     """
-    # Get participant user IDs (excluding sender)
-    participant_user_ids = set([p.id for p in participants])
-    
-    # Get users who read this message (excluding sender)
-    read_user_ids = set(msg.read_statuses.values_list("user_id", flat=True))
-    read_user_ids.discard(msg.sender_id)
-    
-    # For the viewer: is this message read by me?
-    is_read_by_me = (msg.sender_id == viewer.id) or msg.read_statuses.filter(user_id=viewer.id).exists()
-    
-    # For the sender: did others read it?
-    others_count = len(participant_user_ids - {msg.sender_id})
-    read_by_others_count = len(read_user_ids)
-    read_by_all_others = (others_count > 0 and read_by_others_count == others_count)
-    
-    # Get sender image URL
-    sender_image_url = (
-        generate_presigned_url(f"media/{msg.sender.image}", expires_in=3600)
-        if msg.sender.image else None
+    message_data = serialize_message_payload(
+        msg, [p.id for p in participants], read_watermarks=read_watermarks
     )
-    
-    # Base message data
-    message_data = {
-        "id": msg.id,
-        "room_id": msg.chat_room.room_id,
-        "sender": {
-            "id": msg.sender.id,
-            "name": msg.sender.full_name,
-            "role": msg.sender.role,
-            "image_url": sender_image_url,
-        },
-        "content": msg.content,
-        "message_type": msg.message_type,
-        "created_at": msg.created_at.isoformat(),
-        
-        # Viewer perspective
-        "is_read_by_me": is_read_by_me,
-        
-        # Sender perspective (for showing "others read" indicators)
-        "read_by_user_ids": list(read_user_ids),
-        "read_by_others_count": read_by_others_count,
-        "read_by_all_others": read_by_all_others,
-        
-        # Legacy field for backwards compatibility
-        "is_read": is_read_by_me,
-        "read_by": list(msg.read_statuses.values_list("user_id", flat=True))
-    }
-    
-    # Add file/attachment information for media messages
-    if msg.message_type in ['image', 'document', 'file']:
-        message_data.update({
-            "file_url": msg.get_file_url(),
-            "file_name": msg.file_name,
-            "file_size": msg.file_size,
-            "file_size_formatted": msg.file_size_formatted,
-            "file_type": msg.file_type,
-            "duration": msg.duration,
-            "thumbnail_url": msg.thumbnail_url,
-            "dimensions": msg.dimensions,
-            "attachments": msg.get_attachments_data()
-        })
-    
-    return message_data
+    return apply_viewer_read_state(message_data, viewer.id)
 
 
 class ChatRoomListView(APIView):
@@ -118,14 +60,8 @@ class ChatRoomListView(APIView):
         else:
             chat_rooms = ChatRoom.objects.none()
 
-
-        # Add unread message count and last message info
-        chat_rooms = chat_rooms.annotate(
-            unread_count=Count(
-                'messages',
-                filter=~Q(messages__sender=user) & ~Q(messages__read_statuses__user=user)
-            )
-        )
+        # Participant rows carry the read watermarks used by get_unread_count
+        chat_rooms = chat_rooms.prefetch_related("participants")
 
         # Custom response format
         rooms_data = [
@@ -191,13 +127,14 @@ class ChatRoomDetailView(APIView):
 
             messages = list(reversed(messages))  # oldest first
 
-            # Mark as read and send real-time updates
-            newly_marked_ids = self._mark_messages_as_read(messages, request.user)
-            if newly_marked_ids:
-                self._send_read_status_updates_for_detail_view(chat_room, newly_marked_ids, request.user)
+            # Advance the viewer's read watermark and send real-time updates
+            last_read_id = self._mark_messages_as_read(chat_room, messages, request.user)
+            if last_read_id:
+                self._send_read_status_updates_for_detail_view(chat_room, last_read_id, request.user)
 
             # Get participants for proper read state serialization
             participants = chat_room.get_participants()
+            read_watermarks = chat_room.get_read_watermarks()
 
             # Room info
             room_data = {
@@ -208,6 +145,7 @@ class ChatRoomDetailView(APIView):
                 "created_at": chat_room.created_at.isoformat(),
                 "updated_at": chat_room.updated_at.isoformat(),
                 "referral_id": chat_room.referral.reference_id if chat_room.referral else None,
+                "last_seq": chat_room.last_seq,
                 "image_url": (
                     generate_presigned_url(f"media/{chat_room.get_chat_image(request.user)}", expires_in=3600)
                     if chat_room.get_chat_image(request.user) else None
@@ -216,14 +154,11 @@ class ChatRoomDetailView(APIView):
 
             # Messages with dual read perspectives
             messages_data = [
-                serialize_message_with_read_state(msg, request.user, participants)
+                serialize_message_with_read_state(msg, request.user, participants, read_watermarks)
                 for msg in messages
             ]
 
 
-
-            
-
             return Response({
                 "success": True,
                 "chat_room": room_data,
@@ -243,30 +178,23 @@ class ChatRoomDetailView(APIView):
 
 
 
-    def _mark_messages_as_read(self, messages, user):
-        """Mark messages as read for the user and return newly marked message IDs"""
-        message_ids = [msg.id for msg in messages]
-        existing_reads = set(
-            MessageReadStatus.objects.filter(
-                message_id__in=message_ids, user=user
-            ).values_list("message_id", flat=True)
-        )
-
-        new_reads = []
-        newly_marked_ids = []
-        
-        for msg in messages:
-            if msg.id not in existing_reads and msg.sender != user:
-                new_reads.append(MessageReadStatus(message=msg, user=user))
-                newly_marked_ids.append(msg.id)
+    def _mark_messages_as_read(self, chat_room, messages, user):
+        """
+        Move the user's read watermark up to the newest message on the page
+        written by someone else. Returns the new watermark, or None if it
+        didn't move.
+        """
+        others = [msg.id for msg in messages if msg.sender_id != user.id]
+        if not others:
+            return None
 
-        if new_reads:
-            MessageReadStatus.objects.bulk_create(new_reads)
-            
-        return newly_marked_ids
+        last_read_id = max(others)
+        if ChatParticipant.advance_read_watermark(chat_room, user, last_read_id):
+            return last_read_id
+        return None
 
-    def _send_read_status_updates_for_detail_view(self, chat_room, message_ids, user):
-        """Send real-time read status updates when messages are read in detail view"""
+    def _send_read_status_updates_for_detail_view(self, chat_room, last_read_id, user):
+        """Broadcast the reader's new watermark when messages are read in detail view"""
         try:
             from asgiref.sync import async_to_sync
             from channels.layers import get_channel_layer
@@ -274,10 +202,9 @@ class ChatRoomDetailView(APIView):
             channel_layer = get_channel_layer()
             if not channel_layer:
                 return
-            
-            # Get the last (highest) message ID for efficient bulk updates
-            last_message_id = max(message_ids) if message_ids else None
-            
+
+            now = timezone.now().isoformat()
+
             # Send read status update to chat room
             async_to_sync(channel_layer.group_send)(
                 f"chat_{chat_room.room_id}",
@@ -286,57 +213,23 @@ class ChatRoomDetailView(APIView):
                     "room_id": chat_room.room_id,
                     "user_id": user.id,
                     "user_name": user.full_name,
-                    "message_ids": message_ids,
-                    "last_read_message_id": last_message_id,
-                    "read_at": timezone.now().isoformat(),
-                    "timestamp": timezone.now().isoformat(),
+                    "message_ids": [],
+                    "last_read_message_id": last_read_id,
+                    "watermark": True,
+                    "read_at": now,
+                    "timestamp": now,
                 }
             )
             
-            # Send chat list updates to all participants (unread count changed)
-            self._send_chat_list_updates_for_room(chat_room)
+            # Only the reader's unread count changed
+            async_to_sync(channel_layer.group_send)(
+                f"chat_list_{user.id}",
+                {"type": "chat_list_update", "room_ids": [chat_room.room_id], "timestamp": now}
+            )
             
         except Exception as e:
             print(f"Error sending read status updates in detail view: {str(e)}")
 
-    def _send_chat_list_updates_for_room(self, chat_room):
-        """Send chat list updates to all participants of a specific room"""
-        try:
-            from asgiref.sync import async_to_sync
-            from channels.layers import get_channel_layer
-            
-            channel_layer = get_channel_layer()
-            if not channel_layer:
-                return
-            
-            participants = chat_room.get_participants()
-            
-            for participant in participants:
-                # Create a proper mock request class
-                class MockRequest:
-                    def __init__(self, user):
-                        self.user = user
-                        self.META = {'HTTP_HOST': 'thereferralpro.com', 'wsgi.url_scheme': 'https'}
-
-                    def build_absolute_uri(self, location=None):
-                        base = "https://thereferralpro.com"
-                        return f"{base}{location}" if location else base
-
-                # Serialize the updated chat room list
-                mock_request = MockRequest(participant)
-                serialized = ChatRoomListSerializer(
-                    [chat_room], many=True, context={'request': mock_request}
-                ).data
-                payload = json.loads(json.dumps(serialized, cls=DjangoJSONEncoder))
-
-                async_to_sync(channel_layer.group_send)(
-                    f"chat_list_{participant.id}",
-                    {"type": "chat_list_update", "chat_rooms": payload}
-                )
-                
-        except Exception as e:
-            print(f"Error sending chat list updates for room: {str(e)}")
-
 
 
 from asgiref.sync import async_to_sync
@@ -509,6 +402,7 @@ class CreateChatRoomView(APIView):
             ))
         
         ChatParticipant.objects.bulk_create(participants, ignore_conflicts=True)
+        chat_room.broadcast_state_change()
 
     # def _send_chat_list_updates_for_new_room(self, chat_room):
     #     """Send chat list updates to all participants for a new room"""
@@ -566,13 +460,7 @@ class CreateChatRoomView(APIView):
         else:
             chat_rooms = ChatRoom.objects.none()
         
-        # Add unread message count and last message info
-        chat_rooms = chat_rooms.annotate(
-            unread_count=Count(
-                'messages', 
-                filter=~Q(messages__sender=user) & ~Q(messages__read_statuses__user=user)
-            )
-        ).select_related(
+        chat_rooms = chat_rooms.select_related(
             'solo_user', 'rep_user', 'company_user', 'referral'
         ).prefetch_related(
             'messages'
@@ -786,13 +674,7 @@ class SendMessageView(APIView):
         else:
             chat_rooms = ChatRoom.objects.none()
         
-        # Add unread message count and last message info
-        chat_rooms = chat_rooms.annotate(
-            unread_count=Count(
-                'messages', 
-                filter=~Q(messages__sender=user) & ~Q(messages__read_statuses__user=user)
-            )
-        ).select_related(
+        chat_rooms = chat_rooms.select_related(
             'solo_user', 'rep_user', 'company_user', 'referral'
         ).prefetch_related(
             'messages'
@@ -801,7 +683,7 @@ class SendMessageView(APIView):
         return chat_rooms
 
     def _send_push_notifications_to_participants(self, chat_room, message, sender):
-        """Send push notifications to all participants except the sender"""
+        """Queue a digested push for all participants except the sender"""
         try:
             participants = chat_room.get_participants()
             
@@ -837,34 +719,17 @@ class SendMessageView(APIView):
                 'timestamp': str(message.created_at.isoformat())
             }
             
-            # Send to each participant except the sender
-            # notification_results = []
-            for participant in participants:
-                if participant.id != sender.id:
-                    try:
-                        result = send_push_notification_to_user(
-                            user=participant,
-                            title=f"New message from {sender_name}",
-                            body=notification_body,
-                            data=notification_data
-                        )
-                        
-                        # notification_results.append({
-                        #     'user_id': participant.id,
-                        #     'result': result
-                        # })
-                        
-                        if result.get('error'):
-                            print(f"❌ Failed to send push notification to user {participant.id}: {result['error']}")
-                        else:
-                            print(f"✅ Push notification sent successfully to user {participant.id} - {result.get('success', 0)} devices")
-                            
-                    except Exception as individual_push_error:
-                        print(f"❌ Error sending push notification to user {participant.id}: {individual_push_error}")
-                        # notification_results.append({
-                        #     'user_id': participant.id,
-                        #     'result': {'error': str(individual_push_error)}
-                        # })
+            # Held briefly and merged with the room's other new messages (utils.push_digest)
+            recipient_ids = [p.id for p in participants if p.id != sender.id]
+            if recipient_ids:
+                queue_chat_push(
+                    str(chat_room.room_id),
+                    sender.id,
+                    sender_name,
+                    recipient_ids,
+                    notification_body,
+                    notification_data,
+                )
 
             return None
                         
@@ -909,13 +774,21 @@ class ChatAnalyticsView(APIView):
             created_at__gte=thirty_days_ago
         ).count()
         
-        # Unread messages
+        # Unread messages: not the user's own, not covered by their room read
+        # watermark and without a legacy per-message read row
+        covered_by_watermark = ChatParticipant.objects.filter(
+            chat_room_id=OuterRef('chat_room_id'),
+            user=user,
+            last_read_message_id__gte=OuterRef('id'),
+        )
         unread_messages = Message.objects.filter(
             chat_room__in=chat_rooms
         ).exclude(
             read_statuses__user=user
         ).exclude(
             sender=user
+        ).exclude(
+            Exists(covered_by_watermark)
         ).count()
         
         # Active conversations (had activity in last 7 days)
@@ -1091,13 +964,7 @@ class MarkMessagesReadView(APIView):
         else:
             chat_rooms = ChatRoom.objects.none()
         
-        # Add unread message count and last message info
-        chat_rooms = chat_rooms.annotate(
-            unread_count=Count(
-                'messages', 
-                filter=~Q(messages__sender=user) & ~Q(messages__read_statuses__user=user)
-            )
-        ).select_related(
+        chat_rooms = chat_rooms.select_related(
             'solo_user', 'rep_user', 'company_user', 'referral'
         ).prefetch_related(
             'messages'
@@ -1251,6 +1118,7 @@ class UpdateChatRoomView(APIView):
             if is_active is not None:
                 chat_room.is_active = is_active
                 chat_room.save()
+                chat_room.broadcast_state_change()
             
             serializer = ChatRoomSerializer(chat_room, context={'request': request})
             
@@ -1267,9 +1135,32 @@ class UpdateChatRoomView(APIView):
             }, status=status.HTTP_404_NOT_FOUND)
 
 
+def encode_notification_cursor(notification):
+    """Opaque cursor pointing just past `notification` in (-created_at, id) order"""
+    raw = json.dumps({'t': notification.created_at.isoformat(), 'id': notification.id})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_notification_cursor(cursor):
+    """(created_at, id) from a cursor; raises ValueError if it's malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        created_at = datetime.fromisoformat(data['t'])
+        return created_at, int(data['id'])
+    except (TypeError, KeyError, binascii.Error, json.JSONDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {str(e)}")
+
+
 class NotificationListView(APIView):
     """
     List notifications for the authenticated user
+
+    Keyset pagination: pass `cursor` from the previous page's
+    pagination.next_cursor. Rows are ordered (-created_at, id), the order of
+    the (user, -created_at) index, so every page is an index range scan and
+    new notifications don't shift later pages. `page` still works for old
+    clients but is an OFFSET scan.
     """
     permission_classes = [IsAuthenticated]
     
@@ -1278,9 +1169,10 @@ class NotificationListView(APIView):
         user = request.user
         
         # Pagination
+        cursor = request.GET.get('cursor')
         page = int(request.GET.get('page', 1))
-        page_size = int(request.GET.get('page_size', 20))
-        offset = (page - 1) * page_size
+        page_size = min(max(int(request.GET.get('page_size', 20)), 1), 100)
+        offset = 0 if cursor else (page - 1) * page_size
         
         # Filter options
         unread_only = request.GET.get('unread_only', 'false').lower() == 'true'
@@ -1298,12 +1190,26 @@ class NotificationListView(APIView):
         if event_type:
             notifications = notifications.filter(event_type=event_type)
         
-        # Get total count before pagination
-        total_count = notifications.count()
-        unread_count = user.notifications.filter(is_read=False).count()
+        # Counts come from the materialized counters, not COUNT(*)
+        (total_all, unread_count), filtered = NotificationCounter.counts_for(user, event_type)
+        total_count, unread_for_filter = filtered if filtered else (total_all, unread_count)
+        if unread_only:
+            total_count = unread_for_filter
+        
+        notifications = notifications.order_by('-created_at', 'id')
+        if cursor:
+            try:
+                cursor_created_at, cursor_id = decode_notification_cursor(cursor)
+            except ValueError as e:
+                return Response({'success': False, 'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            notifications = notifications.filter(
+                Q(created_at__lt=cursor_created_at) | Q(created_at=cursor_created_at, id__gt=cursor_id)
+            )
         
-        # Apply pagination
-        notifications = notifications[offset:offset + page_size]
+        # One extra row answers has_more without counting
+        notifications = list(notifications[offset:offset + page_size + 1])
+        has_more = len(notifications) > page_size
+        notifications = notifications[:page_size]
         
         # Serialize notifications
         notifications_data = []
@@ -1335,7 +1241,8 @@ class NotificationListView(APIView):
                 'page_size': page_size,
                 'total_count': total_count,
                 'unread_count': unread_count,
-                'has_more': len(notifications) == page_size
+                'has_more': has_more,
+                'next_cursor': encode_notification_cursor(notifications[-1]) if has_more else None,
             }
         }, status=status.HTTP_200_OK)
 
@@ -1358,11 +1265,7 @@ class MarkNotificationReadView(APIView):
             
             if mark_all:
                 # Mark all unread notifications as read
-                updated_count = user.notifications.filter(is_read=False).update(
-                    is_read=True,
-                    read_at=timezone.now(),
-                    updated_at=timezone.now()
-                )
+                updated_count, _ = Notification.mark_read_for_user(user)
                 
                 return Response({
                     'success': True,
@@ -1380,31 +1283,21 @@ class MarkNotificationReadView(APIView):
                     'error': 'No notification IDs provided'
                 }, status=status.HTTP_400_BAD_REQUEST)
             
-            # Get notifications that belong to the current user
-            notifications = user.notifications.filter(
-                id__in=notification_ids,
-                is_read=False
-            )
+            # Mark the user's own unread ones as read (counters move with them)
+            updated_count, marked_ids = Notification.mark_read_for_user(user, notification_ids)
             
-            if not notifications.exists():
+            if not updated_count:
                 return Response({
                     'success': True,
                     'message': 'No unread notifications found to mark',
                     'marked_count': 0
                 }, status=status.HTTP_200_OK)
             
-            # Mark as read
-            updated_count = notifications.update(
-                is_read=True,
-                read_at=timezone.now(),
-                updated_at=timezone.now()
-            )
-            
             return Response({
                 'success': True,
                 'message': f'Marked {updated_count} notifications as read',
                 'marked_count': updated_count,
-                'marked_notification_ids': list(notifications.values_list('id', flat=True))
+                'marked_notification_ids': marked_ids
             }, status=status.HTTP_200_OK)
             
         except Exception as e:
@@ -1424,16 +1317,19 @@ class NotificationStatsView(APIView):
         """Get notification stats for the current user"""
         user = request.user
         
-        # Get stats by event type
-        from django.db.models import Count
-        stats_by_type = user.notifications.values('event_type').annotate(
-            total=Count('id'),
-            unread=Count('id', filter=models.Q(is_read=False))
-        ).order_by('event_type')
-        
-        # Overall stats
-        total_notifications = user.notifications.count()
-        unread_notifications = user.notifications.filter(is_read=False).count()
+        # Overall and per-type stats: the user's counter rows, one query
+        counters = NotificationCounter.objects.filter(user=user).order_by('event_type')
+        total_notifications = unread_notifications = 0
+        stats_by_type = []
+        for counter in counters:
+            if counter.event_type == NotificationCounter.ALL:
+                total_notifications, unread_notifications = counter.total, counter.unread
+            elif counter.total:
+                stats_by_type.append({
+                    'event_type': counter.event_type,
+                    'total': counter.total,
+                    'unread': counter.unread,
+                })
         
         # Recent activity (last 7 days)
         from datetime import timedelta
@@ -1448,7 +1344,7 @@ class NotificationStatsView(APIView):
                 'total_notifications': total_notifications,
                 'unread_notifications': unread_notifications,
                 'recent_notifications_7_days': recent_notifications,
-                'stats_by_type': list(stats_by_type)
+                'stats_by_type': stats_by_type
             }
         }, status=status.HTTP_200_OK)
 
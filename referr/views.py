@@ -18,12 +18,11 @@ from .models import Referral, ReferralAssignment, ReferralReward
 from accounts.models import User, BusinessInfo, FavoriteCompany, Review, ReviewImage
 
 # utils
-from utils.email_service import send_app_download_email, send_referral_email
-from utils.twilio_service import TwilioService
 from utils.storage_backends import generate_presigned_url
 from utils.notify import notify_users
 from utils.activity import log_activity
 from utils.push import send_push_notification_to_user
+from utils.tasks import notify_users_task, send_email_task, send_push_task, send_sms_task
 
 
 
@@ -565,24 +564,25 @@ class SendReferralView(APIView):
 
 
             notification_body = f"Received referral for {referred_to_user.full_name} from {request.user.full_name}"
-            send_push_notification_to_user(
-                user=referral.company,
-                title=f"New Referral from {company.company_name if company.company_name else COMPANY.full_name}",
-                body=notification_body,
-                data=notification_data
+            send_push_task.delay_on_commit(
+                referral.company_id,
+                f"New Referral from {company.company_name if company.company_name else COMPANY.full_name}",
+                notification_body,
+                notification_data,
             )
 
             notification_body = f"{request.user.full_name} has referred you to {company.company_name if company.company_name else COMPANY.full_name}"
-            send_push_notification_to_user(
-                user=referral.referred_to,
-                title=f"New Referral to {request.user.full_name}",
-                body=notification_body,
-                data=notification_data
+            send_push_task.delay_on_commit(
+                referral.referred_to_id,
+                f"New Referral to {request.user.full_name}",
+                notification_body,
+                notification_data,
             )
 
             print(f"Referral created with ID: {referral.id} and Reference ID: {referral.reference_id}")
 
-            send_referral_email(
+            send_email_task.delay_on_commit(
+                "send_referral_email",
                 referred_to_email=referred_to_email,
                 referred_to_name=referred_to_name,
                 company_name=company.company_name if company.company_name else COMPANY.full_name,  
@@ -593,7 +593,8 @@ class SendReferralView(APIView):
             )
 
             if referred_to_phone:
-                TwilioService.send_referral_sms(
+                send_sms_task.delay_on_commit(
+                    "send_referral_sms",
                     phone_number=referred_to_phone,
                     referred_to_name=referred_to_name,
                     company_name=company.company_name if company.company_name else COMPANY.full_name,
@@ -645,8 +646,8 @@ class SendReferralView(APIView):
             }
 
             # Send different notifications to different users
-            notify_users([referred_to_user.id], payload_referred_to)
-            notify_users([COMPANY.id], payload_company)
+            notify_users_task.delay_on_commit([referred_to_user.id], payload_referred_to)
+            notify_users_task.delay_on_commit([COMPANY.id], payload_company)
 
 
             return Response(
@@ -756,11 +757,11 @@ class AssignRepView(APIView):
                 notification_data = {}
 
                 notification_body = f"you have been assigned to referral #{referral_obj.reference_id}"
-                send_push_notification_to_user(
-                    user=employee,
-                    title=f"New Referral Assigned #{referral_obj.reference_id}",
-                    body=notification_body,
-                    data=notification_data
+                send_push_task.delay_on_commit(
+                    employee.id,
+                    f"New Referral Assigned #{referral_obj.reference_id}",
+                    notification_body,
+                    notification_data,
                 )
 
             try:
@@ -815,8 +816,8 @@ class AssignRepView(APIView):
                 }
 
                 # Send notifications separately
-                notify_users([referral_obj.referred_by.id], payload_referred_by)
-                notify_users([referral_obj.referred_to.id], payload_referred_to)
+                notify_users_task.delay_on_commit([referral_obj.referred_by.id], payload_referred_by)
+                notify_users_task.delay_on_commit([referral_obj.referred_to.id], payload_referred_to)
 
             # Payload for employee - assigned to referral
             payload_employee = {
@@ -840,7 +841,7 @@ class AssignRepView(APIView):
             }
 
             if employee:
-                notify_users([employee.id], payload_employee)
+                notify_users_task.delay_on_commit([employee.id], payload_employee)
 
             return Response(
                 {
@@ -1483,23 +1484,23 @@ class SendAcceptView(APIView):
         try:
 
             notification_body = f"{referral.referred_to.full_name} accepted the referral #{referral.reference_id}"
-            send_push_notification_to_user(
-                user=referral.company,
-                title=f"Referral Accepted #{referral.reference_id}",
-                body=notification_body,
-                data=notification_data
+            send_push_task.delay_on_commit(
+                referral.company_id,
+                f"Referral Accepted #{referral.reference_id}",
+                notification_body,
+                notification_data,
             )
 
             notification_body = f"{referral.referred_to.full_name} accepted the referral #{referral.reference_id}"
-            send_push_notification_to_user(
-                user=referral.referred_by,
-                title=f"Referral Accepted #{referral.reference_id}",
-                body=notification_body,
-                data=notification_data
+            send_push_task.delay_on_commit(
+                referral.referred_by_id,
+                f"Referral Accepted #{referral.reference_id}",
+                notification_body,
+                notification_data,
             )
 
         except Exception as e:
-            print(f"Error sending push notification: {str(e)}")
+            print(f"Error queueing push notification: {str(e)}")
         print(f"Referral {referral.id} accepted by {referral.referred_to.full_name}")
 
 
@@ -1525,7 +1526,7 @@ class SendAcceptView(APIView):
             }
         }
 
-        notify_users([referral.referred_by.id, referral.company.id], payload)
+        notify_users_task.delay_on_commit([referral.referred_by.id, referral.company.id], payload)
 
 
 
@@ -1900,7 +1901,8 @@ class SendAppInvitationView(APIView):
             sender_name = request.user.full_name or request.user.email
             
             # Send the app download invitation email
-            send_app_download_email(
+            send_email_task.delay_on_commit(
+                "send_app_download_email",
                 email=email,
                 name=name,
                 sender_name=sender_name
@@ -1908,7 +1910,8 @@ class SendAppInvitationView(APIView):
 
             if phone:
                 print(f"Sending app download SMS to {phone}")
-                TwilioService.send_app_download_sms(
+                send_sms_task.delay_on_commit(
+                    "send_app_download_sms",
                     phone_number=phone,
                     name=name,
                     sender_name=sender_name
@@ -8,15 +8,13 @@ django.setup()
 
 # Import channels and other Django-dependent modules after setup
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 from chat.middleware import TokenAuthMiddleware
 import chat.routing
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
+    # JWT auth only; session/cookie auth isn't used by the apps
     "websocket": TokenAuthMiddleware(
-        AuthMiddlewareStack(
-            URLRouter(chat.routing.websocket_urlpatterns)
-        )
+        URLRouter(chat.routing.websocket_urlpatterns)
     ),
 })
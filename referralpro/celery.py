@@ -0,0 +1,13 @@
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'referralpro.settings')
+
+app = Celery('referralpro')
+
+# All CELERY_* settings in referralpro/settings.py configure the app
+app.config_from_object('django.conf:settings', namespace='CELERY')
+
+# tasks.py in every installed app; utils/ isn't an app, see CELERY_IMPORTS
+app.autodiscover_tasks()
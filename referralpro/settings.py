@@ -4,6 +4,7 @@ Django settings for referralpro project.
 
 from pathlib import Path
 import os
+import sys
 from dotenv import load_dotenv
 
 # Load .env file
@@ -16,6 +17,8 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # -------------------------
 SECRET_KEY = os.getenv("SECRET_KEY", "django-insecure-placeholder")
 DEBUG = os.getenv("DEBUG", "True").lower() == "true"
+# `manage.py test` runs with DEBUG off; lets dev-only fallbacks stay on
+TESTING = len(sys.argv) > 1 and sys.argv[1] == "test"
 ALLOWED_HOSTS = ['*']
 
 # -------------------------
@@ -148,8 +151,79 @@ REDIS_HOST = os.getenv("REDIS_HOST", "127.0.0.1")
 REDIS_PORT = os.getenv("REDIS_PORT", "6379")
 REDIS_DB = os.getenv("REDIS_DB", "0")
 
-CELERY_BROKER_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}"
-CELERY_RESULT_BACKEND = CELERY_BROKER_URL
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", f"redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}")
+CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", CELERY_BROKER_URL)
+
+# Side-effect tasks live in utils/, which isn't an installed app
+CELERY_IMPORTS = ("utils.tasks",)
+CELERY_TASK_SERIALIZER = "json"
+CELERY_ACCEPT_CONTENT = ["json"]
+# Nobody reads task results; don't write them
+CELERY_TASK_IGNORE_RESULT = True
+# Ack after the task runs so a crashed worker's tasks are redelivered
+CELERY_TASK_ACKS_LATE = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# Tests/dev: CELERY_TASK_ALWAYS_EAGER=True runs tasks inline,
+# or CELERY_BROKER_URL=memory:// keeps a real queue in process
+CELERY_TASK_ALWAYS_EAGER = os.getenv("CELERY_TASK_ALWAYS_EAGER", "False") == "True"
+CELERY_TASK_EAGER_PROPAGATES = CELERY_TASK_ALWAYS_EAGER
+
+# One queue per channel so a slow SMTP server can't hold up pushes.
+# Run e.g. `celery -A referralpro worker -Q default,notifications,push,email,sms`
+CELERY_TASK_DEFAULT_QUEUE = "default"
+CELERY_TASK_ROUTES = {
+    "utils.tasks.notify_users": {"queue": "notifications"},
+    "utils.tasks.run_broadcast": {"queue": "notifications"},
+    "utils.tasks.send_push": {"queue": "push"},
+    "utils.tasks.flush_chat_push_digest": {"queue": "push"},
+    "utils.tasks.send_email": {"queue": "email"},
+    "utils.tasks.send_invitation": {"queue": "email"},
+    "utils.tasks.send_sms": {"queue": "sms"},
+}
+# Priorities within a queue (0 = highest on Redis); OTPs jump the line
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    "priority_steps": list(range(10)),
+    "sep": ":",
+    "queue_order_strategy": "priority",
+    "visibility_timeout": 3600,
+}
+CELERY_TASK_DEFAULT_PRIORITY = 5
+TASK_PRIORITY_HIGH = 0
+TASK_PRIORITY_LOW = 9
+
+# Retry caps per channel (backoff doubles from 1s up to the max, with jitter)
+NOTIFY_TASK_MAX_RETRIES = int(os.getenv("NOTIFY_TASK_MAX_RETRIES", "5"))
+NOTIFY_TASK_RETRY_BACKOFF_MAX = int(os.getenv("NOTIFY_TASK_RETRY_BACKOFF_MAX", "60"))
+PUSH_TASK_MAX_RETRIES = int(os.getenv("PUSH_TASK_MAX_RETRIES", "5"))
+PUSH_TASK_RETRY_BACKOFF_MAX = int(os.getenv("PUSH_TASK_RETRY_BACKOFF_MAX", "120"))
+EMAIL_TASK_MAX_RETRIES = int(os.getenv("EMAIL_TASK_MAX_RETRIES", "6"))
+EMAIL_TASK_RETRY_BACKOFF_MAX = int(os.getenv("EMAIL_TASK_RETRY_BACKOFF_MAX", "600"))
+SMS_TASK_MAX_RETRIES = int(os.getenv("SMS_TASK_MAX_RETRIES", "4"))
+SMS_TASK_RETRY_BACKOFF_MAX = int(os.getenv("SMS_TASK_RETRY_BACKOFF_MAX", "300"))
+
+# Shared cache (presence, WebSocket auth, snowflake id leases, push digests,
+# SMS limits). Defaults to the broker's Redis in its own database, like
+# CELERY_BROKER_URL; CACHE_URL= (empty) falls back to per-process memory,
+# which features that must be shared across processes (utils.shared_cache)
+# refuse outside DEBUG/tests. Tests always run on per-process memory.
+REDIS_CACHE_DB = os.getenv("REDIS_CACHE_DB", "1")
+CACHE_URL = "" if TESTING else os.getenv("CACHE_URL", f"redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_CACHE_DB}")
+SHARED_CACHE = bool(CACHE_URL)
+if CACHE_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CACHE_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "OPTIONS": {"MAX_ENTRIES": 10000},
+        }
+    }
 
 # -------------------------
 # AWS S3 Configuration - CORRECTED
@@ -201,6 +275,14 @@ EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER", "")
 EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD", "")
 EMAIL_USE_TLS = os.getenv("EMAIL_USE_TLS", "True").lower() == "true"
 DEFAULT_FROM_EMAIL = os.getenv("DEFAULT_FROM_EMAIL", EMAIL_HOST_USER)
+# Don't let a hung SMTP server block a worker forever
+EMAIL_TIMEOUT = int(os.getenv("EMAIL_TIMEOUT", "10"))
+# utils.email_service keeps up to EMAIL_POOL_SIZE open connections per process,
+# each reused for EMAIL_CONNECTION_MAX_MESSAGES sends or until idle too long.
+# Tests: EMAIL_BACKEND=django.core.mail.backends.locmem.EmailBackend
+EMAIL_POOL_SIZE = int(os.getenv("EMAIL_POOL_SIZE", "4"))
+EMAIL_CONNECTION_MAX_MESSAGES = int(os.getenv("EMAIL_CONNECTION_MAX_MESSAGES", "100"))
+EMAIL_CONNECTION_MAX_IDLE_SECONDS = int(os.getenv("EMAIL_CONNECTION_MAX_IDLE_SECONDS", "60"))
 
 # -------------------------
 # Twilio
@@ -208,6 +290,15 @@ DEFAULT_FROM_EMAIL = os.getenv("DEFAULT_FROM_EMAIL", EMAIL_HOST_USER)
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_PHONE_NUMBER = os.getenv("TWILIO_PHONE_NUMBER")
+TWILIO_TIMEOUT_SECONDS = int(os.getenv("TWILIO_TIMEOUT_SECONDS", "10"))
+# Send rates across all workers (utils.rate_limit); a long code sends 1 message/second.
+# Rate limits and the dedupe window live in the cache and need CACHE_URL outside DEBUG.
+TWILIO_NUMBER_SMS_PER_SECOND = float(os.getenv("TWILIO_NUMBER_SMS_PER_SECOND", "1"))
+TWILIO_ACCOUNT_SMS_PER_SECOND = float(os.getenv("TWILIO_ACCOUNT_SMS_PER_SECOND", "10"))
+# The same text to the same number within this window is sent once
+TWILIO_SMS_DEDUPE_SECONDS = int(os.getenv("TWILIO_SMS_DEDUPE_SECONDS", "300"))
+# Public URL of accounts' twilio_status/ endpoint; empty = no delivery reports
+TWILIO_STATUS_CALLBACK_URL = os.getenv("TWILIO_STATUS_CALLBACK_URL", "")
 
 # -------------------------
 # Stripe / PayPal
@@ -258,6 +349,13 @@ USE_I18N = True
 USE_TZ = True
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Snowflake ids (utils.ids) for high-volume tables: every process leases a
+# free worker id 0-63 from the shared cache for this long (renewed while in
+# use). SNOWFLAKE_WORKER_ID pins one instead; only for single-process setups.
+SNOWFLAKE_WORKER_ID = os.getenv("SNOWFLAKE_WORKER_ID")
+SNOWFLAKE_LEASE_SECONDS = int(os.getenv("SNOWFLAKE_LEASE_SECONDS", "600"))
+
 ASGI_APPLICATION = "referralpro.asgi.application"
 
 # Temporary: in-memory layer (works for local dev)
@@ -267,6 +365,134 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Presence: each worker refreshes a connected user's shared key within the TTL,
+# so a crashed worker's users go offline after at most PRESENCE_TTL_SECONDS;
+# Device.is_online / last_seen are written in batches every flush interval.
+PRESENCE_TTL_SECONDS = int(os.getenv("PRESENCE_TTL_SECONDS", "300"))
+PRESENCE_FLUSH_INTERVAL_SECONDS = int(os.getenv("PRESENCE_FLUSH_INTERVAL_SECONDS", "15"))
+
+# Read receipts: at most one watermark write/broadcast per connection per interval
+READ_RECEIPT_THROTTLE_SECONDS = float(os.getenv("READ_RECEIPT_THROTTLE_SECONDS", "1.0"))
+
+# Chat pushes in a room are held this long and merged into one digest (0 = send immediately).
+# Pending digests live in the shared cache; without one (CACHE_URL empty outside
+# DEBUG) pushes go out immediately.
+PUSH_DIGEST_WINDOW_SECONDS = int(os.getenv("PUSH_DIGEST_WINDOW_SECONDS", "5"))
+PUSH_DIGEST_MAX_MESSAGES = int(os.getenv("PUSH_DIGEST_MAX_MESSAGES", "50"))
+
+# Direct APNs (utils.apns) instead of FCM for iOS devices that registered a native APNs token.
+# Token auth with the bundled .p8 key; APNS_BASE_URL overrides the Apple host (e.g. a local HTTP/2 stand-in).
+APNS_ENABLED = os.getenv("APNS_ENABLED", "False") == "True"
+APNS_KEY_PATH = os.getenv("APNS_KEY_PATH", os.path.join(BASE_DIR, "AuthKey_7K3666385D.p8"))
+APNS_KEY_ID = os.getenv("APNS_KEY_ID", "7K3666385D")
+APNS_TEAM_ID = os.getenv("APNS_TEAM_ID", "")
+APNS_TOPIC = os.getenv("APNS_TOPIC", "")  # iOS bundle id
+APNS_USE_SANDBOX = os.getenv("APNS_USE_SANDBOX", "False") == "True"
+APNS_BASE_URL = os.getenv("APNS_BASE_URL", "")
+APNS_VERIFY_TLS = os.getenv("APNS_VERIFY_TLS", "True") == "True"
+APNS_TIMEOUT_SECONDS = float(os.getenv("APNS_TIMEOUT_SECONDS", "10"))
+# Concurrent streams multiplexed on the shared HTTP/2 connection
+APNS_MAX_CONCURRENT_STREAMS = int(os.getenv("APNS_MAX_CONCURRENT_STREAMS", "100"))
+# Apple allows reuse for up to 60 minutes and throttles refreshing more often than every 20
+APNS_TOKEN_REFRESH_SECONDS = int(os.getenv("APNS_TOKEN_REFRESH_SECONDS", "3000"))
+
+# Typing indicators: keystroke frames closer than the min interval are dropped
+# per connection; each room broadcasts at most once per broadcast interval.
+TYPING_MIN_INTERVAL_SECONDS = float(os.getenv("TYPING_MIN_INTERVAL_SECONDS", "0.3"))
+TYPING_BROADCAST_INTERVAL_SECONDS = float(os.getenv("TYPING_BROADCAST_INTERVAL_SECONDS", "0.5"))
+
+# Multiplexed socket (api/ws/): max topics a single connection may subscribe to
+MULTIPLEX_MAX_TOPICS = int(os.getenv("MULTIPLEX_MAX_TOPICS", "50"))
+
+# WebSocket subprotocols json / msgpack / *.deflate: frames at least this big
+# are zlib-compressed when a ".deflate" subprotocol was negotiated
+WS_DEFLATE_THRESHOLD_BYTES = int(os.getenv("WS_DEFLATE_THRESHOLD_BYTES", "1024"))
+WS_DEFLATE_LEVEL = int(os.getenv("WS_DEFLATE_LEVEL", "6"))
+
+# Resume/replay: per-room in-memory buffer of recent messages per worker;
+# gaps larger than RESUME_MAX_MESSAGES make the client reload over REST.
+REPLAY_BUFFER_SIZE = int(os.getenv("REPLAY_BUFFER_SIZE", "200"))
+REPLAY_BUFFER_MAX_ROOMS = int(os.getenv("REPLAY_BUFFER_MAX_ROOMS", "1000"))
+RESUME_MAX_MESSAGES = int(os.getenv("RESUME_MAX_MESSAGES", "500"))
+
+# Per-connection outbound queues: past the soft limit typing/presence frames
+# are dropped; past the hard limit the client is disconnected (code 4008).
+# Queued frames of the coalesce types are merged instead of piling up.
+WS_OUTBOUND_SOFT_MAX_MESSAGES = int(os.getenv("WS_OUTBOUND_SOFT_MAX_MESSAGES", "100"))
+WS_OUTBOUND_SOFT_MAX_BYTES = int(os.getenv("WS_OUTBOUND_SOFT_MAX_BYTES", str(512 * 1024)))
+WS_OUTBOUND_HARD_MAX_MESSAGES = int(os.getenv("WS_OUTBOUND_HARD_MAX_MESSAGES", "1000"))
+WS_OUTBOUND_HARD_MAX_BYTES = int(os.getenv("WS_OUTBOUND_HARD_MAX_BYTES", str(4 * 1024 * 1024)))
+WS_OUTBOUND_DROP_TYPES = os.getenv("WS_OUTBOUND_DROP_TYPES", "typing,typing_indicator,user_joined,user_left")
+WS_OUTBOUND_COALESCE_TYPES = os.getenv("WS_OUTBOUND_COALESCE_TYPES", "chat_list_update")
+
+# Heartbeats and admission: the server sends an app-level ping every interval.
+# With WS_IDLE_TIMEOUT_SECONDS > 0 it also closes sockets that sent no frame for
+# that long (4408); off by default because older clients never answer pings
+# (dead TCP connections are still dropped by daphne's protocol-level pings).
+# Sockets over the per-user (4429) or per-worker (4503) caps are accepted and
+# closed immediately.
+WS_PING_INTERVAL_SECONDS = int(os.getenv("WS_PING_INTERVAL_SECONDS", "25"))
+WS_IDLE_TIMEOUT_SECONDS = int(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "0"))
+WS_MAX_CONNECTIONS_PER_USER = int(os.getenv("WS_MAX_CONNECTIONS_PER_USER", "10"))
+WS_MAX_CONNECTIONS_PER_WORKER = int(os.getenv("WS_MAX_CONNECTIONS_PER_WORKER", "5000"))
+
+# WebSocket auth: verified tokens are cached until they expire; user snapshots
+# for this long (dropped on every User save)
+WS_AUTH_USER_CACHE_SECONDS = int(os.getenv("WS_AUTH_USER_CACHE_SECONDS", "60"))
+
+# Notification socket catch-up: rows newer than ?last_notification_id= are
+# replayed in batches; past the max the client reloads over REST.
+NOTIFICATION_REPLAY_BATCH_SIZE = int(os.getenv("NOTIFICATION_REPLAY_BATCH_SIZE", "100"))
+NOTIFICATION_REPLAY_MAX = int(os.getenv("NOTIFICATION_REPLAY_MAX", "1000"))
+
+# Notification counters (chat.NotificationCounter) are rebuilt from the
+# Notification table on this schedule to fix any drift
+NOTIFICATION_COUNTER_RECONCILE_SECONDS = int(os.getenv("NOTIFICATION_COUNTER_RECONCILE_SECONDS", "3600"))
+NOTIFICATION_COUNTER_RECONCILE_BATCH_SIZE = int(os.getenv("NOTIFICATION_COUNTER_RECONCILE_BATCH_SIZE", "500"))
+
+# Broadcasts (utils.broadcast): recipients per chunk/transaction, and how long
+# a running broadcast may go without progress before beat re-queues it. A
+# failed broadcast is re-queued by the same beat job, at most
+# BROADCAST_MAX_RETRIES times, once it has been failed that long.
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "500"))
+BROADCAST_STALL_SECONDS = int(os.getenv("BROADCAST_STALL_SECONDS", "600"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+
+# Retention (utils.retention): rows older than these are pruned; 0 keeps forever
+RETENTION_NOTIFICATION_READ_DAYS = int(os.getenv("RETENTION_NOTIFICATION_READ_DAYS", "90"))
+RETENTION_NOTIFICATION_UNREAD_DAYS = int(os.getenv("RETENTION_NOTIFICATION_UNREAD_DAYS", "365"))
+RETENTION_OTP_GRACE_HOURS = int(os.getenv("RETENTION_OTP_GRACE_HOURS", "24"))
+RETENTION_EVENT_AUDIT_DAYS = int(os.getenv("RETENTION_EVENT_AUDIT_DAYS", "90"))
+RETENTION_READ_STATUS_DAYS = int(os.getenv("RETENTION_READ_STATUS_DAYS", "30"))
+RETENTION_ACTIVITY_LOG_DAYS = int(os.getenv("RETENTION_ACTIVITY_LOG_DAYS", "730"))
+RETENTION_SMS_MESSAGE_DAYS = int(os.getenv("RETENTION_SMS_MESSAGE_DAYS", "90"))
+# Rows per DELETE transaction; after each batch sleep ratio x batch time (at least the min)
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "1000"))
+RETENTION_SLEEP_RATIO = float(os.getenv("RETENTION_SLEEP_RATIO", "1.0"))
+RETENTION_MIN_SLEEP_SECONDS = float(os.getenv("RETENTION_MIN_SLEEP_SECONDS", "0.05"))
+# Time budget per run; the next run continues where this one stopped
+RETENTION_MAX_SECONDS_PER_RUN = int(os.getenv("RETENTION_MAX_SECONDS_PER_RUN", "900"))
+RETENTION_RUN_EVERY_SECONDS = int(os.getenv("RETENTION_RUN_EVERY_SECONDS", "3600"))
+
+# Periodic tasks (run `celery -A referralpro beat`)
+CELERY_BEAT_SCHEDULE = {
+    "reconcile-notification-counters": {
+        "task": "chat.tasks.reconcile_notification_counters",
+        "schedule": NOTIFICATION_COUNTER_RECONCILE_SECONDS,
+        "options": {"priority": TASK_PRIORITY_LOW},
+    },
+    "run-retention": {
+        "task": "utils.tasks.run_retention",
+        "schedule": RETENTION_RUN_EVERY_SECONDS,
+        "options": {"priority": TASK_PRIORITY_LOW, "expires": RETENTION_RUN_EVERY_SECONDS},
+    },
+    "resume-stalled-broadcasts": {
+        "task": "utils.tasks.resume_stalled_broadcasts",
+        "schedule": BROADCAST_STALL_SECONDS,
+        "options": {"priority": TASK_PRIORITY_LOW},
+    },
+}
+
 
 
 REFERRALPRO_ANDROID_URL = "https://play.google.com/store/apps/details?id=com.referralpro.app"
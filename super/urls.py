@@ -1,7 +1,9 @@
 from django.urls import path
-from .views import adminDashboardView, LoadUsersView
+from .views import adminDashboardView, LoadUsersView, BroadcastView, BroadcastDetailView
 
 urlpatterns = [
     path('dashboard/', adminDashboardView.as_view(), name='super-admin-dashboard'),
     path('users/', LoadUsersView.as_view(), name='load-users'),
+    path('broadcasts/', BroadcastView.as_view(), name='broadcasts'),
+    path('broadcasts/<int:broadcast_id>/', BroadcastDetailView.as_view(), name='broadcast-detail'),
 ]
@@ -1,6 +1,7 @@
 from django.shortcuts import render
 from django.db.models import Count, Sum, Q, F
 from django.db.models.functions import TruncMonth
+from django.db import transaction
 from django.utils import timezone
 from datetime import timedelta
 
@@ -11,6 +12,8 @@ from rest_framework.permissions import IsAuthenticated
 
 from accounts.models import User, Subscription, Transaction, BusinessInfo
 from referr.models import Referral
+from chat.models import Broadcast
+from utils.broadcast import start_broadcast
 
 
 class adminDashboardView(APIView):
@@ -280,3 +283,126 @@ class LoadUsersView(APIView):
                 "success": False,
                 "error": str(e)
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def _broadcast_data(broadcast):
+    return {
+        'id': broadcast.id,
+        'title': broadcast.title,
+        'message': broadcast.message,
+        'event_type': broadcast.event_type,
+        'audience': broadcast.audience,
+        'send_push': broadcast.send_push,
+        'status': broadcast.status,
+        'total_recipients': broadcast.total_recipients,
+        'delivered_count': broadcast.delivered_count,
+        'progress': broadcast.progress,
+        'error': broadcast.error or None,
+        'retry_count': broadcast.retry_count,
+        'created_at': broadcast.created_at,
+        'started_at': broadcast.started_at,
+        'completed_at': broadcast.completed_at,
+    }
+
+
+class BroadcastView(APIView):
+    """
+    Broadcast notifications
+    GET: recent broadcasts with delivery progress
+    POST: create a broadcast and start delivering it in the background
+        {title, message, audience (all|solo|company|rep), send_push, meta_data}
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        if request.user.role != "admin":
+            return Response({
+                "error": "Access denied. Only admins can access this resource."
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        broadcasts = Broadcast.objects.all()[:50]
+        return Response({
+            'success': True,
+            'broadcasts': [_broadcast_data(b) for b in broadcasts]
+        }, status=status.HTTP_200_OK)
+
+    def post(self, request):
+        if request.user.role != "admin":
+            return Response({
+                "error": "Access denied. Only admins can access this resource."
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        title = (request.data.get('title') or '').strip()
+        message = (request.data.get('message') or '').strip()
+        audience = request.data.get('audience') or 'all'
+        meta_data = request.data.get('meta_data') or {}
+
+        if not title or not message:
+            return Response({"error": "title and message are required"}, status=status.HTTP_400_BAD_REQUEST)
+        if audience not in dict(Broadcast.AUDIENCES):
+            return Response({"error": f"Invalid audience: {audience}"}, status=status.HTTP_400_BAD_REQUEST)
+        if not isinstance(meta_data, dict):
+            return Response({"error": "meta_data must be an object"}, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            broadcast = Broadcast.objects.create(
+                created_by=request.user,
+                title=title[:200],
+                message=message,
+                audience=audience,
+                send_push=str(request.data.get('send_push', True)).lower() not in ('false', '0'),
+                meta_data=meta_data,
+            )
+            start_broadcast(broadcast)
+
+        return Response({
+            'success': True,
+            'broadcast': _broadcast_data(broadcast)
+        }, status=status.HTTP_201_CREATED)
+
+
+class BroadcastDetailView(APIView):
+    """
+    GET: progress of one broadcast
+    POST {"action": "cancel" | "resume"}: stop delivery, or continue a
+        cancelled/failed broadcast from where it stopped
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, broadcast_id):
+        if request.user.role != "admin":
+            return Response({
+                "error": "Access denied. Only admins can access this resource."
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        broadcast = Broadcast.objects.filter(id=broadcast_id).first()
+        if not broadcast:
+            return Response({"error": "Broadcast not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'success': True, 'broadcast': _broadcast_data(broadcast)}, status=status.HTTP_200_OK)
+
+    def post(self, request, broadcast_id):
+        if request.user.role != "admin":
+            return Response({
+                "error": "Access denied. Only admins can access this resource."
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        action = request.data.get('action')
+        with transaction.atomic():
+            broadcast = Broadcast.objects.select_for_update().filter(id=broadcast_id).first()
+            if not broadcast:
+                return Response({"error": "Broadcast not found"}, status=status.HTTP_404_NOT_FOUND)
+
+            if action == 'cancel':
+                if broadcast.status not in ('pending', 'running'):
+                    return Response({"error": f"Broadcast is {broadcast.status}"}, status=status.HTTP_400_BAD_REQUEST)
+                # The running task sees the new status before its next chunk
+                broadcast.status = 'cancelled'
+                broadcast.save(update_fields=['status', 'updated_at'])
+            elif action == 'resume':
+                if broadcast.status not in ('cancelled', 'failed'):
+                    return Response({"error": f"Broadcast is {broadcast.status}"}, status=status.HTTP_400_BAD_REQUEST)
+                start_broadcast(broadcast)
+            else:
+                return Response({"error": "action must be 'cancel' or 'resume'"}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({'success': True, 'broadcast': _broadcast_data(broadcast)}, status=status.HTTP_200_OK)
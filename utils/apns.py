@@ -0,0 +1,183 @@
+# utils/apns.py
+"""
+Direct APNs provider (HTTP/2, token-based auth).
+
+- The ES256 provider JWT is signed once and reused until
+  APNS_TOKEN_REFRESH_SECONDS (Apple accepts tokens up to an hour old and
+  rejects refreshing more than every 20 minutes).
+- One httpx HTTP/2 client lives on a background event loop thread, so every
+  push from this process shares the same connection and concurrent pushes
+  are multiplexed as streams on it.
+- APNS_BASE_URL can point at a local HTTP/2 server for tests.
+- Device tokens here are native APNs tokens (Device.apns_token, sent by the
+  iOS app at registration), never FCM registration tokens.
+"""
+import asyncio
+import concurrent.futures
+import json
+import threading
+import time
+
+import httpx
+import jwt
+from django.conf import settings
+
+# Responses meaning the device token is dead; utils.push clears it from Device.apns_token
+INVALID_TOKEN_REASONS = {"BadDeviceToken", "DeviceTokenNotForTopic", "Unregistered"}
+
+# Slack on top of the per-request timeouts before send_many gives up on a batch
+RESULT_GRACE_SECONDS = 5
+
+PRODUCTION_URL = "https://api.push.apple.com"
+SANDBOX_URL = "https://api.sandbox.push.apple.com"
+
+
+def apns_enabled():
+    return settings.APNS_ENABLED and bool(settings.APNS_TEAM_ID and settings.APNS_TOPIC)
+
+
+class ProviderToken:
+    """Signed provider JWT, cached for its allowed lifetime"""
+
+    def __init__(self, key_path, key_id, team_id, lifetime):
+        self.key_path = key_path
+        self.key_id = key_id
+        self.team_id = team_id
+        self.lifetime = lifetime
+        self._key = None
+        self._token = None
+        self._issued_at = 0
+        self._lock = threading.Lock()
+
+    def get(self, force=False):
+        with self._lock:
+            now = int(time.time())
+            if force or self._token is None or now - self._issued_at >= self.lifetime:
+                if self._key is None:
+                    with open(self.key_path) as f:
+                        self._key = f.read()
+                self._token = jwt.encode(
+                    {"iss": self.team_id, "iat": now},
+                    self._key,
+                    algorithm="ES256",
+                    headers={"kid": self.key_id},
+                )
+                self._issued_at = now
+            return self._token
+
+
+class APNsClient:
+    """
+    Shared HTTP/2 client for APNs. send_many() is synchronous for callers
+    (views, Celery tasks) and runs the requests concurrently on the
+    client's own event loop.
+    """
+
+    def __init__(self):
+        self.base_url = settings.APNS_BASE_URL or (SANDBOX_URL if settings.APNS_USE_SANDBOX else PRODUCTION_URL)
+        self.topic = settings.APNS_TOPIC
+        self.token = ProviderToken(
+            settings.APNS_KEY_PATH,
+            settings.APNS_KEY_ID,
+            settings.APNS_TEAM_ID,
+            settings.APNS_TOKEN_REFRESH_SECONDS,
+        )
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="apns-client", daemon=True)
+        self._thread.start()
+        self._client = None
+        self._semaphore = None
+
+    def _ensure_client(self):
+        # Created on the client loop so its connection pool belongs to it
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=True,
+                base_url=self.base_url,
+                timeout=settings.APNS_TIMEOUT_SECONDS,
+                verify=settings.APNS_VERIFY_TLS,
+            )
+            self._semaphore = asyncio.Semaphore(settings.APNS_MAX_CONCURRENT_STREAMS)
+
+    def _payload(self, title, body, data, thread_id):
+        aps = {"alert": {"title": title, "body": body}, "sound": "default", "badge": 1}
+        if thread_id:
+            aps["thread-id"] = thread_id
+        # Custom keys sit next to "aps"; stringified to match the FCM data payload
+        return {**{k: str(v) for k, v in (data or {}).items()}, "aps": aps}
+
+    async def _send_one(self, device_token, payload, collapse_key):
+        headers = {
+            "apns-topic": self.topic,
+            "apns-push-type": "alert",
+            "apns-priority": "10",
+        }
+        if collapse_key:
+            headers["apns-collapse-id"] = collapse_key[:64]
+        body = json.dumps(payload).encode()
+
+        async with self._semaphore:
+            for attempt in range(2):
+                headers["authorization"] = f"bearer {self.token.get(force=attempt > 0)}"
+                response = await self._client.post(f"/3/device/{device_token}", content=body, headers=headers)
+                if response.status_code == 200:
+                    return {"token": device_token, "success": True, "apns_id": response.headers.get("apns-id")}
+
+                reason = None
+                try:
+                    reason = response.json().get("reason")
+                except ValueError:
+                    pass
+                if response.status_code == 403 and reason == "ExpiredProviderToken" and attempt == 0:
+                    continue
+                return {
+                    "token": device_token,
+                    "success": False,
+                    "status": response.status_code,
+                    "reason": reason,
+                    "invalid": response.status_code == 410 or reason in INVALID_TOKEN_REASONS,
+                }
+
+    async def _send_all(self, items, collapse_key, thread_id):
+        self._ensure_client()
+
+        async def _safe(device_token, payload):
+            try:
+                return await self._send_one(device_token, payload, collapse_key)
+            except Exception as e:
+                return {"token": device_token, "success": False, "reason": str(e), "invalid": False}
+
+        return await asyncio.gather(*(
+            _safe(device_token, self._payload(title, body, data, thread_id))
+            for device_token, title, body, data in items
+        ))
+
+    def send_many(self, items, collapse_key=None, thread_id=None):
+        """items: iterable of (device_token, title, body, data); returns one result dict per item"""
+        items = list(items)
+        if not items:
+            return []
+        future = asyncio.run_coroutine_threadsafe(self._send_all(items, collapse_key, thread_id), self._loop)
+        waves = 1 + len(items) // settings.APNS_MAX_CONCURRENT_STREAMS
+        try:
+            return future.result(timeout=settings.APNS_TIMEOUT_SECONDS * waves + RESULT_GRACE_SECONDS)
+        except concurrent.futures.TimeoutError:
+            # Stop the stragglers; the caller still gets one result per item
+            future.cancel()
+            print(f"❌ APNs batch of {len(items)} timed out")
+            return [
+                {"token": device_token, "success": False, "reason": "timeout", "invalid": False}
+                for device_token, *_ in items
+            ]
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_apns_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = APNsClient()
+        return _client
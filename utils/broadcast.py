@@ -0,0 +1,127 @@
+# utils/broadcast.py
+"""
+Broadcast delivery (chat.Broadcast) for audiences too big for one request.
+
+A broadcast is processed BROADCAST_CHUNK_SIZE recipients at a time, walking
+user ids in ascending order from broadcast.last_user_id. Each chunk is one
+bulk INSERT of Notification rows plus the cursor advance in the same
+transaction, so a crashed or cancelled run resumes exactly after the last
+committed chunk and memory stays at one chunk whatever the audience size.
+Websocket fan-out and pushes for a chunk go out after it commits; their
+errors are logged and don't stop the broadcast, since the chunk's
+Notification rows are already saved.
+"""
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from utils.notify import _send_notification_batches, _serialize_notification, ws_event_type
+
+
+# Broadcast.audience -> user roles; "all" is everyone except admins
+AUDIENCE_ROLES = {
+    "solo": ["solo"],
+    "company": ["company"],
+    "rep": ["rep", "employee"],
+}
+
+
+def audience_queryset(broadcast):
+    User = apps.get_model("accounts", "User")
+    users = User.objects.filter(is_active=True, is_delete=False).exclude(role__in=["admin", "superadmin"])
+    if broadcast.audience in AUDIENCE_ROLES:
+        users = users.filter(role__in=AUDIENCE_ROLES[broadcast.audience])
+    return users
+
+
+def start_broadcast(broadcast):
+    """Count the audience, mark the broadcast running and queue its first chunk"""
+    from utils.tasks import run_broadcast_task
+
+    # Resumed broadcasts only count who is left after the cursor
+    remaining = audience_queryset(broadcast).filter(id__gt=broadcast.last_user_id).count()
+    broadcast.total_recipients = broadcast.delivered_count + remaining
+    broadcast.status = "running"
+    broadcast.error = ""
+    # A manual (re)start gets a fresh automatic retry budget
+    broadcast.retry_count = 0
+    broadcast.started_at = broadcast.started_at or timezone.now()
+    broadcast.save(update_fields=["total_recipients", "status", "error", "retry_count", "started_at", "updated_at"])
+    run_broadcast_task.delay_on_commit(broadcast.id)
+
+
+def process_next_chunk(broadcast_id, chunk_size=None):
+    """
+    Deliver the next chunk of a running broadcast.
+    Returns True when more recipients remain, False when it is done or no
+    longer running (cancelled, failed, or another worker finished it).
+    """
+    Broadcast = apps.get_model("chat", "Broadcast")
+    Notification = apps.get_model("chat", "Notification")
+    chunk_size = chunk_size or settings.BROADCAST_CHUNK_SIZE
+
+    with transaction.atomic():
+        # Row lock: two workers never deliver the same chunk
+        broadcast = Broadcast.objects.select_for_update().filter(id=broadcast_id).first()
+        if broadcast is None or broadcast.status != "running":
+            return False
+
+        user_ids = list(
+            audience_queryset(broadcast)
+            .filter(id__gt=broadcast.last_user_id)
+            .order_by("id")
+            .values_list("id", flat=True)[:chunk_size]
+        )
+        if not user_ids:
+            broadcast.status = "completed"
+            broadcast.completed_at = timezone.now()
+            broadcast.save(update_fields=["status", "completed_at", "updated_at"])
+            print(f"📣 Broadcast {broadcast.id} completed: {broadcast.delivered_count} recipients")
+            return False
+
+        actor = broadcast.created_by
+        meta_data = {**(broadcast.meta_data or {}), "broadcast_id": broadcast.id}
+        created = Notification.objects.bulk_create([
+            Notification(
+                user_id=user_id,
+                event_type=broadcast.event_type,
+                title=broadcast.title,
+                message=broadcast.message,
+                actor_user=actor,
+                meta_data=meta_data,
+            )
+            for user_id in user_ids
+        ])
+
+        broadcast.last_user_id = user_ids[-1]
+        broadcast.delivered_count += len(created)
+        fields = ["last_user_id", "delivered_count", "updated_at"]
+        more = len(user_ids) == chunk_size
+        if not more:
+            broadcast.status = "completed"
+            broadcast.completed_at = timezone.now()
+            fields += ["status", "completed_at"]
+        broadcast.save(update_fields=fields)
+
+    try:
+        batches = {n.user_id: [_serialize_notification(n)] for n in created}
+        _send_notification_batches(ws_event_type(broadcast.event_type), batches)
+    except Exception as e:
+        print(f"❌ Broadcast {broadcast.id} websocket fan-out failed for users {user_ids[0]}-{user_ids[-1]}: {e}")
+
+    if broadcast.send_push:
+        from utils.push import send_push_notifications
+
+        data = {"event": broadcast.event_type, "broadcast_id": broadcast.id}
+        try:
+            send_push_notifications(
+                [(user_id, broadcast.title, broadcast.message, data) for user_id in user_ids],
+                collapse_key=f"broadcast:{broadcast.id}",
+            )
+        except Exception as e:
+            print(f"❌ Broadcast {broadcast.id} push failed for users {user_ids[0]}-{user_ids[-1]}: {e}")
+
+    if not more:
+        print(f"📣 Broadcast {broadcast.id} completed: {broadcast.delivered_count} recipients")
+    return more
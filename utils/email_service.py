@@ -1,17 +1,143 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from queue import Empty, Full, LifoQueue
+from smtplib import SMTPServerDisconnected
+
 from django.core.mail import send_mail
 from django.conf import settings
-from django.template.loader import render_to_string
-from django.core.mail import EmailMultiAlternatives
+from django.template.loader import get_template
+from django.core.mail import EmailMultiAlternatives, get_connection
 
 
 support_url = "https://thereferralpro.com/contact"
 
+
+# ---------- templates ----------
+
+@lru_cache(maxsize=None)
+def _compiled_template(name):
+    return get_template(name)
+
+
+def render_email(template_name, context):
+    """render_to_string with the compiled template kept for the process (re-read on every call in DEBUG)"""
+    template = get_template(template_name) if settings.DEBUG else _compiled_template(template_name)
+    return template.render(context)
+
+
+# ---------- connection pool ----------
+
+class _PooledConnection:
+    def __init__(self):
+        # EMAIL_BACKEND decides the transport, so tests on locmem go through the same path
+        self.connection = get_connection(fail_silently=False)
+        self.connection.open()
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+    def expired(self):
+        return (
+            self.sent >= settings.EMAIL_CONNECTION_MAX_MESSAGES
+            or time.monotonic() - self.last_used > settings.EMAIL_CONNECTION_MAX_IDLE_SECONDS
+        )
+
+    def send(self, message):
+        try:
+            sent = self.connection.send_messages([message])
+        except SMTPServerDisconnected:
+            # The server dropped the connection while it sat in the pool; nothing was sent
+            self.close()
+            self.connection.open()
+            sent = self.connection.send_messages([message])
+        self.sent += sent or 0
+        return sent or 0
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+
+class SMTPConnectionPool:
+    """
+    Long-lived connections to EMAIL_HOST, so the TCP+TLS handshake and AUTH
+    happen once per connection instead of once per email. Connections are
+    retired after EMAIL_CONNECTION_MAX_MESSAGES sends or when they have been
+    idle longer than EMAIL_CONNECTION_MAX_IDLE_SECONDS (servers drop them).
+    """
+
+    def __init__(self, size):
+        self._idle = LifoQueue(maxsize=size)
+
+    def _acquire(self):
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except Empty:
+                return _PooledConnection()
+            if not pooled.expired():
+                return pooled
+            pooled.close()
+
+    def _release(self, pooled):
+        pooled.last_used = time.monotonic()
+        try:
+            self._idle.put_nowait(pooled)
+        except Full:
+            pooled.close()
+
+    @contextmanager
+    def connection(self):
+        pooled = self._acquire()
+        try:
+            yield pooled
+        except Exception:
+            pooled.close()
+            raise
+        self._release(pooled)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        # Forked workers must not share the parent's sockets
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = SMTPConnectionPool(settings.EMAIL_POOL_SIZE)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def send_messages(messages):
+    """Send messages over one pooled connection; returns how many were sent"""
+    messages = list(messages)
+    if not messages:
+        return 0
+    sent = 0
+    with get_pool().connection() as pooled:
+        for message in messages:
+            sent += pooled.send(message)
+    return sent
+
+
+def _deliver(msg):
+    send_messages([msg])
+
+
 def send_otp(email: str, otp_code: str, purpose: str, expires_in: int):
     subject = "Your ReferralPro OTP Code"
     from_email = settings.DEFAULT_FROM_EMAIL
 
     # Render HTML template
-    html_content = render_to_string('OTP.html', {
+    html_content = render_email('OTP.html', {
         'otp': otp_code,
         'purpose': purpose,
         'expires_in': expires_in
@@ -25,7 +151,7 @@ def send_otp(email: str, otp_code: str, purpose: str, expires_in: int):
 
     msg = EmailMultiAlternatives(subject, text_content, from_email, [email])
     msg.attach_alternative(html_content, "text/html")
-    msg.send()
+    _deliver(msg)
 
     print("OTP email sent.")
 
@@ -47,7 +173,7 @@ def send_referral_email(
     from_email = settings.DEFAULT_FROM_EMAIL
 
     # Render HTML template (create referral_email.html in templates folder)
-    html_content = render_to_string("referral_email.html", {
+    html_content = render_email("referral_email.html", {
         "referred_to_name": referred_to_name,
         "company_name": company_name,
         "referred_by_name": referred_by_name,
@@ -62,7 +188,7 @@ def send_referral_email(
 
     msg = EmailMultiAlternatives(subject, text_content, from_email, [referred_to_email])
     msg.attach_alternative(html_content, "text/html")
-    msg.send()
+    _deliver(msg)
 
     print(f"Referral email sent to {referred_to_email}")
 
@@ -74,7 +200,7 @@ def send_invitation_email(email: str, name: str, password: str):
     from_email = settings.DEFAULT_FROM_EMAIL
 
     # Render HTML template (create `invitation.html` in templates folder)
-    html_content = render_to_string('invitation.html', {
+    html_content = render_email('invitation.html', {
         'name': name,
         'email': email,
         'password': password,
@@ -99,7 +225,7 @@ def send_invitation_email(email: str, name: str, password: str):
 
     msg = EmailMultiAlternatives(subject, text_content, from_email, [email])
     msg.attach_alternative(html_content, "text/html")
-    msg.send()
+    _deliver(msg)
 
     print(f"Invitation email sent to {email}")
 
@@ -109,7 +235,7 @@ def send_app_download_email(email: str, name: str,  sender_name: str = None):
     from_email = settings.DEFAULT_FROM_EMAIL
 
     # Render HTML template
-    html_content = render_to_string('app_download_invitation.html', {
+    html_content = render_email('app_download_invitation.html', {
         'name': name,
         'email': email,
         'sender_name': sender_name,
@@ -143,7 +269,7 @@ def send_app_download_email(email: str, name: str,  sender_name: str = None):
 
     msg = EmailMultiAlternatives(subject, text_content, from_email, [email])
     msg.attach_alternative(html_content, "text/html")
-    msg.send()
+    _deliver(msg)
 
     print(f"App download invitation email sent to {email}")
 
@@ -152,7 +278,7 @@ def send_solo_signup_success_email(email: str, name: str):
     subject = "Welcome to ReferralPro!"
     from_email = settings.DEFAULT_FROM_EMAIL
 
-    html_content = render_to_string('solo_signup_success.html', {
+    html_content = render_email('solo_signup_success.html', {
         'name': name,
         'email': email,
         'login_url': 'https://thereferralpro.com/login',
@@ -172,7 +298,7 @@ def send_solo_signup_success_email(email: str, name: str):
 
     msg = EmailMultiAlternatives(subject, text_content, from_email, [email])
     msg.attach_alternative(html_content, "text/html")
-    msg.send()
+    _deliver(msg)
 
     print(f"Solo signup success email sent to {email}")
 
@@ -181,7 +307,7 @@ def send_company_signup_email(email: str, name: str):
     subject = "Welcome to ReferralPro for Business"
     from_email = settings.DEFAULT_FROM_EMAIL
 
-    html_content = render_to_string('company_signup.html', {
+    html_content = render_email('company_signup.html', {
         'name': name,
         'email': email,
         'dashboard_url': 'https://thereferralpro.com',
@@ -200,7 +326,7 @@ def send_company_signup_email(email: str, name: str):
 
     msg = EmailMultiAlternatives(subject, text_content, from_email, [email])
     msg.attach_alternative(html_content, "text/html")
-    msg.send()
+    _deliver(msg)
 
     print(f"Company signup email sent to {email}")
 
@@ -210,7 +336,7 @@ def send_payment_success_email(email: str, name: str, plan_name: str, amount: fl
     subject = "Your Subscription Payment was Successful"
     from_email = settings.DEFAULT_FROM_EMAIL
 
-    html_content = render_to_string('payment_success.html', {
+    html_content = render_email('payment_success.html', {
         'name': name,
         'plan_name': plan_name,
         'amount': amount,
@@ -233,7 +359,7 @@ def send_payment_success_email(email: str, name: str, plan_name: str, amount: fl
 
     msg = EmailMultiAlternatives(subject, text_content, from_email, [email])
     msg.attach_alternative(html_content, "text/html")
-    msg.send()
+    _deliver(msg)
 
     print(f"Payment success email sent to {email}")
 
@@ -244,7 +370,7 @@ def send_payment_failed_email(email: str, name: str, reason: str = None):
     subject = "Your Payment Could Not Be Processed"
     from_email = settings.DEFAULT_FROM_EMAIL
 
-    html_content = render_to_string('payment_failed.html', {
+    html_content = render_email('payment_failed.html', {
         'name': name,
         'reason': reason or "Unknown error",
         'support_url': 'https://thereferralpro.com/',
@@ -265,7 +391,7 @@ def send_payment_failed_email(email: str, name: str, reason: str = None):
 
     msg = EmailMultiAlternatives(subject, text_content, from_email, [email])
     msg.attach_alternative(html_content, "text/html")
-    msg.send()
+    _deliver(msg)
 
     print(f"Payment failed email sent to {email}")
 
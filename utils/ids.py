@@ -0,0 +1,161 @@
+# utils/ids.py
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models
+
+from utils.shared_cache import require_shared_cache
+
+# Custom epoch: 2025-01-01T00:00:00Z, in milliseconds
+EPOCH_MS = 1735689600000
+
+# 41 bits of milliseconds + 6 bits of worker + 6 bits of sequence = 53 bits,
+# so ids stay exact as JavaScript numbers (Number.MAX_SAFE_INTEGER = 2**53 - 1).
+# The timestamp shift is the same 12 bits as the earlier 4/8 split, so ids
+# minted after the change still sort after older ones.
+TIMESTAMP_BITS = 41
+WORKER_BITS = 6
+SEQUENCE_BITS = 6
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+LEASE_KEY = "snowflake:worker:{worker_id}"
+
+
+class SnowflakeGenerator:
+    """
+    Time-sortable 53-bit ids generated in process, so rows can get their
+    primary key before INSERT and bulk_create works without the database
+    returning ids (MySQL can't).
+
+    Every live process needs a distinct worker id (0-63). By default each
+    process leases a free one from the shared cache for
+    SNOWFLAKE_LEASE_SECONDS and renews it while it keeps minting; forked
+    children lease their own. SNOWFLAKE_WORKER_ID pins the id instead, which
+    is only safe when exactly one process runs with that value.
+    """
+
+    def __init__(self, worker_id=None):
+        self._fixed_worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+        self._worker_id = None
+        self._pid = None
+        self._owner = None
+        self._renew_at = None
+
+    @property
+    def worker_id(self):
+        with self._lock:
+            return self._current_worker_id()
+
+    def _current_worker_id(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # New process (or forked child): never reuse the parent's id
+            self._worker_id = None
+            self._pid = pid
+        if self._worker_id is not None and (self._renew_at is None or time.monotonic() < self._renew_at):
+            return self._worker_id
+
+        fixed = self._fixed_worker_id
+        if fixed is None:
+            fixed = getattr(settings, "SNOWFLAKE_WORKER_ID", None)
+        if fixed not in (None, ""):
+            fixed = int(fixed)
+            if not 0 <= fixed <= MAX_WORKER_ID:
+                raise ImproperlyConfigured(f"SNOWFLAKE_WORKER_ID must be between 0 and {MAX_WORKER_ID}")
+            self._worker_id, self._renew_at = fixed, None
+            return fixed
+
+        return self._lease()
+
+    def _lease(self):
+        require_shared_cache("Snowflake worker id leases")
+        ttl = settings.SNOWFLAKE_LEASE_SECONDS
+
+        # Renew the id we hold while the lease is still ours
+        if self._worker_id is not None:
+            key = LEASE_KEY.format(worker_id=self._worker_id)
+            if cache.get(key) == self._owner and cache.touch(key, ttl):
+                self._renew_at = time.monotonic() + ttl / 3
+                return self._worker_id
+
+        owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        start = random.randrange(MAX_WORKER_ID + 1)
+        for offset in range(MAX_WORKER_ID + 1):
+            worker_id = (start + offset) % (MAX_WORKER_ID + 1)
+            if cache.add(LEASE_KEY.format(worker_id=worker_id), owner, ttl):
+                self._worker_id, self._owner = worker_id, owner
+                self._renew_at = time.monotonic() + ttl / 3
+                return worker_id
+        raise ImproperlyConfigured(f"All {MAX_WORKER_ID + 1} snowflake worker ids are leased")
+
+    def next_id(self):
+        with self._lock:
+            worker_id = self._current_worker_id()
+            now_ms = int(time.time() * 1000) - EPOCH_MS
+            # Never go backwards if the clock does
+            now_ms = max(now_ms, self._last_ms)
+
+            if now_ms == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond; borrow the next one
+                    now_ms += 1
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+
+            return (
+                (now_ms << (WORKER_BITS + SEQUENCE_BITS))
+                | (worker_id << SEQUENCE_BITS)
+                | self._sequence
+            )
+
+
+snowflake = SnowflakeGenerator()
+
+
+def next_id():
+    return snowflake.next_id()
+
+
+class SnowflakeQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            if obj.pk is None:
+                obj.pk = next_id()
+        return super().bulk_create(objs, *args, **kwargs)
+
+
+SnowflakeManager = models.Manager.from_queryset(SnowflakeQuerySet)
+
+
+class SnowflakeIdMixin:
+    """
+    Assign a snowflake primary key before the first save. The column stays a
+    BIGINT auto-increment and existing rows keep their ids, but once a
+    snowflake id is written MySQL moves AUTO_INCREMENT past it: a row inserted
+    without an id (raw SQL, fixtures without pks) would land right after the
+    newest snowflake and can collide with the next one minted. Insert through
+    save()/bulk_create only. Pair with `objects = SnowflakeManager()` so
+    bulk_create assigns ids too.
+    """
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.pk is None:
+            self.pk = next_id()
+            # The pk is new; skip Django's UPDATE-then-INSERT probe
+            kwargs.setdefault("force_insert", True)
+        return super().save(*args, **kwargs)
@@ -1,47 +1,62 @@
 # utils/notify.py
+import asyncio
+
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from django.utils import timezone
-from django.db import connection, transaction
 
 # ---------- internal helpers ----------
 
 def _create_notifications_safely(model_cls, objs):
     """
-    Create rows and guarantee .id is populated on returned objects.
-    Uses bulk_create only if the backend can return rows from bulk insert.
+    Create rows with a single bulk INSERT and guarantee .id is populated on
+    returned objects. Notification ids are assigned client-side (utils.ids),
+    so this works on MySQL, which can't return ids from bulk inserts.
     """
     if not objs:
         return []
 
-    can_return_ids = getattr(connection.features, "can_return_rows_from_bulk_insert", False)
+    created = model_cls.objects.bulk_create(objs)
 
-    if can_return_ids:
-        # On backends like PostgreSQL this will populate primary keys.
-        created = model_cls.objects.bulk_create(objs)
-    else:
-        # Fallback: save individually so .id is set.
-        created = []
-        with transaction.atomic():
-            for o in objs:
-                o.save()
-                created.append(o)
-
-    # Paranoid check: if any IDs are still None, refetch (rare, but just in case)
+    # Paranoid check: every object must carry its id for serialization
     if any(getattr(o, "id", None) is None for o in created):
-        # Attempt a targeted refetch using a short time window.
-        # NOTE: We cannot rely on .created_at from the object if it's auto_now_add at DB time,
-        # so we refetch by a minimal set of constraints + a tight time window.
-        # Callers should pass a qs to refine this further if needed.
         model_name = model_cls.__name__
         raise RuntimeError(
             f"{model_name}: bulk insert returned objects without IDs. "
-            "Either your DB doesn't support returning IDs for bulk inserts or the model is misconfigured."
+            "Use SnowflakeManager on the model or a backend that returns ids from bulk inserts."
         )
 
     return created
 
 
+def _send_notification_batches(event_type, batches):
+    """
+    Deliver {user_id: [payload, ...]} with one group_send per user, all from
+    a single async_to_sync hop. Users with several payloads get one
+    "notification_batch" event; single payloads keep the plain event shape.
+    """
+    channel_layer = get_channel_layer()
+    if not channel_layer or not batches:
+        return
+
+    def _event(items):
+        if len(items) == 1:
+            return {"type": event_type, **items[0]}
+        return {"type": "notification_batch", "event_type": event_type, "notifications": items}
+
+    async def _send_all():
+        await asyncio.gather(*(
+            channel_layer.group_send(f"notifications_{uid}", _event(items))
+            for uid, items in batches.items()
+            if items
+        ))
+
+    try:
+        async_to_sync(_send_all)()
+    except Exception as e:
+        print(f"Error sending real-time notifications: {e}")
+
+
 def _group_by_user_id(notifications):
     by_user = {}
     for n in notifications:
@@ -104,74 +119,85 @@ def _serialize_notification(n, *, include_chat=False, include_referral=True):
         "chat_message": chat_message,
     }
 
+def ws_event_type(event, default="notification"):
+    """NotificationConsumer handler type for a notification event name."""
+    event = event or ""
+    if event.startswith("chat."):
+        return "new_message_notification"
+    if event.startswith("referral."):
+        return "referral_notification"
+    return default
+
 # ---------- public dispatchers ----------
 
-def notify_users(user_ids, payload, event_type="notification"):
+def notify_users(user_ids, payload, event_type="notification", strict=False):
+    """
+    strict=True raises when the Notification rows can't be stored, instead of
+    falling back to a websocket-only send; notify_users_task uses it so the
+    task retries before anything was stored or sent.
+    """
     event = payload.get("event", "") or ""
     if event.startswith("chat."):
-        return notify_chat_users(user_ids, payload, "new_message_notification")
+        return notify_chat_users(user_ids, payload, "new_message_notification", strict=strict)
     elif event.startswith("referral."):
-        return notify_referral_users(user_ids, payload, "referral_notification")
+        return notify_referral_users(user_ids, payload, "referral_notification", strict=strict)
     else:
-        return notify_generic_users(user_ids, payload, event_type)
+        return notify_generic_users(user_ids, payload, event_type, strict=strict)
 
-def notify_generic_users(user_ids, payload, event_type="notification"):
-    channel_layer = get_channel_layer()
+def notify_generic_users(user_ids, payload, event_type="notification", strict=False):
     payload = {**payload, "created_at": timezone.now().isoformat()}
 
-    created_notifications = _store_generic_notifications_in_db(user_ids, payload)
+    created_notifications = _store_generic_notifications_in_db(user_ids, payload, strict=strict)
 
     if created_notifications:
-        by_user = _group_by_user_id(created_notifications)
-        for uid, notes in by_user.items():
-            for n in notes:
-                data = _serialize_notification(n, include_chat=False, include_referral=True)
-                async_to_sync(channel_layer.group_send)(f"notifications_{uid}", {"type": event_type, **data})
+        batches = {
+            uid: [_serialize_notification(n, include_chat=False, include_referral=True) for n in notes]
+            for uid, notes in _group_by_user_id(created_notifications).items()
+        }
     else:
         # Fallback
-        for uid in {u for u in user_ids if u}:
-            async_to_sync(channel_layer.group_send)(f"notifications_{uid}", {"type": event_type, **payload})
+        batches = {uid: [payload] for uid in {u for u in user_ids if u}}
 
-def notify_referral_users(user_ids, payload, event_type="referral_notification"):
-    channel_layer = get_channel_layer()
+    _send_notification_batches(event_type, batches)
+
+def notify_referral_users(user_ids, payload, event_type="referral_notification", strict=False):
     payload = {**payload, "created_at": timezone.now().isoformat()}
 
-    created_notifications = _store_referral_notifications_in_db(user_ids, payload)
+    created_notifications = _store_referral_notifications_in_db(user_ids, payload, strict=strict)
 
     if created_notifications:
-        by_user = _group_by_user_id(created_notifications)
-        for uid, notes in by_user.items():
-            for n in notes:
-                data = _serialize_notification(n, include_chat=False, include_referral=True)
-                async_to_sync(channel_layer.group_send)(f"notifications_{uid}", {"type": event_type, **data})
+        batches = {
+            uid: [_serialize_notification(n, include_chat=False, include_referral=True) for n in notes]
+            for uid, notes in _group_by_user_id(created_notifications).items()
+        }
     else:
-        for uid in {u for u in user_ids if u}:
-            async_to_sync(channel_layer.group_send)(f"notifications_{uid}", {"type": event_type, **payload})
+        batches = {uid: [payload] for uid in {u for u in user_ids if u}}
 
-def notify_chat_users(user_ids, payload, event_type="chat_notification"):
-    channel_layer = get_channel_layer()
+    _send_notification_batches(event_type, batches)
+
+def notify_chat_users(user_ids, payload, event_type="chat_notification", strict=False):
     payload = {**payload, "created_at": timezone.now().isoformat()}
 
-    created_notifications = _store_chat_notifications_in_db(user_ids, payload)
+    created_notifications = _store_chat_notifications_in_db(user_ids, payload, strict=strict)
 
     if created_notifications:
-        by_user = _group_by_user_id(created_notifications)
-        for uid, notes in by_user.items():
-            for n in notes:
-                data = _serialize_notification(n, include_chat=True, include_referral=True)
-                async_to_sync(channel_layer.group_send)(f"notifications_{uid}", {"type": event_type, **data})
+        batches = {
+            uid: [_serialize_notification(n, include_chat=True, include_referral=True) for n in notes]
+            for uid, notes in _group_by_user_id(created_notifications).items()
+        }
     else:
-        for uid in {u for u in user_ids if u}:
-            async_to_sync(channel_layer.group_send)(f"notifications_{uid}", {"type": event_type, **payload})
+        batches = {uid: [payload] for uid in {u for u in user_ids if u}}
+
+    _send_notification_batches(event_type, batches)
 
-def _store_referral_notifications_in_db(user_ids, payload):
+def _store_referral_notifications_in_db(user_ids, payload, strict=False):
     try:
         from accounts.models import User
         from chat.models import Notification
         from referr.models import Referral
 
-        recipients = User.objects.filter(id__in=user_ids)
-        if not recipients.exists():
+        recipients = list(User.objects.filter(id__in=user_ids).only("id"))
+        if not recipients:
             return []
 
         event_type = payload.get("event", "notification")
@@ -209,23 +235,21 @@ def _store_referral_notifications_in_db(user_ids, payload):
             for r in recipients
         ]
 
-        created = _create_notifications_safely(Notification, objs)
-
-        # Pull relateds for serialization
-        return Notification.objects.filter(id__in=[o.id for o in created]).select_related(
-            "user", "actor_user", "referral"
-        )
+        # Relateds were assigned above, so the created objects serialize as-is
+        return _create_notifications_safely(Notification, objs)
     except Exception as e:
+        if strict:
+            raise
         print(f"Error storing referral notifications in database: {e}")
         return []
 
-def _store_chat_notifications_in_db(user_ids, payload):
+def _store_chat_notifications_in_db(user_ids, payload, strict=False):
     try:
         from accounts.models import User
         from chat.models import Notification, Message, ChatRoom
 
-        recipients = User.objects.filter(id__in=user_ids)
-        if not recipients.exists():
+        recipients = list(User.objects.filter(id__in=user_ids).only("id"))
+        if not recipients:
             return []
 
         event_type = payload.get("event", "notification")
@@ -270,23 +294,22 @@ def _store_chat_notifications_in_db(user_ids, payload):
             for r in recipients
         ]
 
-        created = _create_notifications_safely(Notification, objs)
-
-        return Notification.objects.filter(id__in=[o.id for o in created]).select_related(
-            "user", "actor_user", "referral", "chat_room", "chat_message"
-        )
+        # Relateds were assigned above, so the created objects serialize as-is
+        return _create_notifications_safely(Notification, objs)
     except Exception as e:
+        if strict:
+            raise
         print(f"Error storing chat notifications in database: {e}")
         return []
 
-def _store_generic_notifications_in_db(user_ids, payload):
+def _store_generic_notifications_in_db(user_ids, payload, strict=False):
     try:
         from accounts.models import User
         from chat.models import Notification
         from referr.models import Referral
 
-        recipients = User.objects.filter(id__in=user_ids)
-        if not recipients.exists():
+        recipients = list(User.objects.filter(id__in=user_ids).only("id"))
+        if not recipients:
             return []
 
         event_type = payload.get("event", "notification")
@@ -321,12 +344,11 @@ def _store_generic_notifications_in_db(user_ids, payload):
             for r in recipients
         ]
 
-        created = _create_notifications_safely(Notification, objs)
-
-        return Notification.objects.filter(id__in=[o.id for o in created]).select_related(
-            "user", "actor_user", "referral"
-        )
+        # Relateds were assigned above, so the created objects serialize as-is
+        return _create_notifications_safely(Notification, objs)
     except Exception as e:
+        if strict:
+            raise
         print(f"Error storing generic notifications in database: {e}")
         return []
 
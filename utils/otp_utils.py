@@ -1,7 +1,15 @@
 import random, datetime
+import secrets
+import string
 from django.utils import timezone
 from accounts.models import OtpCode
 
+
+def generate_random_password(length=10):
+    chars = string.digits + string.ascii_uppercase + string.ascii_lowercase
+    return ''.join(secrets.choice(chars) for _ in range(length))
+
+
 def generate_otp(user, purpose="login", expires_in=10):
     code = str(random.randint(100000, 999999))  # 6-digit OTP
     expires_at = timezone.now() + datetime.timedelta(minutes=expires_in)
@@ -1,8 +1,9 @@
 from django.conf import settings
 import os
 import firebase_admin
-from firebase_admin import credentials, messaging
+from firebase_admin import credentials, exceptions as firebase_exceptions, messaging
 from accounts.models import Device
+from utils.apns import apns_enabled, get_apns_client
 
 def initialize_firebase():
     """Initialize Firebase Admin SDK with service account"""
@@ -25,97 +26,186 @@ def initialize_firebase():
 # Initialize once globally
 firebase_messaging = initialize_firebase()
 
-def send_push_notification_to_user(user, title, body, data=None):
-    """Send notification only to offline devices of a user"""
-    try:
-        if firebase_messaging is None:
-            print("Firebase not initialized. Cannot send notification.")
-            return {"error": "Firebase not initialized"}
+# FCM's send_each accepts at most 500 messages per call
+FCM_BATCH_SIZE = 500
 
-        print(f"\n\n Preparing to send push notification to user {user.id}")
-        
-        # Get only OFFLINE devices for the user to prevent duplicate notifications
-        offline_devices = Device.objects.filter(user=user)
-        
-        # if not offline_devices.exists():
-        #     print(f"⚠️  User {user.id} has no offline devices - skipping push notification")
-        #     return {"info": "User has no offline devices", "success": 0, "failure": 0}
+# Errors meaning the token itself is dead; anything else may succeed later
+INVALID_TOKEN_ERRORS = (messaging.UnregisteredError, messaging.SenderIdMismatchError)
 
-        print(f"User {user.id} has {offline_devices.count()} offline devices")
 
-        # Send to each offline device individually
-        successful_sends = []
-        failed_sends = []
-        invalid_tokens = []
-        
-        for device in offline_devices:
-            token = device.token
-            if not token:
-                print(f"⚠️  No FCM token for offline device {device.id} of user {user.id}")
-                continue
-                
-            try:
-                message = messaging.Message(
-                    notification=messaging.Notification(title=title, body=body),
-                    data={k: str(v) for k, v in (data or {}).items()},  # Convert all values to strings
-                    token=token,
-                    android=messaging.AndroidConfig(
-                        priority="high",
-                        notification=messaging.AndroidNotification(
-                            sound="default",
-                            channel_id="default"  # You can customize this
-                        )
-                    ),
-                    apns=messaging.APNSConfig(
-                        payload=messaging.APNSPayload(
-                            aps=messaging.Aps(
-                                sound="default",
-                                badge=1  # You can customize this
-                            )
-                        )
-                    )
+def _is_invalid_token_error(error):
+    if isinstance(error, INVALID_TOKEN_ERRORS):
+        return True
+    # INVALID_ARGUMENT also covers bad payloads; only prune for malformed tokens
+    return (
+        isinstance(error, firebase_exceptions.InvalidArgumentError)
+        and "registration token" in str(error).lower()
+    )
+
+
+def _build_message(token, title, body, data=None, collapse_key=None, thread_id=None):
+    """
+    collapse_key: a newer push with the same key replaces the older one on
+    the device (Android tag/collapse_key, apns-collapse-id) instead of stacking.
+    thread_id: groups notifications in the tray (iOS thread-id, Android tag).
+    """
+    return messaging.Message(
+        notification=messaging.Notification(title=title, body=body),
+        data={k: str(v) for k, v in (data or {}).items()},  # Convert all values to strings
+        token=token,
+        android=messaging.AndroidConfig(
+            priority="high",
+            collapse_key=collapse_key,
+            notification=messaging.AndroidNotification(
+                sound="default",
+                channel_id="default",  # You can customize this
+                tag=collapse_key or thread_id,
+            )
+        ),
+        apns=messaging.APNSConfig(
+            headers={"apns-collapse-id": collapse_key} if collapse_key else None,
+            payload=messaging.APNSPayload(
+                aps=messaging.Aps(
+                    sound="default",
+                    badge=1,  # You can customize this
+                    thread_id=thread_id,
                 )
-                
-                # Send individual message
-                message_id = firebase_messaging.send(message)
-                successful_sends.append(message_id)
-                print(f"✅ Sent to offline device {device.id} token {token[:10]}... - Message ID: {message_id}")
-                
-            except Exception as send_error:
-                failed_sends.append(token)
-                error_str = str(send_error)
-                print(f"❌ Failed to send to offline device {device.id} token {token[:10]}... - Error: {error_str}")
-
-                # Check if token is invalid and should be removed
-                if any(err_code in error_str.lower() for err_code in [
-                    "registration-token-not-registered", 
-                    "invalid-argument",
-                    "sender-id-mismatch",
-                    "invalid registration token"
-                ]):
-                    invalid_tokens.append(token)
-                    print(f"🗑️ Marking token {token[:10]}... for removal")
-
-        # Clean up invalid tokens from database
-        if invalid_tokens:
-            Device.objects.filter(user=user, token__in=invalid_tokens).delete()
-            print(f"🧹 Removed {len(invalid_tokens)} invalid tokens for user {user.id}")
-
-        success_count = len(successful_sends)
-        failure_count = len(failed_sends)
-        
-        print(f"✅ Push notification sent to offline devices: {success_count} successful, {failure_count} failed for user {user.id}")
+            )
+        )
+    )
+
+
+def _send_fcm(messages):
+    """send_each in FCM_BATCH_SIZE chunks -> (message_ids, failed_tokens, invalid_tokens)"""
+    message_ids = []
+    failed_tokens = []
+    invalid_tokens = []
+    for start in range(0, len(messages), FCM_BATCH_SIZE):
+        chunk = messages[start:start + FCM_BATCH_SIZE]
+        try:
+            batch = firebase_messaging.send_each(chunk)
+        except Exception as e:
+            # The whole request failed (auth, network); nothing in the chunk was sent
+            print(f"❌ FCM batch of {len(chunk)} failed: {e}")
+            failed_tokens.extend(m.token for m in chunk)
+            continue
+
+        for message, response in zip(chunk, batch.responses):
+            if response.success:
+                message_ids.append(response.message_id)
+                continue
+            failed_tokens.append(message.token)
+            if _is_invalid_token_error(response.exception):
+                invalid_tokens.append(message.token)
+    return message_ids, failed_tokens, invalid_tokens
+
+
+def _send_apns(items, collapse_key, thread_id):
+    """Direct APNs for iOS tokens -> (message_ids, failed_tokens, invalid_tokens)"""
+    message_ids = []
+    failed_tokens = []
+    invalid_tokens = []
+    for result in get_apns_client().send_many(items, collapse_key=collapse_key, thread_id=thread_id):
+        if result["success"]:
+            message_ids.append(result["apns_id"])
+            continue
+        failed_tokens.append(result["token"])
+        if result["invalid"]:
+            invalid_tokens.append(result["token"])
+        print(f"❌ APNs rejected token {result['token'][:10]}...: {result.get('status')} {result.get('reason')}")
+    return message_ids, failed_tokens, invalid_tokens
 
-        return {
-            "success": success_count,
-            "failure": failure_count,
-            "total_sent": offline_devices.count(),
-            "invalid_tokens": invalid_tokens,
-            "message_ids": successful_sends
-        }
 
+def send_push_notifications(notifications, collapse_key=None, thread_id=None, tokens=None):
+    """
+    Send many pushes at once.
+
+    `notifications` is an iterable of (user or user_id, title, body, data).
+    Device tokens for every user are loaded with one query and messages go
+    out through FCM's send_each in chunks of FCM_BATCH_SIZE, so a push to a
+    whole room or company costs one round trip per 500 devices. With
+    APNS_ENABLED, devices that registered a native APNs token go straight to
+    APNs (utils.apns) instead. Devices whose FCM token is reported dead are
+    deleted in one query; a dead APNs token is only cleared, so the device
+    falls back to FCM.
+    collapse_key/thread_id apply to every message (see _build_message).
+    tokens limits the send to those devices (retrying the ones that failed).
+    """
+    use_apns = apns_enabled()
+    if firebase_messaging is None and not use_apns:
+        print("Firebase not initialized. Cannot send notification.")
+        return {"error": "Firebase not initialized"}
+
+    notifications = [
+        (getattr(user, "id", user), title, body, data)
+        for user, title, body, data in notifications
+    ]
+    user_ids = {user_id for user_id, *_ in notifications if user_id}
+    if not user_ids:
+        return {"success": 0, "failure": 0, "total_sent": 0, "invalid_tokens": [], "message_ids": []}
+
+    devices_by_user = {}
+    devices = Device.objects.filter(user_id__in=user_ids).exclude(token="")
+    if tokens is not None:
+        devices = devices.filter(token__in=tokens)
+    for user_id, token, apns_token in devices.values_list("user_id", "token", "apns_token"):
+        devices_by_user.setdefault(user_id, []).append((token, apns_token))
+
+    fcm_messages = []
+    apns_items = []
+    device_for_apns = {}  # APNs token -> the device's FCM token
+    for user_id, title, body, data in notifications:
+        for token, apns_token in devices_by_user.get(user_id, ()):
+            if use_apns and apns_token:
+                apns_items.append((apns_token, title, body, data))
+                device_for_apns[apns_token] = token
+            elif firebase_messaging is not None:
+                fcm_messages.append(_build_message(token, title, body, data, collapse_key, thread_id))
+
+    # failed_tokens/invalid_tokens are Device.token values throughout
+    message_ids, failed_tokens, invalid_tokens = _send_fcm(fcm_messages)
+    if apns_items:
+        apns_ids, apns_failed, apns_invalid = _send_apns(apns_items, collapse_key, thread_id)
+        message_ids += apns_ids
+        failed_tokens += [device_for_apns[t] for t in apns_failed]
+        if apns_invalid:
+            Device.objects.filter(apns_token__in=set(apns_invalid)).update(apns_token=None)
+            print(f"🧹 Cleared {len(set(apns_invalid))} invalid APNs tokens")
+
+    # Clean up invalid tokens from database
+    if invalid_tokens:
+        Device.objects.filter(token__in=set(invalid_tokens)).delete()
+        print(f"🧹 Removed {len(set(invalid_tokens))} invalid tokens")
+
+    sent = len(fcm_messages) + len(apns_items)
+    print(
+        f"✅ Push batch to {len(user_ids)} users: {len(message_ids)} successful, "
+        f"{len(failed_tokens)} failed across {sent} devices ({len(apns_items)} via APNs)"
+    )
+
+    return {
+        "success": len(message_ids),
+        "failure": len(failed_tokens),
+        "failed_tokens": failed_tokens,
+        "total_sent": sent,
+        "invalid_tokens": invalid_tokens,
+        "message_ids": message_ids,
+    }
+
+
+def send_push_notification_to_users(users, title, body, data=None):
+    """Same push to many users (a room, a whole company) in one batch"""
+    return send_push_notifications((user, title, body, data) for user in users)
+
+
+def send_push_notification_to_user(user, title, body, data=None, tokens=None):
+    """Send a push to every registered device of a user (or only `tokens`)"""
+    user_id = getattr(user, "id", user)
+    try:
+        print(f"\n\n Preparing to send push notification to user {user_id}")
+        return send_push_notifications([(user_id, title, body, data)], tokens=tokens)
     except Exception as e:
-        print(f"❌ Error sending notification to user {user.id}: {e}")
+        print(f"❌ Error sending notification to user {user_id}: {e}")
         return {"error": str(e)}
 
 # def send_push_notification_to_multiple_users(users, title, body, data=None):
@@ -0,0 +1,178 @@
+# utils/push_digest.py
+"""
+Chat push digests: a burst of messages in a room becomes one push per
+recipient ("3 new messages from X") instead of one per message.
+
+The first message in a room opens a PUSH_DIGEST_WINDOW_SECONDS window and
+schedules a flush on a push worker. Pending messages live in the shared
+cache as one key per message, numbered by an atomic incr of the room's head
+counter; a flush consumes the indexes after the room's tail and advances the
+tail, so messages queued while a flush runs are never dropped. Workers and
+web processes must see the same cache (CACHE_URL). Pushes carry the room as
+collapse key and thread id, so a later digest replaces the earlier one on
+the device. Without a shared cache there is no window: every push is sent
+immediately.
+"""
+from django.conf import settings
+from django.core.cache import cache
+
+from utils.shared_cache import shared_cache_available
+
+HEAD_KEY = "push_digest:{room_id}:head"      # index of the last queued message
+TAIL_KEY = "push_digest:{room_id}:tail"      # index of the last flushed message
+ENTRY_KEY = "push_digest:{room_id}:{index}"
+STALLED_KEY = "push_digest:{room_id}:stalled"  # head when a flush last hit a missing entry
+SCHEDULED_KEY = "push_digest:{room_id}:scheduled"
+FLUSH_LOCK_KEY = "push_digest:{room_id}:flushing"
+
+# Counters outlive any window so a room's indexes never restart mid-digest
+COUNTER_TTL = 24 * 60 * 60
+
+
+def chat_collapse_key(room_id):
+    return f"chat:{room_id}"
+
+
+def digest_window():
+    """Seconds pushes are held for a digest; 0 when workers can't share the pending list"""
+    return settings.PUSH_DIGEST_WINDOW_SECONDS if shared_cache_available() else 0
+
+
+def queue_chat_push(room_id, sender_id, sender_name, recipient_ids, body, data):
+    """Add a chat message to the room's digest, opening a window if needed"""
+    window = digest_window()
+    entry = {
+        "sender_id": sender_id,
+        "sender_name": sender_name,
+        "recipient_ids": list(recipient_ids),
+        "body": body,
+        "data": data,
+    }
+
+    if window <= 0:
+        send_digest(room_id, [entry])
+        return
+
+    head_key = HEAD_KEY.format(room_id=room_id)
+    cache.add(head_key, 0, COUNTER_TTL)
+    try:
+        index = cache.incr(head_key)
+    except ValueError:
+        # Head expired between add and incr
+        cache.add(head_key, 0, COUNTER_TTL)
+        index = cache.incr(head_key)
+    cache.set(ENTRY_KEY.format(room_id=room_id, index=index), entry, window * 4)
+    _schedule_flush(room_id)
+
+
+def _schedule_flush(room_id):
+    from utils.tasks import flush_chat_push_digest_task
+
+    window = settings.PUSH_DIGEST_WINDOW_SECONDS
+    if cache.add(SCHEDULED_KEY.format(room_id=room_id), 1, window * 4):
+        flush_chat_push_digest_task.apply_async(args=(room_id,), countdown=window)
+
+
+def flush_digest(room_id):
+    """Send and clear everything pending for the room (called by the task)"""
+    lock_key = FLUSH_LOCK_KEY.format(room_id=room_id)
+    if not cache.add(lock_key, 1, 60):
+        # Another flush is running; it or the next window picks these up
+        return
+    try:
+        # Close the window first so messages arriving now schedule the next digest
+        cache.delete(SCHEDULED_KEY.format(room_id=room_id))
+        pending, complete = _take_pending(room_id)
+    finally:
+        cache.delete(lock_key)
+
+    if not complete:
+        # A message was counted but not written yet; collect it next window
+        _schedule_flush(room_id)
+    if pending:
+        send_digest(room_id, pending)
+
+
+def _take_pending(room_id):
+    """
+    (entries, complete): the newest PUSH_DIGEST_MAX_MESSAGES entries after
+    the tail, oldest first. Stops at the first index
+    whose entry isn't written yet (complete=False), unless a previous flush
+    already waited a window on it: then its writer died or it expired.
+    """
+    head_key = HEAD_KEY.format(room_id=room_id)
+    tail_key = TAIL_KEY.format(room_id=room_id)
+    stalled_key = STALLED_KEY.format(room_id=room_id)
+
+    head = cache.get(head_key) or 0
+    tail = cache.get(tail_key) or 0
+    if tail > head:
+        # Head expired and restarted
+        tail = 0
+    if head == tail:
+        return [], True
+
+    # Older entries wouldn't make the digest; they expire on their own
+    indexes = range(max(tail + 1, head - settings.PUSH_DIGEST_MAX_MESSAGES + 1), head + 1)
+    keys = {index: ENTRY_KEY.format(room_id=room_id, index=index) for index in indexes}
+    found = cache.get_many(list(keys.values()))
+    stalled = cache.get(stalled_key) or 0
+    if stalled > head:
+        stalled = 0
+
+    entries = []
+    consumed = indexes[0] - 1
+    complete = True
+    for index in indexes:
+        entry = found.get(keys[index])
+        if entry is None and index > stalled:
+            cache.set(stalled_key, head, COUNTER_TTL)
+            complete = False
+            break
+        if entry is not None:
+            entries.append(entry)
+        consumed = index
+
+    cache.set(tail_key, consumed, COUNTER_TTL)
+    cache.touch(head_key, COUNTER_TTL)
+    cache.delete_many([keys[index] for index in indexes if index <= consumed])
+    return entries, complete
+
+
+def _digest_for(entries):
+    """(title, body, data) summarising a recipient's pending messages"""
+    last = entries[-1]
+    if len(entries) == 1:
+        return f"New message from {last['sender_name']}", last["body"], last["data"]
+
+    senders = list(dict.fromkeys(e["sender_name"] for e in entries))
+    if len(senders) == 1:
+        title = senders[0]
+        body = f"{len(entries)} new messages from {senders[0]}"
+    else:
+        title = "New messages"
+        others = len(senders) - 1
+        body = f"{len(entries)} new messages from {senders[-1]} and {others} other{'s' if others > 1 else ''}"
+    return title, body, {**last["data"], "count": len(entries)}
+
+
+def send_digest(room_id, entries):
+    from utils.push import send_push_notifications
+
+    per_recipient = {}
+    for entry in entries:
+        for user_id in entry["recipient_ids"]:
+            if user_id != entry["sender_id"]:
+                per_recipient.setdefault(user_id, []).append(entry)
+
+    if not per_recipient:
+        return None
+
+    notifications = [
+        (user_id, *_digest_for(user_entries))
+        for user_id, user_entries in per_recipient.items()
+    ]
+    collapse_key = chat_collapse_key(room_id)
+    result = send_push_notifications(notifications, collapse_key=collapse_key, thread_id=collapse_key)
+    print(f"📨 Chat push digest for room {room_id}: {len(entries)} messages to {len(notifications)} users")
+    return result
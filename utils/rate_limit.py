@@ -0,0 +1,52 @@
+# utils/rate_limit.py
+"""
+Token buckets kept in the Django cache. Workers only share a bucket when
+they share the cache (CACHE_URL); with the per-process LocMem fallback each
+process would get its own full bucket, so take() refuses to run on it
+outside DEBUG and tests (utils.shared_cache).
+
+A bucket holds up to `capacity` tokens and refills at `rate` tokens per
+second. take() either consumes a token and returns 0, or returns how many
+seconds until one is available, so callers can reschedule instead of
+sleeping. Updates are serialised with a short cache.add lock; a caller that
+can't get the lock is told to retry shortly.
+"""
+import time
+
+from django.core.cache import cache
+
+from utils.shared_cache import require_shared_cache
+
+LOCK_TIMEOUT = 2
+LOCK_RETRY_SECONDS = 0.05
+
+
+class TokenBucket:
+    def __init__(self, name, rate, capacity=None):
+        self.key = f"bucket:{name}"
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+
+    def take(self):
+        """Consume a token; returns 0 on success or the seconds to wait"""
+        if self.rate <= 0:
+            return 0
+        require_shared_cache("SMS rate limits")
+        lock_key = f"{self.key}:lock"
+        if not cache.add(lock_key, 1, LOCK_TIMEOUT):
+            return LOCK_RETRY_SECONDS
+        try:
+            now = time.time()
+            tokens, updated = cache.get(self.key) or (self.capacity, now)
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                cache.set(self.key, (tokens, now), self._ttl())
+                return (1 - tokens) / self.rate
+            cache.set(self.key, (tokens - 1, now), self._ttl())
+            return 0
+        finally:
+            cache.delete(lock_key)
+
+    def _ttl(self):
+        # Long enough to refill completely; an expired bucket is simply full
+        return int(self.capacity / self.rate) + 60
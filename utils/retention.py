@@ -0,0 +1,192 @@
+# utils/retention.py
+"""
+Retention engine for tables that only ever grow.
+
+Each RetentionPolicy names a model and the rows that may go. The engine walks
+matching primary keys in ascending order, deleting RETENTION_BATCH_SIZE rows
+per transaction, and sleeps between batches in proportion to how long the
+batch took (RETENTION_SLEEP_RATIO) so replicas keep up. A run stops after
+RETENTION_MAX_SECONDS_PER_RUN and the next one picks up where it left off,
+since deleted rows no longer match.
+"""
+import time
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+
+class RetentionPolicy:
+    """
+    name: label used by the command/metrics
+    model: "app_label.ModelName"
+    build_queryset: callable(model, now) -> queryset of rows that may be deleted,
+        or None when the policy is switched off
+    fields: columns passed to on_delete with each deleted pk
+    on_delete: callable([(pk, *fields), ...]) run in the delete transaction,
+        e.g. to keep counters in step
+    """
+
+    def __init__(self, name, model, build_queryset, fields=(), on_delete=None):
+        self.name = name
+        self.model = model
+        self.build_queryset = build_queryset
+        self.fields = tuple(fields)
+        self.on_delete = on_delete
+
+    def queryset(self, now):
+        return self.build_queryset(apps.get_model(self.model), now)
+
+
+def _days_ago(now, days):
+    return now - timedelta(days=days) if days > 0 else None
+
+
+def _notifications(model, now):
+    read_cutoff = _days_ago(now, settings.RETENTION_NOTIFICATION_READ_DAYS)
+    unread_cutoff = _days_ago(now, settings.RETENTION_NOTIFICATION_UNREAD_DAYS)
+    if read_cutoff and unread_cutoff:
+        return model.objects.filter(Q(is_read=True, created_at__lt=read_cutoff) | Q(created_at__lt=unread_cutoff))
+    if read_cutoff:
+        return model.objects.filter(is_read=True, created_at__lt=read_cutoff)
+    if unread_cutoff:
+        return model.objects.filter(created_at__lt=unread_cutoff)
+    return None
+
+
+def _notifications_deleted(rows):
+    from chat.models import NotificationCounter
+
+    NotificationCounter.record_deleted((user_id, event_type, is_read) for _, user_id, event_type, is_read in rows)
+
+
+def _otp_codes(model, now):
+    # Used codes can't be used again; expired ones are kept briefly for support lookups
+    cutoff = now - timedelta(hours=settings.RETENTION_OTP_GRACE_HOURS)
+    return model.objects.filter(Q(is_used=True, created_at__lt=cutoff) | Q(expires_at__lt=cutoff))
+
+
+def _event_audits(model, now):
+    # Stripe stops retrying after 3 days; rows only dedupe retries
+    cutoff = _days_ago(now, settings.RETENTION_EVENT_AUDIT_DAYS)
+    return model.objects.filter(processed_at__lt=cutoff) if cutoff else None
+
+
+def _message_read_statuses(model, now):
+    # Only rows the reader's room watermark already covers; read state survives
+    cutoff = _days_ago(now, settings.RETENTION_READ_STATUS_DAYS)
+    if not cutoff:
+        return None
+    ChatParticipant = apps.get_model("chat", "ChatParticipant")
+    covered = ChatParticipant.objects.filter(
+        chat_room_id=OuterRef("message__chat_room_id"),
+        user_id=OuterRef("user_id"),
+        last_read_message_id__gte=OuterRef("message_id"),
+    )
+    return model.objects.filter(Exists(covered), read_at__lt=cutoff)
+
+
+def _activity_logs(model, now):
+    cutoff = _days_ago(now, settings.RETENTION_ACTIVITY_LOG_DAYS)
+    return model.objects.filter(created_at__lt=cutoff) if cutoff else None
+
+
+def _sms_messages(model, now):
+    cutoff = _days_ago(now, settings.RETENTION_SMS_MESSAGE_DAYS)
+    return model.objects.filter(created_at__lt=cutoff) if cutoff else None
+
+
+POLICIES = [
+    RetentionPolicy(
+        "notifications", "chat.Notification", _notifications,
+        fields=("user_id", "event_type", "is_read"), on_delete=_notifications_deleted,
+    ),
+    RetentionPolicy("otp_codes", "accounts.OtpCode", _otp_codes),
+    RetentionPolicy("event_audits", "payments.EventAudit", _event_audits),
+    RetentionPolicy("message_read_statuses", "chat.MessageReadStatus", _message_read_statuses),
+    RetentionPolicy("activity_logs", "activity.ActivityLog", _activity_logs),
+    RetentionPolicy("sms_messages", "accounts.SmsMessage", _sms_messages),
+]
+
+
+def get_policies(names=None):
+    if not names:
+        return list(POLICIES)
+    known = {p.name: p for p in POLICIES}
+    unknown = set(names) - set(known)
+    if unknown:
+        raise ValueError(f"Unknown retention policies: {', '.join(sorted(unknown))}")
+    return [known[name] for name in names]
+
+
+def prune(policy, batch_size=None, deadline=None, dry_run=False, progress=None):
+    """
+    Delete the policy's rows in pk order. Returns metrics:
+    {"policy", "deleted", "batches", "seconds", "last_pk", "finished"}
+    """
+    batch_size = batch_size or settings.RETENTION_BATCH_SIZE
+    started = time.monotonic()
+    stats = {"policy": policy.name, "deleted": 0, "batches": 0, "seconds": 0.0, "last_pk": None, "finished": True}
+
+    now = timezone.now()
+    queryset = policy.queryset(now)
+    if queryset is None:
+        return stats
+
+    # Rows created after the run starts wait for the next run
+    upper = queryset.model.objects.order_by("-pk").values_list("pk", flat=True).first()
+    last_pk = None
+    while upper is not None:
+        if deadline is not None and time.monotonic() >= deadline:
+            stats["finished"] = False
+            break
+
+        batch_started = time.monotonic()
+        window = queryset.filter(pk__lte=upper)
+        if last_pk is not None:
+            window = window.filter(pk__gt=last_pk)
+        pks = list(window.order_by("pk").values_list("pk", flat=True)[:batch_size])
+        if not pks:
+            break
+
+        if dry_run:
+            deleted = len(pks)
+        else:
+            with transaction.atomic():
+                # Re-apply the policy so rows that changed since the SELECT survive
+                doomed = queryset.filter(pk__in=pks)
+                if policy.on_delete:
+                    rows = list(doomed.select_for_update().values_list("pk", *policy.fields))
+                    deleted, _ = queryset.model.objects.filter(pk__in=[row[0] for row in rows]).delete()
+                    policy.on_delete(rows)
+                else:
+                    deleted, _ = doomed.delete()
+
+        last_pk = pks[-1]
+        stats["deleted"] += deleted
+        stats["batches"] += 1
+        stats["last_pk"] = last_pk
+        if progress:
+            progress(stats)
+
+        if len(pks) < batch_size:
+            break
+        # Give replicas time proportional to the work just done
+        took = time.monotonic() - batch_started
+        time.sleep(max(settings.RETENTION_MIN_SLEEP_SECONDS, took * settings.RETENTION_SLEEP_RATIO))
+
+    stats["seconds"] = round(time.monotonic() - started, 2)
+    return stats
+
+
+def run_retention(names=None, batch_size=None, max_seconds=None, dry_run=False, progress=None):
+    """Run every (or the named) policy within one time budget; returns per-policy metrics"""
+    max_seconds = settings.RETENTION_MAX_SECONDS_PER_RUN if max_seconds is None else max_seconds
+    deadline = time.monotonic() + max_seconds if max_seconds else None
+    results = []
+    for policy in get_policies(names):
+        results.append(prune(policy, batch_size=batch_size, deadline=deadline, dry_run=dry_run, progress=progress))
+    return results
@@ -0,0 +1,19 @@
+# utils/shared_cache.py
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+def shared_cache_available():
+    """True when the cache is shared, or per-process memory is acceptable (DEBUG, tests)."""
+    return settings.SHARED_CACHE or settings.DEBUG or settings.TESTING
+
+
+def require_shared_cache(feature):
+    """
+    Raise ImproperlyConfigured when `feature` relies on a cache every process
+    sees but CACHES is per-process memory (CACHE_URL unset). Allowed in DEBUG
+    and tests, where a single process is the norm.
+    """
+    if shared_cache_available():
+        return
+    raise ImproperlyConfigured(f"{feature} need a shared cache; set CACHE_URL")
@@ -0,0 +1,230 @@
+# utils/tasks.py
+"""
+Background side effects (email, SMS, push, in-app notifications).
+
+Views enqueue these with `.delay_on_commit(...)` so nothing is sent for a
+transaction that rolls back and the request never waits on SMTP, Twilio or
+FCM. Queues and priorities are set in settings (CELERY_TASK_ROUTES); every
+task retries with exponential backoff and jitter.
+"""
+from celery import shared_task
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# Only these helpers can be named by a queued task
+EMAIL_FUNCTIONS = {
+    "send_otp",
+    "send_referral_email",
+    "send_app_download_email",
+    "send_solo_signup_success_email",
+    "send_company_signup_email",
+    "send_payment_success_email",
+    "send_payment_failed_email",
+}
+SMS_METHODS = {
+    "send_sms",
+    "send_app_download_sms",
+    "send_referral_sms",
+}
+
+RETRY_OPTIONS = {
+    "autoretry_for": (Exception,),
+    # A misconfigured deployment fails the same way on every retry
+    "dont_autoretry_for": (ImproperlyConfigured,),
+    "retry_backoff": True,
+    "retry_jitter": True,
+}
+
+
+class DeliveryFailed(Exception):
+    """A provider reported failure without raising; raised so the task retries."""
+
+
+@shared_task(
+    name="utils.tasks.send_email",
+    retry_backoff_max=settings.EMAIL_TASK_RETRY_BACKOFF_MAX,
+    max_retries=settings.EMAIL_TASK_MAX_RETRIES,
+    **RETRY_OPTIONS,
+)
+def send_email_task(func_name, **kwargs):
+    if func_name not in EMAIL_FUNCTIONS:
+        raise ValueError(f"Unknown email function: {func_name}")
+
+    from utils import email_service
+
+    getattr(email_service, func_name)(**kwargs)
+    print(f"Email {func_name} sent to {kwargs.get('email') or kwargs.get('referred_to_email')}")
+
+
+@shared_task(
+    name="utils.tasks.send_invitation",
+    retry_backoff_max=settings.EMAIL_TASK_RETRY_BACKOFF_MAX,
+    max_retries=settings.EMAIL_TASK_MAX_RETRIES,
+    **RETRY_OPTIONS,
+)
+def send_invitation_task(user_id):
+    """
+    Set a fresh temporary password for an invited user and email it. The
+    password is generated here, so it never sits in a broker message, task
+    args or the result backend; each retry mails a new one.
+    """
+    from accounts.models import User
+    from utils import email_service
+    from utils.otp_utils import generate_random_password
+
+    user = User.objects.filter(id=user_id).first()
+    # Deleted since, or already chose their own password
+    if user is None or user.is_passwordSet:
+        return
+
+    password = generate_random_password()
+    user.set_password(password)
+    user.save(update_fields=["password"])
+    email_service.send_invitation_email(email=user.email, name=user.full_name, password=password)
+    print(f"Invitation sent to {user.email}")
+
+
+@shared_task(
+    name="utils.tasks.send_sms",
+    bind=True,
+    retry_backoff_max=settings.SMS_TASK_RETRY_BACKOFF_MAX,
+    max_retries=settings.SMS_TASK_MAX_RETRIES,
+    **RETRY_OPTIONS,
+)
+def send_sms_task(self, method, **kwargs):
+    if method not in SMS_METHODS:
+        raise ValueError(f"Unknown SMS method: {method}")
+
+    from utils.twilio_service import RateLimited, TwilioService
+
+    try:
+        result = getattr(TwilioService, method)(**kwargs)
+    except RateLimited as e:
+        # Waiting for the bucket isn't a failure: re-queue without using up a retry
+        priority = (self.request.delivery_info or {}).get("priority")
+        self.apply_async(args=(method,), kwargs=kwargs, countdown=e.wait, priority=priority)
+        return {"rate_limited": True, "retry_in": e.wait}
+    # Some TwilioService helpers swallow errors and return a result dict
+    if isinstance(result, dict) and not result.get("success"):
+        raise DeliveryFailed(result.get("error") or f"{method} failed")
+    return result
+
+
+@shared_task(
+    name="utils.tasks.send_push",
+    bind=True,
+    retry_backoff_max=settings.PUSH_TASK_RETRY_BACKOFF_MAX,
+    max_retries=settings.PUSH_TASK_MAX_RETRIES,
+    **RETRY_OPTIONS,
+)
+def send_push_task(self, user_id, title, body, data=None, tokens=None):
+    from celery.utils.time import get_exponential_backoff_interval
+
+    from utils.push import send_push_notification_to_user
+
+    result = send_push_notification_to_user(user=user_id, title=title, body=body, data=data, tokens=tokens)
+    # "Firebase not initialized" won't fix itself on retry; anything else might
+    if isinstance(result, dict) and "error" in result and "not initialized" not in result["error"]:
+        raise DeliveryFailed(result["error"])
+
+    # Retry only the devices that failed, so the others aren't pushed twice
+    failed = set(result.get("failed_tokens") or []) - set(result.get("invalid_tokens") or [])
+    if failed:
+        countdown = get_exponential_backoff_interval(
+            factor=1, retries=self.request.retries, maximum=settings.PUSH_TASK_RETRY_BACKOFF_MAX, full_jitter=True,
+        )
+        raise self.retry(
+            args=(user_id, title, body, data), kwargs={"tokens": sorted(failed)},
+            exc=DeliveryFailed(f"Push failed for {len(failed)} devices"), countdown=countdown,
+        )
+    return result
+
+
+@shared_task(
+    name="utils.tasks.notify_users",
+    retry_backoff_max=settings.NOTIFY_TASK_RETRY_BACKOFF_MAX,
+    max_retries=settings.NOTIFY_TASK_MAX_RETRIES,
+    **RETRY_OPTIONS,
+)
+def notify_users_task(user_ids, payload, event_type="notification"):
+    from utils.notify import notify_users
+
+    # Storage errors raise so the task retries; rows and counters are written
+    # in one transaction, so a failed attempt stored and sent nothing
+    notify_users(user_ids, payload, event_type, strict=True)
+
+
+@shared_task(
+    name="utils.tasks.flush_chat_push_digest",
+    retry_backoff_max=settings.PUSH_TASK_RETRY_BACKOFF_MAX,
+    max_retries=settings.PUSH_TASK_MAX_RETRIES,
+    **RETRY_OPTIONS,
+)
+def flush_chat_push_digest_task(room_id):
+    from utils.push_digest import flush_digest
+
+    flush_digest(room_id)
+
+
+@shared_task(name="utils.tasks.run_retention")
+def run_retention_task(names=None):
+    from utils.retention import run_retention
+
+    results = run_retention(names)
+    for stats in results:
+        print(
+            f"Retention {stats['policy']}: deleted {stats['deleted']} in {stats['batches']} batches, "
+            f"{stats['seconds']}s{'' if stats['finished'] else ' (time budget hit)'}"
+        )
+    return results
+
+
+@shared_task(name="utils.tasks.run_broadcast", bind=True)
+def run_broadcast_task(self, broadcast_id):
+    """One chunk per task run, then re-queue, so long broadcasts don't hold a worker"""
+    from chat.models import Broadcast
+    from utils.broadcast import process_next_chunk
+
+    try:
+        more = process_next_chunk(broadcast_id)
+    except Exception as e:
+        Broadcast.objects.filter(id=broadcast_id, status="running").update(status="failed", error=str(e)[:1000])
+        print(f"❌ Broadcast {broadcast_id} failed: {e}")
+        raise
+    if more:
+        self.apply_async(args=(broadcast_id,))
+
+
+@shared_task(name="utils.tasks.resume_stalled_broadcasts")
+def resume_stalled_broadcasts_task():
+    """
+    Re-queue running broadcasts whose worker died between chunks, and failed
+    ones with automatic retries left
+    """
+    from datetime import timedelta
+
+    from django.db.models import F
+    from django.utils import timezone
+
+    from chat.models import Broadcast
+
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=settings.BROADCAST_STALL_SECONDS)
+    stalled = list(Broadcast.objects.filter(status="running", updated_at__lt=cutoff).values_list("id", flat=True))
+
+    retryable = Broadcast.objects.filter(
+        status="failed", retry_count__lt=settings.BROADCAST_MAX_RETRIES, updated_at__lt=cutoff,
+    ).values_list("id", flat=True)
+    for broadcast_id in retryable:
+        # Conditional update: an admin resume or another beat run may have claimed it
+        claimed = Broadcast.objects.filter(id=broadcast_id, status="failed").update(
+            status="running", retry_count=F("retry_count") + 1, updated_at=now,
+        )
+        if claimed:
+            stalled.append(broadcast_id)
+
+    for broadcast_id in stalled:
+        run_broadcast_task.delay(broadcast_id)
+    if stalled:
+        print(f"Resumed stalled broadcasts: {stalled}")
+    return stalled
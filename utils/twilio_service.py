@@ -1,10 +1,110 @@
+import hashlib
+import os
+import threading
+
+from twilio.base.exceptions import TwilioRestException
+from twilio.http.http_client import TwilioHttpClient
 from twilio.rest import Client
 from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+
+from utils.rate_limit import TokenBucket
+from utils.shared_cache import require_shared_cache
+
+
+class RateLimited(Exception):
+    """A send bucket is empty; try again in `wait` seconds."""
+
+    def __init__(self, wait):
+        super().__init__(f"SMS rate limit, retry in {wait:.2f}s")
+        self.wait = wait
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    One Twilio client per process. TwilioHttpClient(pool_connections=True)
+    keeps a requests Session, so sends reuse the HTTPS connection to
+    api.twilio.com instead of a new TLS handshake each time.
+    """
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            http_client = TwilioHttpClient(pool_connections=True, timeout=settings.TWILIO_TIMEOUT_SECONDS)
+            _client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN, http_client=http_client)
+            _client_pid = os.getpid()
+        return _client
+
+
+def _buckets(from_number):
+    # Twilio queues and eventually rejects what exceeds the sender's MPS
+    return [
+        TokenBucket("sms:account", settings.TWILIO_ACCOUNT_SMS_PER_SECOND),
+        TokenBucket(f"sms:number:{from_number}", settings.TWILIO_NUMBER_SMS_PER_SECOND),
+    ]
 
 
 class TwilioService:
     def __init__(self):
-        self.client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+        self.client = get_client()
+
+    @classmethod
+    def _send(cls, kind: str, phone_number: str, body: str) -> str:
+        """
+        Send one SMS through the shared client and record it (accounts.SmsMessage).
+        - The same body to the same number within TWILIO_SMS_DEDUPE_SECONDS is
+          sent once; the duplicate returns the first message's sid, or None
+          while that send is still in flight. The claim lives in the cache,
+          so it needs CACHE_URL to hold across workers.
+        - Raises RateLimited when the account or sender bucket is empty.
+        """
+        from accounts.models import SmsMessage
+
+        window = settings.TWILIO_SMS_DEDUPE_SECONDS
+        if window > 0:
+            require_shared_cache("SMS duplicate checks")
+        digest = hashlib.sha256(f"{phone_number}\n{body}".encode()).hexdigest()
+        dedupe_key = f"sms_dedupe:{digest}"
+        if window > 0 and not cache.add(dedupe_key, "pending", window):
+            print(f"Skipping duplicate {kind} SMS to {phone_number}")
+            sid = cache.get(dedupe_key)
+            return None if sid == "pending" else sid
+
+        try:
+            for bucket in _buckets(settings.TWILIO_PHONE_NUMBER):
+                wait = bucket.take()
+                if wait:
+                    raise RateLimited(wait)
+
+            extra = {}
+            if settings.TWILIO_STATUS_CALLBACK_URL:
+                extra["status_callback"] = settings.TWILIO_STATUS_CALLBACK_URL
+            message = get_client().messages.create(
+                body=body,
+                from_=settings.TWILIO_PHONE_NUMBER,
+                to=phone_number,
+                **extra
+            )
+        except Exception as e:
+            # Let the retry through
+            if window > 0:
+                cache.delete(dedupe_key)
+            if isinstance(e, TwilioRestException):
+                SmsMessage.objects.create(
+                    to=phone_number, kind=kind, status="failed",
+                    error_code=str(e.code or ""), error_message=str(e.msg or "")[:1000],
+                )
+            raise
+
+        if window > 0:
+            cache.set(dedupe_key, message.sid, window)
+        SmsMessage.objects.create(sid=message.sid, to=phone_number, kind=kind, status=message.status or "queued")
+        return message.sid
 
     # ----- internal: build link block safely from settings -----
     @staticmethod
@@ -42,7 +142,6 @@ class TwilioService:
         purpose: str = "verification",
         expires_in: int = 10
     ):
-        service = cls()
         message_body = (
             f"ReferralPro: Use OTP {otp_code} to {purpose.capitalize()}.\n"
             f"Expires in {expires_in} minutes.\n\n"
@@ -50,12 +149,7 @@ class TwilioService:
             f"{cls._link_block()}"
         )
 
-        message = service.client.messages.create(
-            body=message_body,
-            from_=settings.TWILIO_PHONE_NUMBER,
-            to=phone_number
-        )
-        return message.sid
+        return cls._send("otp", phone_number, message_body)
 
     @classmethod
     def send_app_download_sms(
@@ -69,8 +163,6 @@ class TwilioService:
         Send SMS invitation to download the ReferralPro app
         """
         try:
-            service = cls()
-
             inviter = f"{sender_name} has" if sender_name else "You have"
             message_body = (
                 f"Hi {name}!\n\n"
@@ -82,13 +174,12 @@ class TwilioService:
                 "Best regards,\nReferralPro Team"
             )
 
-            message = service.client.messages.create(
-                body=message_body,
-                from_=settings.TWILIO_PHONE_NUMBER,
-                to=phone_number
-            )
-            return {"success": True, "sid": message.sid}
+            sid = cls._send("app_download", phone_number, message_body)
+            return {"success": True, "sid": sid}
 
+        except (RateLimited, ImproperlyConfigured):
+            # Not a delivery failure: re-queue, or fix the deployment
+            raise
         except Exception as e:
             print(f"Failed to send app download SMS to {phone_number}: {str(e)}")
             return {"success": False, "error": str(e)}
@@ -107,8 +198,6 @@ class TwilioService:
         """
         Send an SMS notification when a referral is created.
         """
-        service = cls()
-
         try:
             reason_text = f"\nReason: {reason}" if reason else ""
             description_text = f"\nNotes: {request_description}" if request_description else ""
@@ -123,15 +212,14 @@ class TwilioService:
                 "Regards,\nReferralPro Team"
             )
 
-            message = service.client.messages.create(
-                body=message_body,
-                from_=settings.TWILIO_PHONE_NUMBER,
-                to=phone_number
-            )
+            sid = cls._send("referral", phone_number, message_body)
 
             print(f"Referral SMS sent to {phone_number}")
-            return {"success": True, "sid": message.sid}
+            return {"success": True, "sid": sid}
 
+        except (RateLimited, ImproperlyConfigured):
+            # Not a delivery failure: re-queue, or fix the deployment
+            raise
         except Exception as e:
             print(f"Failed to send referral SMS to {phone_number}: {str(e)}")
             return {"success": False, "error": str(e)}